@@ -1,10 +1,22 @@
 #!/usr/bin/env bash
 
-if [ -e ~/.cache/huggingface/token ]
+# ./httpfs_lm.bash [-u] ORG/NAME[@REVISION] ...
+# clones each repository without its lfs files and mounts it over itself with one
+# background process, which serves the lfs files from the network and logs to
+# .git/httpfs_lm.log; -u unmounts instead
+
+srcdir="$(dirname "$(readlink -f "$0")")"
+
+unmount=''
+if [ "$1" == "-u" ]
+then
+    unmount=1
+    shift
+fi
+
+if ! python3 -c 'import fuse, dulwich, requests' 2> /dev/null
 then
-    hfhubheader="--header=Authorization: Bearer $(<~/.cache/huggingface/token)"
-else
-    hfhubheader=''
+    python3 -m pip install fusepy dulwich requests
 fi
 
 for lmurl in "$@"
@@ -19,17 +31,21 @@ do
     fi
     revision="${lmurl#*@}"
     lmurl="${lmurl%@*}"
-    httpfspath="${lmurl}/resolve/${revision//\//%2F}"
-
-    if ! type -p httpfs > /dev/null || ! grep args.header $(type -p httpfs) > /dev/null
-    then
-        python3 -m pip install git+https://github.com/xloem/httpfs@5b9b122acb5867f0b0da04b5a3cfb1cf78551741
-    fi
-    sed -i 's/print(d)/print(d, flush=True)/' $(type -p httpfs) # to process the output in a pipeline
-    sed -i 's/, allow_other=True//' $(type -p httpfs) # not always supported
     lmpath="${lmurl#*//}"
     lmpath="${lmpath#*/}/$revision"
     lmpath="${lmpath//\//_}"
+
+    if [ -n "$unmount" ]
+    then
+        fusermount -u "$lmpath" && echo "$lmpath" unmounted
+        continue
+    fi
+    if mountpoint -q "$lmpath"
+    then
+        echo "$lmpath" is already mounted
+        continue
+    fi
+
     if ! [ -e "$lmpath"/.git/config ]
     then
         GIT_LFS_SKIP_SMUDGE=1 git clone "$lmurl" "$lmpath"
@@ -37,30 +53,28 @@ do
     (
         cd "$lmpath"
         git fetch origin "$revision":"remotes/origin/$revision"
-        GIT_LFS_SKIP_SMUDGE=1 git checkout "remotes/origin/$revision" -b "$revision"
+        GIT_LFS_SKIP_SMUDGE=1 git checkout "remotes/origin/$revision" -B "$revision"
         git branch --set-upstream-to=origin/"$revision" "$revision"
         GIT_LFS_SKIP_SMUDGE=1 git pull
-        {
-            grep --files-with-matches -r https://git-lfs.github.com/spec/v1
-            find -L -type l
-        } | while read filename
-        do
-            echo "Mounting $lmpath/$filename .."
-            rm "$filename"
-            httpfs "$hfhubheader" "$httpfspath/$filename" | while read line
-            do
-                echo "$line"
-                if [ "$line" == "..." ]
-                then
-                    read mountpath
-                    ln -sf "$mountpath"/"$(basename "$filename")" "$filename"
-                fi
-            done &
-            while ! [ -e "$filename" ]; do sleep 1; done
-            echo "$lmpath/$filename -> $(readlink "$filename")"
-        done
     )
+    # the mount stays in the foreground, so it is backgrounded here and waited on until
+    # mounted; it then resolves every lfs file in the background
+    PYTHONPATH="$srcdir${PYTHONPATH:+:$PYTHONPATH}" nohup python3 -m test.mount mount "$lmpath" \
+        > "$lmpath"/.git/httpfs_lm.log 2>&1 < /dev/null &
+    pid=$!
+    tries=300
+    until mountpoint -q "$lmpath"
+    do
+        if ! kill -0 "$pid" 2> /dev/null || ! (( tries-- ))
+        then
+            cat "$lmpath"/.git/httpfs_lm.log >&2
+            echo "$lmpath" failed to mount >&2
+            kill "$pid" 2> /dev/null
+            continue 2
+        fi
+        sleep 0.1
+    done
+
     echo
-    echo "$lmurl" mounted at "$lmpath"
+    echo "$lmurl" mounted at "$lmpath", unmount with "$0" -u "${lmurl#https://huggingface.co/}@$revision"
 done
-wait
@@ -0,0 +1,207 @@
+# Benchmarks for the mount.
+#   python3 -m test.bench read PATH [--threads 1,2,4,8,16]
+# reads every file under PATH, normally a mountpoint, with increasing numbers
+# of reader threads and prints throughput and read latency for each.
+#   python3 -m test.bench read --repo REPO [--fuse-args '-s'] ...
+# mounts REPO on a temporary mountpoint first, passing fuse args through.
+#   python3 -m test.bench fake [--latency 0.02] [--bandwidth 200] [--rate-limit 0.01] ...
+# serves synthetic checkpoints from a local fake LFS server, mounts a repository of
+# their pointers afresh for each thread count, and reads it as above. When torch is
+# available it then times torch_remote_serialization.load through the mount and
+# straight from the server, reporting time to first tensor.
+
+import hashlib, io, os, shutil, subprocess, sys, tempfile, threading, time
+
+from .stats import Stats
+
+def list_files(path):
+    files = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        if '.git' in dirnames:
+            dirnames.remove('.git')
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            if os.path.isfile(filepath) and os.path.getsize(filepath):
+                files.append(filepath)
+    return files
+
+def bench_read(files, threads, read_size=128*1024, duration=5.0):
+    # each thread preads read_size pieces, walking files sequentially from staggered starts
+    # returns bytes per second summed over threads, and a snapshot of the read latency histogram
+    fds = [os.open(path, os.O_RDONLY) for path in files]
+    sizes = [os.fstat(fd).st_size for fd in fds]
+    stats = Stats()
+    total = [0] * threads
+    deadline = time.monotonic() + duration
+    def reader(num):
+        file_idx = num % len(fds)
+        offset = num * sizes[file_idx] // threads // read_size * read_size
+        nbytes = 0
+        while time.monotonic() < deadline:
+            start = time.monotonic()
+            data = os.pread(fds[file_idx], read_size, offset)
+            stats.record('read_latency', time.monotonic() - start)
+            nbytes += len(data)
+            offset += read_size
+            if offset >= sizes[file_idx]:
+                file_idx = (file_idx + 1) % len(fds)
+                offset = 0
+        total[num] = nbytes
+    start = time.monotonic()
+    workers = [threading.Thread(target=reader, args=[num]) for num in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - start
+    for fd in fds:
+        os.close(fd)
+    return sum(total) / elapsed, stats.snapshot()['histograms'].get('read_latency')
+
+def bench_load(source):
+    # times torch_remote_serialization.load and fetching every tensor it returns
+    import torch_remote_serialization
+    start = time.monotonic()
+    tensors = torch_remote_serialization.load(source, manifest_dir=None)
+    loaded = time.monotonic()
+    first = None
+    nbytes = 0
+    for name, tensor in torch_remote_serialization.iter_fetch(tensors):
+        # mapped tensors read nothing until touched
+        tensor = tensor.clone()
+        if first is None:
+            first = time.monotonic()
+        nbytes += tensor.numel() * tensor.element_size()
+    end = time.monotonic()
+    return dict(load=loaded - start, first_tensor=(first or end) - start, total=end - start, rate=nbytes / (end - start))
+
+def format_read(threads, rate, latency):
+    line = f'{threads:4d} threads {rate/1024/1024:10.1f} MiB/s'
+    if latency:
+        line += f' p50 {latency["p50"]*1000:8.1f}ms p99 {latency["p99"]*1000:8.1f}ms'
+    return line
+
+def format_load(label, timing):
+    return (
+        f'{label:>24} load {timing["load"]:7.3f}s first tensor {timing["first_tensor"]:7.3f}s'
+        f' all {timing["total"]:7.3f}s {timing["rate"]/1024/1024:10.1f} MiB/s'
+    )
+
+def synthetic_checkpoint(size, layers=32):
+    import torch
+    numel = max(1, size // layers // 4)
+    state = {f'layers.{idx}.weight': torch.randn(numel) for idx in range(layers)}
+    buf = io.BytesIO()
+    torch.save(state, buf)
+    return buf.getvalue()
+
+def fake_repo(fake, contents):
+    # a repository whose files are lfs pointers to contents, a dict of name -> bytes, added to fake
+    path = tempfile.mkdtemp(prefix='httpfs_lm_bench_repo_')
+    def git(*args):
+        subprocess.check_call(['git', '-C', path, '-c', 'user.name=bench', '-c', 'user.email=bench@localhost', *args], stdout=subprocess.DEVNULL)
+    git('init', '-q')
+    for name, data in contents.items():
+        with open(os.path.join(path, name), 'wb') as fh:
+            fh.write(fake.pointer(fake.add(data), len(data)))
+    git('add', '.')
+    git('commit', '-q', '-m', 'synthetic')
+    git('remote', 'add', 'origin', fake.url + '/bench')
+    return path
+
+def mount(repo_path, fuse_args=[], mount_args=[]):
+    mountpoint = tempfile.mkdtemp(prefix='httpfs_lm_bench_')
+    proc = subprocess.Popen([
+        sys.executable, '-m', 'test.mount', 'mount', *mount_args, repo_path, mountpoint, *fuse_args
+    ], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    while not os.path.ismount(mountpoint):
+        if proc.poll() is not None:
+            raise RuntimeError('mount exited with status ' + str(proc.returncode))
+        time.sleep(0.1)
+    return mountpoint, proc
+
+def unmount(mountpoint, proc):
+    subprocess.call(['fusermount', '-u', mountpoint])
+    proc.wait()
+    os.rmdir(mountpoint)
+
+if __name__ == '__main__':
+    import argparse, shlex
+    parser = argparse.ArgumentParser(description='Benchmark the mount')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    read_parser = subparsers.add_parser('read', help='multithreaded read throughput')
+    read_parser.add_argument('path', nargs='?', help='directory to read, normally a mountpoint')
+    read_parser.add_argument('--repo', help='mount this repository on a temporary mountpoint and read that')
+    read_parser.add_argument('--fuse-args', default='', help='extra arguments for the mount, e.g. -s')
+    read_parser.add_argument('--threads', default='1,2,4,8,16', help='comma-separated reader thread counts')
+    read_parser.add_argument('--read-size', type=int, default=128*1024)
+    read_parser.add_argument('--duration', type=float, default=5.0, help='seconds per thread count')
+    fake_parser = subparsers.add_parser('fake', help='read and load synthetic checkpoints from a local fake lfs server')
+    fake_parser.add_argument('--files', type=int, default=2, help='number of checkpoints')
+    fake_parser.add_argument('--size', type=float, default=64, help='MiB per checkpoint')
+    fake_parser.add_argument('--latency', type=float, default=0.02, help='seconds the server adds to every response')
+    fake_parser.add_argument('--bandwidth', type=float, help='MiB per second the server sends in total')
+    fake_parser.add_argument('--rate-limit', type=float, default=0, help='fraction of requests the server refuses with 429')
+    fake_parser.add_argument('--retry-after', type=float, default=1, help='seconds the server asks refused clients to wait')
+    fake_parser.add_argument('--mount-args', default='', help='extra arguments for the mount command, e.g. --readahead 8')
+    fake_parser.add_argument('--fuse-args', default='', help='extra arguments for fuse, e.g. -s')
+    fake_parser.add_argument('--threads', default='1,4,16', help='comma-separated reader thread counts')
+    fake_parser.add_argument('--read-size', type=int, default=128*1024)
+    fake_parser.add_argument('--duration', type=float, default=5.0, help='seconds per thread count')
+    args = parser.parse_args()
+
+    if args.command == 'read':
+        if args.repo is not None:
+            path, proc = mount(args.repo, shlex.split(args.fuse_args))
+        else:
+            path = args.path
+        try:
+            files = list_files(path)
+            if not files:
+                sys.exit('no files to read under ' + path)
+            for threads in [int(count) for count in args.threads.split(',')]:
+                rate, latency = bench_read(files, threads, args.read_size, args.duration)
+                print(format_read(threads, rate, latency), flush=True)
+        finally:
+            if args.repo is not None:
+                unmount(path, proc)
+
+    elif args.command == 'fake':
+        from .fake_lfs import FakeLFS
+        bandwidth = args.bandwidth and args.bandwidth * 1024 * 1024
+        fake = FakeLFS(latency=args.latency, bandwidth=bandwidth, rate_limit=args.rate_limit, retry_after=args.retry_after).start()
+        try:
+            import torch
+        except ImportError:
+            torch = None
+            print('torch is not available, serving random bytes and skipping load timings', flush=True)
+        size = int(args.size * 1024 * 1024)
+        if torch is not None:
+            contents = {f'model-{idx}.pt': synthetic_checkpoint(size) for idx in range(args.files)}
+        else:
+            contents = {f'data-{idx}.bin': os.urandom(size) for idx in range(args.files)}
+        repo_path = fake_repo(fake, contents)
+        mount_args, fuse_args = shlex.split(args.mount_args), shlex.split(args.fuse_args)
+        try:
+            for threads in [int(count) for count in args.threads.split(',')]:
+                # a fresh mount each time, so every run starts with cold caches
+                path, proc = mount(repo_path, fuse_args, ['--memory-cache', *mount_args])
+                try:
+                    rate, latency = bench_read(list_files(path), threads, args.read_size, args.duration)
+                finally:
+                    unmount(path, proc)
+                print(format_read(threads, rate, latency), flush=True)
+            if torch is not None:
+                path, proc = mount(repo_path, fuse_args, ['--memory-cache', *mount_args])
+                try:
+                    for name in contents:
+                        print(format_load('mount ' + name, bench_load(os.path.join(path, name))), flush=True)
+                finally:
+                    unmount(path, proc)
+                for name, data in contents.items():
+                    url = fake.url + '/objects/' + hashlib.sha256(data).hexdigest()
+                    print(format_load('http ' + name, bench_load(url)), flush=True)
+            print('server', ' '.join(f'{name}={count}' for name, count in sorted(fake.counts.items())), flush=True)
+        finally:
+            fake.stop()
+            shutil.rmtree(repo_path)
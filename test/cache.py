@@ -0,0 +1,468 @@
+# Block cache shared by all open remote files.
+# Blocks are keyed by (oid, index) and evicted least-recently-used first.
+# With a path, each oid is stored as a sparse file at path/OID[0:2]/OID[2:4]/OID
+# with blocks written at index*block_size; resident blocks are rediscovered on
+# startup with SEEK_DATA/SEEK_HOLE and evicted blocks are hole-punched away.
+# A block shorter than block_size is only ever an object's last, so writing one
+# records the object's size in the user.httpfs_lm.size xattr; a short block found
+# at the end of a file without it is a torn write and is not trusted.
+# The index of resident blocks is this process's own, so the directory is locked
+# for its exclusive use; processes share blocks through SharedBlockCache instead.
+# Without a path, blocks are kept in memory.
+# SharedBlockCache keeps the same sparse files in a directory shared by every process
+# on the node, with an index of resident blocks in sqlite.
+
+import collections, contextlib, ctypes, ctypes.util, fcntl, os, sqlite3, threading, time
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+_fallocate = None
+
+def punch_hole(fd, offset, nbytes):
+    # frees the range in a sparse file; false where fallocate cannot
+    global _fallocate
+    if _fallocate is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fallocate = libc.fallocate
+            fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+            _fallocate = fallocate
+        except (OSError, AttributeError, TypeError):
+            _fallocate = False
+    if not _fallocate:
+        return False
+    return _fallocate(fd, FALLOC_FL_KEEP_SIZE | FALLOC_FL_PUNCH_HOLE, offset, nbytes) == 0
+
+class _SparseFiles:
+    # the sparse file of each oid under path, kept open; an fd in use by an unlocked pread
+    # or pwrite is pinned, and closing it while pinned is deferred until it is unpinned
+    # methods other than _oid_path are called with self._lock held
+    def _init_files(self):
+        self._fds = {}
+        self._pins = {} # fd -> number of unlocked preads/pwrites in progress
+        self._doomed = set() # fds closed while pinned, closed when unpinned
+
+    def _oid_path(self, oid):
+        return os.path.join(self.path, oid[:2], oid[2:4], oid)
+
+    def _fd(self, oid):
+        fd = self._fds.get(oid)
+        if fd is None:
+            path = self._oid_path(oid)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._fds[oid] = fd
+        return fd
+
+    def _pin(self, fd):
+        self._pins[fd] = self._pins.get(fd, 0) + 1
+
+    def _unpin(self, fd):
+        pins = self._pins[fd] - 1
+        if pins:
+            self._pins[fd] = pins
+        else:
+            del self._pins[fd]
+            if fd in self._doomed:
+                self._doomed.discard(fd)
+                os.close(fd)
+
+    def _close(self, oid):
+        fd = self._fds.pop(oid, None)
+        if fd in self._pins:
+            self._doomed.add(fd)
+        elif fd is not None:
+            os.close(fd)
+
+    def _close_all(self):
+        for oid in list(self._fds):
+            self._close(oid)
+
+class BlockCache(_SparseFiles):
+    BLOCK_SIZE = 1024*1024
+    BUDGET = 256*1024*1024
+    SIZE_XATTR = 'user.httpfs_lm.size'
+    def __init__(self, path=None, budget=BUDGET, block_size=BLOCK_SIZE):
+        self.path = path
+        self.budget = budget
+        self.block_size = block_size
+        self.used = 0
+        self._lock = threading.Lock()
+        self._blocks = collections.OrderedDict() # (oid, idx) -> nbytes, in lru order
+        self._counts = {} # oid -> number of resident blocks
+        self._data = {} # (oid, idx) -> bytes, when memory-backed
+        self._init_files()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            # held until the process exits or closes the cache
+            self._dir_fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                fcntl.flock(self._dir_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(self._dir_fd)
+                raise RuntimeError(path + ' is in use by another process; share blocks between processes with SharedBlockCache') from None
+            self._scan()
+
+    def _scan(self):
+        found = []
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for oid in filenames:
+                path = os.path.join(dirpath, oid)
+                if path != self._oid_path(oid):
+                    continue
+                found.append([os.stat(path).st_mtime, oid, path])
+        for mtime, oid, path in sorted(found):
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                end = os.fstat(fd).st_size
+                hole = 0
+                while hole < end:
+                    try:
+                        data = os.lseek(fd, hole, os.SEEK_DATA)
+                    except OSError:
+                        break
+                    hole = os.lseek(fd, data, os.SEEK_HOLE)
+                    idx = -(-data // self.block_size)
+                    while idx * self.block_size < hole:
+                        nbytes = min(self.block_size, hole - idx * self.block_size)
+                        if nbytes == self.block_size or hole == end and self._object_size(fd) == end:
+                            self._add(oid, idx, nbytes)
+                        idx += 1
+            finally:
+                os.close(fd)
+            if not self._counts.get(oid):
+                os.unlink(path)
+        with self._lock:
+            self._evict(0)
+
+    def _object_size(self, fd):
+        try:
+            return int(os.getxattr(fd, self.SIZE_XATTR))
+        except (OSError, ValueError):
+            return None
+
+    def _add(self, oid, idx, nbytes):
+        self._blocks[oid, idx] = nbytes
+        self._counts[oid] = self._counts.get(oid, 0) + 1
+        self.used += nbytes
+
+    def _pinned(self, oid):
+        return self._fds.get(oid) in self._pins
+
+    def contains(self, oid, idx):
+        return (oid, idx) in self._blocks
+
+    def get(self, oid, idx, nbytes):
+        with self._lock:
+            cached = self._blocks.get((oid, idx))
+            if cached is None:
+                return None
+            if cached != nbytes:
+                # not the block the caller expects; dropped so that it is fetched again
+                self._remove(oid, idx)
+                return None
+            self._blocks.move_to_end((oid, idx))
+            if self.path is None:
+                return self._data[oid, idx]
+            fd = self._fd(oid)
+            self._pin(fd)
+        try:
+            data = os.pread(fd, nbytes, idx * self.block_size)
+        finally:
+            with self._lock:
+                self._unpin(fd)
+        if len(data) != nbytes:
+            self.discard(oid, idx)
+            return None
+        return data
+
+    def put(self, oid, idx, data):
+        nbytes = len(data)
+        if nbytes > self.budget:
+            return
+        with self._lock:
+            if (oid, idx) in self._blocks:
+                self._blocks.move_to_end((oid, idx))
+                return
+            self._evict(nbytes)
+            if self.path is None:
+                self._data[oid, idx] = bytes(data)
+            else:
+                fd = self._fd(oid)
+                self._pin(fd)
+        if self.path is not None:
+            written = False
+            try:
+                os.pwrite(fd, data, idx * self.block_size)
+                if nbytes < self.block_size:
+                    try:
+                        os.setxattr(fd, self.SIZE_XATTR, str(idx * self.block_size + nbytes).encode())
+                    except OSError:
+                        pass # without xattrs the last block is not kept across restarts
+                written = True
+            finally:
+                with self._lock:
+                    # a file unlinked by discard meanwhile took the block with it; a pinned fd
+                    # is not closed, so its number cannot have been reused for the oid's new file
+                    if written and self._fds.get(oid) == fd and (oid, idx) not in self._blocks:
+                        self._add(oid, idx, nbytes)
+                    self._unpin(fd)
+            return
+        with self._lock:
+            if (oid, idx) not in self._blocks:
+                self._add(oid, idx, nbytes)
+
+    def discard(self, oid, idx=None):
+        with self._lock:
+            if idx is None:
+                keys = [key for key in self._blocks if key[0] == oid]
+            else:
+                keys = [(oid, idx)] if (oid, idx) in self._blocks else []
+            for key in keys:
+                self._remove(*key)
+
+    def _evict(self, nbytes):
+        if self.used + nbytes <= self.budget:
+            return
+        for key in list(self._blocks):
+            if self._pinned(key[0]):
+                continue
+            self._remove(*key)
+            if self.used + nbytes <= self.budget:
+                break
+
+    def _remove(self, oid, idx):
+        nbytes = self._blocks.pop((oid, idx), None)
+        if nbytes is None:
+            return
+        self.used -= nbytes
+        self._counts[oid] -= 1
+        if self.path is None:
+            del self._data[oid, idx]
+        elif not self._counts[oid] or not self._punch(oid, idx * self.block_size, nbytes):
+            for key in [key for key in self._blocks if key[0] == oid]:
+                self.used -= self._blocks.pop(key)
+            del self._counts[oid]
+            self._unlink(oid)
+        if not self._counts.get(oid, 1):
+            del self._counts[oid]
+
+    def _punch(self, oid, offset, nbytes):
+        return punch_hole(self._fd(oid), offset, nbytes)
+
+    def _unlink(self, oid):
+        try:
+            os.unlink(self._oid_path(oid))
+        except FileNotFoundError:
+            pass
+        self._close(oid)
+
+    def close(self):
+        # releases the directory for another process, or another BlockCache
+        with self._lock:
+            self._close_all()
+            if self.path is not None and self._dir_fd is not None:
+                os.close(self._dir_fd)
+                self._dir_fd = None
+
+class SharedBlockCache(_SparseFiles):
+    # Blocks are stored as by BlockCache, at path/OID[0:2]/OID[2:4]/OID, and listed in
+    # path/index.sqlite with the time each was last used. The index holds the block size,
+    # so every process agrees on it, and the bytes stored, so the budget covers them all.
+    # Oids are content hashes, so any process reading the same content reuses the blocks.
+    # A read counts only if the block's row is unchanged after it, so holes are punched only
+    # once the rows' deletion is committed, and a block is not written again until then.
+    # A block evicted mid-read is thus a miss, never zeros. Files are unlinked only where
+    # holes cannot be punched, once no rows refer to them; a writer or reader of a file
+    # unlinked by another process reopens it.
+    PATH = os.path.join(os.path.expanduser('~'), '.cache', 'httpfs_lm', 'blocks')
+    BUDGET = 16*1024*1024*1024
+    TOUCH_INTERVAL = 1 # seconds between writing recency of reads to the index
+    FREEING_TIMEOUT = 60 # seconds after which a block being freed is taken to be by a dead process
+    def __init__(self, path=PATH, budget=BUDGET, block_size=BlockCache.BLOCK_SIZE):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._db = None
+        with self._lock, self._transaction():
+            db = self._index()
+            db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS blocks (id INTEGER PRIMARY KEY AUTOINCREMENT,'
+                ' oid TEXT NOT NULL, idx INTEGER NOT NULL, nbytes INTEGER NOT NULL, used REAL NOT NULL, UNIQUE (oid, idx))'
+            )
+            db.execute('CREATE INDEX IF NOT EXISTS blocks_used ON blocks (used)')
+            db.execute('CREATE TABLE IF NOT EXISTS freeing (oid TEXT NOT NULL, idx INTEGER NOT NULL, since REAL NOT NULL, PRIMARY KEY (oid, idx))')
+            db.execute("INSERT OR IGNORE INTO meta VALUES ('block_size', ?), ('used', 0)", [block_size])
+            self.block_size = db.execute("SELECT value FROM meta WHERE key = 'block_size'").fetchone()[0]
+        with self._lock:
+            # connections must not cross a fork, so the index is reopened on first use
+            self._db.close()
+            self._db = None
+        self._init_files()
+        self._touched = {} # row id -> time last read, not yet in the index
+        self._touches_written = time.monotonic()
+
+    def _index(self):
+        # called with self._lock held
+        if self._db is None:
+            self._db = sqlite3.connect(os.path.join(self.path, 'index.sqlite'), timeout=60, isolation_level=None, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+        return self._db
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # called with self._lock held; IMMEDIATE takes the write lock up front, waiting on other processes
+        self._index().execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._index().execute('ROLLBACK')
+            raise
+        self._index().execute('COMMIT')
+
+    def _row(self, oid, idx):
+        return self._index().execute('SELECT id, nbytes FROM blocks WHERE oid = ? AND idx = ?', [oid, idx]).fetchone()
+
+    def _write_touches(self):
+        if self._touched:
+            with self._transaction():
+                self._index().executemany('UPDATE blocks SET used = ? WHERE id = ?', [[used, row_id] for row_id, used in self._touched.items()])
+            self._touched = {}
+        self._touches_written = time.monotonic()
+
+    def contains(self, oid, idx):
+        with self._lock:
+            return self._row(oid, idx) is not None
+
+    def get(self, oid, idx, nbytes):
+        with self._lock:
+            row = self._row(oid, idx)
+            if row is None:
+                return None
+            if row[1] != nbytes:
+                self._drop(row[0])
+                return None
+            self._touched[row[0]] = time.time()
+            if time.monotonic() - self._touches_written > self.TOUCH_INTERVAL:
+                self._write_touches()
+            fd = self._fd(oid)
+            self._pin(fd)
+        try:
+            data = os.pread(fd, nbytes, idx * self.block_size)
+            unlinked = not os.fstat(fd).st_nlink
+        finally:
+            with self._lock:
+                self._unpin(fd)
+        with self._lock:
+            if unlinked:
+                # another process unlinked the file; the row may be of a new one
+                if self._fds.get(oid) == fd:
+                    self._close(oid)
+                return None
+            if self._row(oid, idx) != row:
+                return None
+            if len(data) != nbytes:
+                # the file was removed or truncated under the index; the block is fetched again
+                self._drop(row[0])
+                return None
+        return data
+
+    def put(self, oid, idx, data):
+        nbytes = len(data)
+        if nbytes > self.budget:
+            return
+        with self._lock:
+            if self._row(oid, idx) is not None:
+                return
+            with self._transaction():
+                if self._row(oid, idx) is not None:
+                    return
+                freeing = self._index().execute('SELECT since FROM freeing WHERE oid = ? AND idx = ?', [oid, idx]).fetchone()
+                if freeing is not None:
+                    if freeing[0] > time.time() - self.FREEING_TIMEOUT:
+                        return
+                    self._index().execute('DELETE FROM freeing WHERE oid = ? AND idx = ?', [oid, idx])
+                fd = self._fd(oid)
+                if os.fstat(fd).st_nlink == 0:
+                    # another process unlinked the file
+                    self._close(oid)
+                    fd = self._fd(oid)
+                os.pwrite(fd, data, idx * self.block_size)
+                self._index().execute('INSERT INTO blocks (oid, idx, nbytes, used) VALUES (?, ?, ?, ?)', [oid, idx, nbytes, time.time()])
+                self._index().execute("UPDATE meta SET value = value + ? WHERE key = 'used'", [nbytes])
+                evicted = self._evict([oid, idx])
+            self._free(evicted)
+            if time.monotonic() - self._touches_written > self.TOUCH_INTERVAL:
+                self._write_touches()
+
+    def discard(self, oid, idx=None):
+        with self._lock:
+            with self._transaction():
+                if idx is None:
+                    rows = self._index().execute('SELECT id, oid, idx, nbytes FROM blocks WHERE oid = ?', [oid]).fetchall()
+                else:
+                    rows = self._index().execute('SELECT id, oid, idx, nbytes FROM blocks WHERE oid = ? AND idx = ?', [oid, idx]).fetchall()
+                self._delete(rows)
+            self._free(rows)
+
+    def _drop(self, row_id):
+        # removes a block whose data is not what its row says
+        with self._transaction():
+            rows = self._index().execute('SELECT id, oid, idx, nbytes FROM blocks WHERE id = ?', [row_id]).fetchall()
+            self._delete(rows)
+        self._free(rows)
+
+    def _evict(self, keep):
+        # called in a transaction; deletes least recently used blocks other than keep until within budget
+        used = self._index().execute("SELECT value FROM meta WHERE key = 'used'").fetchone()[0]
+        if used <= self.budget:
+            return []
+        rows = []
+        # an unfinished cursor would hold its snapshot open past the transaction
+        with contextlib.closing(self._index().execute('SELECT id, oid, idx, nbytes FROM blocks ORDER BY used')) as cursor:
+            for row in cursor:
+                if [row[1], row[2]] == keep:
+                    continue
+                rows.append(row)
+                used -= row[3]
+                if used <= self.budget:
+                    break
+        self._delete(rows)
+        return rows
+
+    def _delete(self, rows):
+        # called in a transaction
+        now = time.time()
+        self._index().executemany('DELETE FROM blocks WHERE id = ?', [[row[0]] for row in rows])
+        self._index().executemany('INSERT OR REPLACE INTO freeing VALUES (?, ?, ?)', [[row[1], row[2], now] for row in rows])
+        self._index().execute("UPDATE meta SET value = value - ? WHERE key = 'used'", [sum(row[3] for row in rows)])
+
+    def _free(self, rows):
+        # called once the deletion of rows is committed
+        if not rows:
+            return
+        unpunched = set()
+        for row_id, oid, idx, nbytes in rows:
+            self._touched.pop(row_id, None)
+            if not punch_hole(self._fd(oid), idx * self.block_size, nbytes):
+                unpunched.add(oid)
+        with self._transaction():
+            self._index().executemany('DELETE FROM freeing WHERE oid = ? AND idx = ?', [[row[1], row[2]] for row in rows])
+            for oid in unpunched:
+                if self._index().execute('SELECT 1 FROM blocks WHERE oid = ? LIMIT 1', [oid]).fetchone() is None:
+                    try:
+                        os.unlink(self._oid_path(oid))
+                    except FileNotFoundError:
+                        pass
+                    self._close(oid)
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._write_touches()
+                self._db.close()
+                self._db = None
+            self._close_all()
@@ -0,0 +1,104 @@
+# Speed and health of the endpoints a remote's files can be fetched from, such as the
+# lfs servers of several remotes. A file offers sources: [endpoint key, href, headers].
+# A request of n bytes to an endpoint is modelled as taking latency + n / throughput,
+# both EWMAs: requests of at most SMALL bytes measure latency, larger ones throughput.
+# Requests go to a random source weighted by 1 / expected time. Sources expected to be
+# over SLOW_FACTOR times slower than the best get none but an occasional probe, and
+# endpoints that fail or refuse are skipped for the server's Retry-After, or else for a
+# backoff doubling with each consecutive failure.
+
+import random, threading, time
+
+from .transport import retry_after
+
+class Endpoint:
+    def __init__(self):
+        self.latency = None # seconds
+        self.throughput = None # bytes per second
+        self.down_until = 0
+        self.failures = 0
+        self.requests = 0
+    def expected(self, nbytes):
+        # seconds a request of nbytes should take, or None before any measurement
+        if self.latency is None and self.throughput is None:
+            return None
+        seconds = self.latency or 0
+        if self.throughput:
+            seconds += nbytes / self.throughput
+        return seconds
+
+class Endpoints:
+    EWMA = 0.3
+    SMALL = 256 * 1024
+    SLOW_FACTOR = 4
+    PROBE = 0.05 # fraction of requests sent to a slow endpoint to measure it again
+    BACKOFF = 1 # seconds an endpoint is skipped after its first failure
+    MAX_BACKOFF = 300
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def _get(self, key):
+        endpoint = self._endpoints.get(key)
+        if endpoint is None:
+            endpoint = Endpoint()
+            self._endpoints[key] = endpoint
+        return endpoint
+
+    def choose(self, sources, nbytes):
+        if len(sources) == 1:
+            return sources[0]
+        now = time.monotonic()
+        with self._lock:
+            endpoints = [self._get(key) for key, href, headers in sources]
+            live = [idx for idx, endpoint in enumerate(endpoints) if endpoint.down_until <= now]
+            if not live:
+                # every endpoint is backing off; try the one that recovers first
+                return sources[min(range(len(sources)), key=lambda idx: endpoints[idx].down_until)]
+            expected = {idx: endpoints[idx].expected(nbytes) for idx in live}
+            unmeasured = [idx for idx in live if expected[idx] is None]
+            if unmeasured:
+                return sources[random.choice(unmeasured)]
+            if random.random() < self.PROBE:
+                return sources[random.choice(live)]
+            best = min(expected.values())
+            candidates = [idx for idx in live if expected[idx] <= best * self.SLOW_FACTOR]
+            weights = [1 / max(expected[idx], 1e-6) for idx in candidates]
+            return sources[random.choices(candidates, weights)[0]]
+
+    def succeeded(self, key, nbytes, seconds):
+        with self._lock:
+            endpoint = self._get(key)
+            endpoint.failures = 0
+            endpoint.requests += 1
+            if nbytes <= self.SMALL or endpoint.latency is None:
+                sample = seconds
+                endpoint.latency = sample if endpoint.latency is None else endpoint.latency + self.EWMA * (sample - endpoint.latency)
+            if nbytes > self.SMALL:
+                sample = nbytes / max(seconds - (endpoint.latency or 0), seconds / 2, 1e-6)
+                endpoint.throughput = sample if endpoint.throughput is None else endpoint.throughput + self.EWMA * (sample - endpoint.throughput)
+
+    def failed(self, key, exc):
+        # works with requests and aiohttp errors, which carry the response or its headers
+        response = getattr(exc, 'response', None)
+        headers = getattr(exc, 'headers', None) or getattr(response, 'headers', None) or {}
+        delay = retry_after(headers)
+        with self._lock:
+            endpoint = self._get(key)
+            endpoint.failures += 1
+            if delay is None:
+                delay = self.BACKOFF * 2 ** (endpoint.failures - 1)
+            endpoint.down_until = time.monotonic() + min(max(delay, 0), self.MAX_BACKOFF)
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                str(key): dict(
+                    latency=endpoint.latency,
+                    throughput=endpoint.throughput,
+                    requests=endpoint.requests,
+                    down_for=max(endpoint.down_until - now, 0),
+                )
+                for key, endpoint in self._endpoints.items()
+            }
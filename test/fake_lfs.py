@@ -0,0 +1,204 @@
+# A local stand-in for a Git-LFS server, for benchmarks and tests.
+# Serves the batch API at /REPO.git/info/lfs/objects/batch and objects at /objects/OID,
+# honouring single byte ranges and sending the oid as ETag. Every response is delayed by latency seconds, object
+# bodies share one link of bandwidth bytes per second, and a fraction of requests are
+# refused with 429 and a Retry-After header. Files given paths are also resolved as the
+# hub resolves them, by a redirect to a signed url of their object on another host name.
+#   python3 -m test.fake_lfs FILE... [--latency 0.05] [--bandwidth 100] [--rate-limit 0.01]
+# serves the given files until interrupted, printing the oid and size of each.
+
+import collections, hashlib, http.server, json, random, re, threading, time, urllib.parse
+
+class FakeLFS:
+    MIME = 'application/vnd.git-lfs+json'
+    CHUNK = 64 * 1024 # bytes written between bandwidth checks
+    def __init__(self, host='127.0.0.1', port=0, latency=0, bandwidth=None, rate_limit=0, retry_after=1, expires_in=3600):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.expires_in = expires_in
+        self.objects = {} # oid -> bytes
+        self.files = {} # path -> oid, resolved as the hub does at /REPO/resolve/REVISION/PATH
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+        self._link_free = 0 # monotonic time the shared link finishes what it has been given
+        self.server = http.server.ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def add(self, data):
+        oid = hashlib.sha256(data).hexdigest()
+        self.objects[oid] = data
+        return oid
+
+    @property
+    def cdn_url(self):
+        # the same server under another host name, as the hub redirects to a cdn
+        host, port = self.server.server_address[:2]
+        return f'http://localhost:{port}'
+
+    @staticmethod
+    def pointer(oid, size):
+        return f'version https://git-lfs.github.com/spec/v1\noid sha256:{oid}\nsize {size}\n'.encode()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fake-lfs', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self.counts[name] += value
+
+    def _throttle(self, nbytes):
+        # blocks until the shared link would have carried nbytes more
+        if not self.bandwidth:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._link_free)
+            self._link_free = start + nbytes / self.bandwidth
+            delay = self._link_free - now
+        time.sleep(delay)
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, as real servers
+    BATCH_PATH = re.compile(r'^/.*\.git/info/lfs/objects/batch$')
+    OBJECT_PATH = re.compile(r'^/objects/([0-9a-f]{64})(?:\?.*)?$')
+    RESOLVE_PATH = re.compile(r'^/.+/resolve/[^/]+/(.+)$')
+    RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+    def log_message(self, format, *args):
+        pass
+
+    def _admit(self):
+        # applies latency and refuses a fraction of requests; returns whether to serve this one
+        fake = self.server.fake
+        fake._count('requests')
+        if fake.latency:
+            time.sleep(fake.latency)
+        if fake.rate_limit and random.random() < fake.rate_limit:
+            fake._count('rate_limited')
+            self._reply(429, b'', {'Retry-After': '%g' % fake.retry_after})
+            return False
+        return True
+
+    def _reply(self, status, body, headers={}):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        fake = self.server.fake
+        view = memoryview(body)
+        for pos in range(0, len(body), fake.CHUNK):
+            chunk = view[pos:pos+fake.CHUNK]
+            fake._throttle(len(chunk))
+            self.wfile.write(chunk)
+        fake._count('bytes_sent', len(body))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self._admit():
+            return
+        if not self.BATCH_PATH.match(self.path):
+            return self._reply(404, b'')
+        fake = self.server.fake
+        fake._count('batch_requests')
+        request = json.loads(body)
+        objects = []
+        for obj in request.get('objects', []):
+            if obj['oid'] in fake.objects:
+                objects.append(dict(obj, authenticated=True, actions=dict(download=dict(
+                    href=fake.url + '/objects/' + obj['oid'],
+                    expires_in=fake.expires_in,
+                ))))
+            else:
+                objects.append(dict(obj, error=dict(code=404, message='Object does not exist')))
+        document = json.dumps(dict(transfer='basic', objects=objects, hash_algo='sha256')).encode()
+        self._reply(200, document, {'Content-Type': fake.MIME})
+
+    def _resolve(self, path):
+        # redirects to a signed url of the file's object, with its size and oid
+        fake = self.server.fake
+        fake._count('resolve_requests')
+        if 'Authorization' in self.headers:
+            fake._count('authorized_resolve_requests')
+        oid = fake.files.get(urllib.parse.unquote(path))
+        if oid is None:
+            return self._reply(404, b'')
+        expires = int(time.time() + fake.expires_in)
+        self._reply(302, b'', {
+            'Location': f'{fake.cdn_url}/objects/{oid}?Expires={expires}&Signature=fake',
+            'X-Linked-Size': str(len(fake.objects[oid])),
+            'X-Linked-Etag': '"' + oid + '"',
+        })
+
+    def do_GET(self):
+        if not self._admit():
+            return
+        match = self.RESOLVE_PATH.match(self.path)
+        if match is not None:
+            return self._resolve(match.group(1))
+        match = self.OBJECT_PATH.match(self.path)
+        data = match and self.server.fake.objects.get(match.group(1))
+        if data is None:
+            return self._reply(404, b'')
+        self.server.fake._count('object_requests')
+        if 'Authorization' in self.headers:
+            self.server.fake._count('authorized_object_requests')
+        size = len(data)
+        # the oid as a strong etag, as the hub's storage sends it
+        headers = {'Accept-Ranges': 'bytes', 'ETag': '"' + match.group(1) + '"'}
+        match = self.RANGE.match(self.headers.get('Range', ''))
+        if match is None:
+            return self._reply(200, data, headers)
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            stop = min(int(last) + 1, size) if last else size
+        else:
+            start = max(size - int(last), 0)
+            stop = size
+        if start >= size or start >= stop:
+            return self._reply(416, b'', {'Content-Range': f'bytes */{size}'})
+        self._reply(206, data[start:stop], {**headers, 'Content-Range': f'bytes {start}-{stop-1}/{size}'})
+
+    do_HEAD = do_GET
+
+if __name__ == '__main__':
+    import argparse, os
+    parser = argparse.ArgumentParser(description='Serve files as a fake Git-LFS server')
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every response')
+    parser.add_argument('--bandwidth', type=float, help='MiB per second shared by all downloads')
+    parser.add_argument('--rate-limit', type=float, default=0, help='fraction of requests refused with 429')
+    parser.add_argument('--retry-after', type=float, default=1, help='seconds sent in Retry-After with each 429')
+    args = parser.parse_args()
+    bandwidth = args.bandwidth and args.bandwidth * 1024 * 1024
+    fake = FakeLFS(args.host, args.port, args.latency, bandwidth, args.rate_limit, args.retry_after)
+    for path in args.files:
+        with open(path, 'rb') as fh:
+            data = fh.read()
+        oid = fake.add(data)
+        print(os.path.basename(path), oid, len(data))
+    print('batch url', fake.url + '/REPO.git/info/lfs/objects/batch', flush=True)
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,103 @@
+# Range requests on an asyncio event loop in a dedicated thread.
+# Callers on any thread submit a range and get a concurrent.futures.Future of its bytes,
+# so hundreds of requests can be in flight without a thread waiting on each. aiohttp
+# pools connections per host; max_inflight bounds the requests started at once.
+# get_range has the signature of Transport.get_range, so either can serve reads.
+# The loop thread starts on first use, as threads do not survive a fork; a forked child
+# starts a loop of its own rather than use the parent's, whose thread it lacks.
+
+import asyncio, importlib.util, os, threading
+
+from .transport import Transport
+
+class FetchEngine:
+    MAX_INFLIGHT = 256
+    CONNECTIONS_PER_HOST = Transport.DOWNLOAD_POOL_SIZE
+    def __init__(self, max_inflight=MAX_INFLIGHT, connections_per_host=CONNECTIONS_PER_HOST):
+        if importlib.util.find_spec('aiohttp') is None:
+            # fails here, rather than on the first read
+            raise ImportError('the fetch engine needs aiohttp', name='aiohttp')
+        self.max_inflight = max_inflight
+        self.connections_per_host = connections_per_host
+        self._reset()
+
+    def _reset(self):
+        # forgets any loop, which in a forked child belongs to the parent; the parent's loop and
+        # session are still held, as finalizing them here would reset connections the parent uses
+        self._parent_loop = [getattr(self, '_loop', None), getattr(self, '_session', None)]
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._session = None
+        self._semaphore = None
+
+    def _ensure_loop(self):
+        if self._pid != os.getpid():
+            self._reset()
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=loop.run_forever, name='fetch-engine', daemon=True)
+                self._thread.start()
+                self._loop = loop
+            return self._loop
+
+    async def _ensure_session(self):
+        # runs on the loop, so needs no lock
+        if self._session is None:
+            import aiohttp
+            connector = aiohttp.TCPConnector(limit=self.max_inflight, limit_per_host=self.connections_per_host)
+            connect, read = Transport.TIMEOUT
+            timeout = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=False)
+            self._semaphore = asyncio.Semaphore(self.max_inflight)
+        return self._session
+
+    def submit(self, url, start, stop, headers={}, retries=None):
+        # future of the bytes [start, stop) of url
+        retries = Transport.RETRIES if retries is None else retries
+        return asyncio.run_coroutine_threadsafe(self._get_range(url, start, stop, headers, retries), self._ensure_loop())
+
+    def get_range(self, url, start, stop, headers={}, retries=None):
+        return self.submit(url, start, stop, headers, retries).result()
+
+    async def _get_range(self, url, start, stop, headers, retries):
+        import aiohttp
+        session = await self._ensure_session()
+        headers = {**headers, 'Range': 'bytes='+str(start)+'-'+str(stop-1)}
+        async with self._semaphore:
+            for attempt in range(retries + 1):
+                try:
+                    async with session.get(url, headers=headers) as resp:
+                        if resp.status in Transport.RETRY_STATUSES and attempt < retries:
+                            delay = Transport.retry_delay(resp.headers, attempt)
+                        else:
+                            resp.raise_for_status()
+                            content = await resp.read()
+                            if resp.status != 206 and len(content) != stop - start:
+                                # server ignored the range
+                                content = content[start:stop]
+                            return content
+                except (asyncio.TimeoutError, aiohttp.ClientConnectionError):
+                    if attempt == retries:
+                        raise
+                    delay = Transport.retry_delay(None, attempt)
+                await asyncio.sleep(delay)
+
+    def close(self):
+        if self._pid != os.getpid():
+            self._reset()
+            return
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        async def shutdown():
+            if self._session is not None:
+                await self._session.close()
+                self._session = None
+        asyncio.run_coroutine_threadsafe(shutdown(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join()
+        loop.close()
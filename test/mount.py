@@ -1,14 +1,50 @@
-import errno, os, sys, threading
+import errno, json, os, sys, threading, time
 import fuse
 from . import repo
+from .cache import BlockCache, SharedBlockCache
+from .fetch_engine import FetchEngine
+from .readahead import ReadAhead
+from .transport import Transport
+
+class StaticHandle:
+    # an open virtual file, fixed at open
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+    def read(self, size, offset):
+        return self.data[offset:offset+size]
+    def close(self):
+        pass
 
 class Interface(fuse.Operations):
     XATTR_PFX = 'user.'
-    def __init__(self, repo, mountpath):
+    STATS_XATTR_PFX = 'user.stats.'
+    HIDDEN_ATTRS = ['fd', 'opens'] # file attributes not published as xattrs
+    # virtual directory holding a json snapshot of the performance counters
+    STATS_DIR = '.httpfs_lm'
+    STATS_FILE = STATS_DIR + '/stats'
+    ATTR_TTL = 10 # seconds to trust attributes and listings of passthrough paths
+    IMMUTABLE_TTL = 3600 # seconds to trust attributes of external files, which are immutable by oid
+    MAX_CACHED_PATHS = 65536 # entries kept per path cache before expired ones are dropped
+    def __init__(self, repo, mountpath, attr_ttl=ATTR_TTL, immutable_ttl=IMMUTABLE_TTL):
         self._repo = repo
         self._lock = threading.Lock()
         self._external_fds = []
         self._external_fd_next = None
+        self._attr_ttl = attr_ttl
+        self._immutable_ttl = immutable_ttl
+        # path -> [monotonic deadline, value]
+        self._attrs = {}
+        self._dirents = {}
+        self._externals = {}
+        # a checkout points paths at other oids, so a new tree stamp clears what was trusted by path
+        self._tree_stamp = None
+
+    def init(self, path):
+        self._repo.start()
+
+    def destroy(self, path):
+        self._repo.stop()
 
     def _external_fd_to_idx(self, fd):
         return fd - 0x10000
@@ -40,6 +76,55 @@ class Interface(fuse.Operations):
         else:
             return self._repo.get_by_path(path, st)
     
+    def _check_tree(self):
+        stamp = self._repo.tree_stamp()
+        if stamp != self._tree_stamp:
+            with self._lock:
+                self._attrs.clear()
+                self._externals.clear()
+                self._tree_stamp = stamp
+
+    def _remember(self, cache, full_path, deadline, value):
+        if len(cache) >= self.MAX_CACHED_PATHS:
+            with self._lock:
+                now = time.monotonic()
+                for key in [key for key, entry in list(cache.items()) if entry[0] <= now]:
+                    cache.pop(key, None)
+                if len(cache) >= self.MAX_CACHED_PATHS:
+                    cache.clear()
+        cache[full_path] = [deadline, value]
+
+    def _external_by_path(self, full_path, st=None):
+        self._check_tree()
+        now = time.monotonic()
+        entry = self._externals.get(full_path)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        external = self._repo.get_by_path(full_path, st)
+        ttl = self._attr_ttl if external is None else self._immutable_ttl
+        self._remember(self._externals, full_path, now + ttl, external)
+        return external
+
+    def _stats_document(self):
+        # the mount's counters, its lfs endpoints, and the counters of each external file that has any
+        files = {}
+        for external in self._repo.files():
+            if external.stats.counters:
+                files[external.path] = external.stats.snapshot()
+        document = dict(mount=self._repo.stats.snapshot(), endpoints=self._repo.endpoints.snapshot(), files=files)
+        return json.dumps(document, indent=1).encode() + b'\n'
+
+    def _virtual_stat(self, full_path):
+        # the virtual paths take their times and owner from the repository root
+        st = os.lstat('.')
+        stat = dict(st_uid=st.st_uid, st_gid=st.st_gid, st_atime=st.st_atime, st_mtime=st.st_mtime, st_ctime=st.st_ctime)
+        if full_path == self.STATS_DIR:
+            stat.update(st_mode=0o40555, st_nlink=2)
+        else:
+            # never cached, so the size matches the snapshot a following open reads
+            stat.update(st_mode=0o100444, st_nlink=1, st_size=len(self._stats_document()))
+        return stat
+
     def _full_path(self, path):
         assert path[0] == '/'
         if len(path) == 1:
@@ -52,28 +137,54 @@ class Interface(fuse.Operations):
         # the cross-platform attributes of fuse.c_stat are:
         # st_dev, st_ino, st_nlink, st_mode, st_uid, st_gid, st_rdev, st_atimespec, st_mtimespec, st_ctimespec, st_size, st_blocks, st_blksize
         full_path = self._full_path(path)
-        try:
-            st = os.lstat(full_path)
-        except FileNotFoundError:
+        if full_path in [self.STATS_DIR, self.STATS_FILE]:
+            return self._virtual_stat(full_path)
+        self._check_tree()
+        now = time.monotonic()
+        entry = self._attrs.get(full_path)
+        if entry is not None and entry[0] > now:
+            stat = entry[1]
+        else:
+            try:
+                st = os.lstat(full_path)
+            except FileNotFoundError:
+                st = None
+            if st is None:
+                stat = None
+                ttl = self._attr_ttl
+            else:
+                stat = dict(
+                    st_mode=st[0], st_ino=st[1], st_dev=st[2], st_nlink=st[3],
+                    st_uid=st[4], st_gid=st[5], st_size=st[6], st_atime=st[7],
+                    st_mtime=st[8], st_ctime=st[9]
+                )
+                external = self._external_by_path(full_path, st)
+                if external is not None:
+                    if stat['st_mode'] & 0o170000 == 0o120000:
+                        # annexed symlinks are presented as the files they point to
+                        stat['st_mode'] = 0o100444
+                    if external.size is not None:
+                        stat['st_size'] = external.size
+                    ttl = self._immutable_ttl
+                else:
+                    ttl = self._attr_ttl
+            self._remember(self._attrs, full_path, now + ttl, stat)
+        if stat is None:
             raise fuse.FuseOSError(errno.ENOENT)
-        stat = dict(
-            st_mode=st[0], st_ino=st[1], st_dev=st[2], st_nlink=st[3],
-            st_uid=st[4], st_gid=st[5], st_size=st[6], st_atime=st[7],
-            st_mtime=st[8], st_ctime=st[9]
-        )
-        external = self._external_get(full_path, st, fi and fi.fh)
-        if external is not None:
-            stat['st_size'] = external.size
         return stat
 
     def listxattr(self, path):
         full_path = self._full_path(path)
-        external = self._repo.get_by_path(full_path)
+        if full_path.split('/')[0] == self.STATS_DIR:
+            return []
+        external = self._external_by_path(full_path)
         if external is not None:
             return [
                 self.XATTR_PFX + name
-                for name, val in external.__dict__.items()
-                if type(val) in [str,int]
+                for name in self._file_xattrs(external)
+            ] + [
+                self.STATS_XATTR_PFX + name
+                for name in external.stats.flat()
             ]
         else:
             return []
@@ -81,20 +192,51 @@ class Interface(fuse.Operations):
     def getxattr(self, path, name):
         if name[:len(self.XATTR_PFX)] == self.XATTR_PFX:
             full_path = self._full_path(path)
-            external = self._repo.get_by_path(full_path)
-            if external is not None:
-                try:
-                    return str(getattr(external, name[len(self.XATTR_PFX):])).encode()
-                except AttributeError:
-                    pass
+            external = None
+            if full_path.split('/')[0] != self.STATS_DIR:
+                external = self._external_by_path(full_path)
+            if external is not None and name.startswith(self.STATS_XATTR_PFX):
+                values = external.stats.flat()
+                stat_name = name[len(self.STATS_XATTR_PFX):]
+                if stat_name in values:
+                    return str(values[stat_name]).encode()
+            elif external is not None:
+                values = self._file_xattrs(external)
+                attr_name = name[len(self.XATTR_PFX):]
+                if attr_name in values:
+                    return str(values[attr_name]).encode()
         raise fuse.FuseOSError(fuse.errno.ENODATA)
 
+    def _file_xattrs(self, external):
+        # a file's public str and int attributes, less the bookkeeping of its open handles
+        return {
+            name: val
+            for name, val in list(external.__dict__.items())
+            if type(val) in [str,int] and not name.startswith('_') and name not in self.HIDDEN_ATTRS
+        }
+
+    def setxattr(self, path, name, value, options, position=0):
+        # writing a true value to user.hydrate downloads the file into the repository in the background
+        if name == self.XATTR_PFX + 'hydrate':
+            external = self._external_by_path(self._full_path(path))
+            if external is not None and getattr(external, 'hydration', 'unavailable') != 'unavailable':
+                if value.strip() not in [b'', b'0', b'false', b'no']:
+                    external.hydrate()
+                return 0
+        raise fuse.FuseOSError(errno.ENOTSUP)
+
     def open(self, path, fi):
         full_path = self._full_path(path)
-        external = self._repo.get_by_path(full_path)
+        if full_path == self.STATS_FILE:
+            fi.fh = self._external_fd_alloc(StaticHandle(self._stats_document()))
+            # the snapshot changes between opens, so reads bypass the page cache
+            fi.direct_io = 1
+            return 0
+        external = self._external_by_path(full_path)
         if external is not None:
-            fi.fh = self._external_fd_alloc(external)
-            external.open()
+            fi.fh = self._external_fd_alloc(external.open())
+            # content is immutable by oid, so the page cache may outlive this open
+            fi.keep_cache = 1
         else:
             fi.fh = os.open(full_path, fi.flags)
         return 0
@@ -103,15 +245,33 @@ class Interface(fuse.Operations):
         fh = fi.fh
         external = self._external_get(path, None, fh)
         if external is None:
-            with self._lock:  # Ensure thread-safe reads
-                os.lseek(fh, offset, os.SEEK_SET)
-                return os.read(fh, size)
+            return os.pread(fh, size, offset)
         else:
             return external.read(size, offset)
 
+    def release(self, path, fi):
+        fh = fi.fh
+        external = self._external_get(path, None, fh)
+        if external is None:
+            os.close(fh)
+        else:
+            external.close()
+            self._external_fd_free(fh)
+        return 0
+
     def readdir(self, path, fi):
         full_path = self._full_path(path)
-        dirents = ['.', '..'] + os.listdir(full_path)
+        now = time.monotonic()
+        entry = self._dirents.get(full_path)
+        if full_path == self.STATS_DIR:
+            dirents = ['.', '..', 'stats']
+        elif entry is not None and entry[0] > now:
+            dirents = entry[1]
+        else:
+            dirents = ['.', '..'] + os.listdir(full_path)
+            if full_path == '.':
+                dirents.append(self.STATS_DIR)
+            self._remember(self._dirents, full_path, now + self._attr_ttl, dirents)
         for r in dirents:
             yield r
 
@@ -174,6 +334,13 @@ class FUSEWithRawArgs(fuse.FUSE):
         if err:
             raise RuntimeError(err)
 
+def parse_size(text):
+    units = 'KMGT'
+    text = text.strip().upper().removesuffix('B').removesuffix('I')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * 1024 ** (units.index(text[-1]) + 1))
+    return int(text)
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description="Mount repository")
@@ -186,6 +353,18 @@ if __name__ == "__main__":
 
     # Mount command
     mount_parser = subparsers.add_parser("mount", help="Mount a repository", add_help=False)
+    mount_parser.add_argument('--cache-dir', help='store cached blocks as sparse files here, for this mount alone; by default .git/' + repo.Repo.CACHE_DIR)
+    mount_parser.add_argument('--memory-cache', action='store_true', help='keep cached blocks in memory only')
+    mount_parser.add_argument('--shared-cache', nargs='?', const=SharedBlockCache.PATH, metavar='DIR', help='share cached blocks by content with every mount and loader on this machine using DIR, by default ' + SharedBlockCache.PATH)
+    mount_parser.add_argument('--cache-size', type=parse_size, help='cache budget in bytes, accepts K/M/G/T suffixes; by default {} or {} shared'.format(BlockCache.BUDGET, SharedBlockCache.BUDGET))
+    mount_parser.add_argument('--readahead', type=int, default=ReadAhead.MAX_DEPTH, help='most range requests kept in flight ahead of each sequential reader, 0 to disable')
+    mount_parser.add_argument('--connections', type=int, default=Transport.DOWNLOAD_POOL_SIZE, help='keep-alive download connections per host, also the number of fetch threads')
+    mount_parser.add_argument('--attr-timeout', type=float, default=Interface.ATTR_TTL, help='seconds the kernel and the daemon trust attributes and listings of passthrough paths')
+    mount_parser.add_argument('--immutable-timeout', type=float, default=Interface.IMMUTABLE_TTL, help='seconds the daemon trusts attributes of lfs files')
+    mount_parser.add_argument('--hydrate', action='store_true', help='download opened lfs files into .git/lfs/objects in the background; per file, setfattr -n user.hydrate -v 1')
+    mount_parser.add_argument('--async-fetch', action='store_true', help='make range requests on an asyncio event loop with aiohttp rather than a thread per request')
+    mount_parser.add_argument('--max-inflight', type=int, default=FetchEngine.MAX_INFLIGHT, help='most range requests in flight with --async-fetch')
+    mount_parser.add_argument('--lfs-api', action='store_true', help='use the lfs batch api for huggingface clones too, rather than resolve urls')
     mount_parser.add_argument('repo_path', nargs='?')
     mount_parser.add_argument('mountpoint', nargs='?')
     mount_parser.add_argument('fuse_args', nargs=argparse.REMAINDER)
@@ -211,7 +390,20 @@ if __name__ == "__main__":
                 sys.exit(*err.args)
         else:
             mountpoint = os.path.abspath(args.mountpoint)
+            cache_dir = args.cache_dir and os.path.abspath(args.cache_dir)
+            shared_cache = args.shared_cache and os.path.abspath(os.path.expanduser(args.shared_cache))
             os.chdir(args.repo_path)
-            repository = repo.Repo('.')
-            backend = Interface(repository, mountpoint)
-            FUSEWithRawArgs(backend, parser.prog, mountpoint, raw_fi=True, *args.fuse_args)
+            if shared_cache:
+                cache = SharedBlockCache(shared_cache, args.cache_size or SharedBlockCache.BUDGET)
+            elif cache_dir or args.memory_cache:
+                cache = BlockCache(cache_dir, args.cache_size or BlockCache.BUDGET)
+            else:
+                cache = None # the repository's own
+            engine = FetchEngine(args.max_inflight, args.connections) if args.async_fetch else None
+            repository = repo.Repo('.', cache=cache, cache_budget=args.cache_size or BlockCache.BUDGET, readahead=args.readahead, workers=args.connections, hydrate=args.hydrate, lfs_api=args.lfs_api, engine=engine)
+            backend = Interface(repository, mountpoint, args.attr_timeout, args.immutable_timeout)
+            # the high-level fuse api has only mount-wide kernel timeouts; fuse_args can override them
+            timeouts = 'attr_timeout={0},entry_timeout={0},negative_timeout={0}'.format(args.attr_timeout)
+            # always in the foreground: daemonizing changes directory to /, and paths
+            # within the repository are relative to it, to reach it under the mount
+            FUSEWithRawArgs(backend, parser.prog, mountpoint, '-f', '-o', timeouts, raw_fi=True, *args.fuse_args)
@@ -0,0 +1,138 @@
+# Sequential read-ahead for one open handle of a remote file.
+# Once reads are seen to follow each other, up to `depth` range requests of
+# `chunk_blocks` cache blocks each are kept in flight ahead of the reader.
+# `depth` hill-climbs on the throughput measured over each window of completed
+# chunks: it keeps moving while throughput improves and turns back when it drops.
+# Chunks are started with file.prefetch and accounted for in its future's callback,
+# which may run on another thread, or on this one when it is already done.
+# The blocks prefetched ahead of every handle's reader, together, are kept within
+# a share of the cache's budget, so that read-ahead does not evict itself before
+# it is read; a handle with nothing ahead may always start one chunk.
+
+import threading, time, weakref
+
+class ReadAhead:
+    CHUNK_BLOCKS = 8
+    MAX_DEPTH = 16
+    BUDGET_SHARE = 0.5
+    _reserved = weakref.WeakKeyDictionary() # cache -> bytes prefetched ahead of readers
+    _reserved_lock = threading.Lock()
+    def __init__(self, file, max_depth=MAX_DEPTH, chunk_blocks=CHUNK_BLOCKS):
+        self.file = file
+        self.max_depth = max_depth
+        self.chunk_blocks = chunk_blocks
+        self.depth = min(2, max_depth)
+        self._lock = threading.RLock() # completion callbacks can run within _fill
+        self._next_offset = None
+        self._streak = 0
+        self._ahead = 0 # next block index to prefetch
+        self._reader = 0 # block index after the last read
+        self._held = 0 # bytes this handle has in _reserved
+        self._inflight = {} # first block index -> [end block index, future]
+        self._direction = 1
+        self._epoch_start = None
+        self._epoch_bytes = 0
+        self._epoch_chunks = 0
+        self._last_rate = None
+
+    def advise(self, size, offset):
+        # called before each read; waits for any in-flight chunk covering it
+        if not self.max_depth:
+            return
+        block_size = self.file.remote.cache.block_size
+        first = offset // block_size
+        last = (offset + size - 1) // block_size
+        with self._lock:
+            if offset == self._next_offset:
+                self._streak += 1
+            else:
+                self._streak = 0
+                self._ahead = 0
+            self._next_offset = offset + size
+            self._reader = last + 1
+            for start, [end, fut] in list(self._inflight.items()):
+                if fut.done() and end <= first:
+                    del self._inflight[start]
+            if self._streak >= 1:
+                self._ahead = max(self._ahead, last + 1)
+                self._fill()
+            self._reserve()
+            waits = [
+                fut
+                for start, [end, fut] in self._inflight.items()
+                if start <= last and end > first
+            ]
+        for fut in waits:
+            try:
+                fut.result()
+            except Exception:
+                pass # the read itself will retry and raise
+
+    def _reserve(self):
+        # brings this handle's entry in _reserved up to date, returning the total over all handles
+        cache = self.file.remote.cache
+        held = max(0, self._ahead - self._reader) * cache.block_size
+        with self._reserved_lock:
+            total = self._reserved.get(cache, 0) + held - self._held
+            self._reserved[cache] = total
+        self._held = held
+        return total
+
+    def _fill(self):
+        cache = self.file.remote.cache
+        nblocks = -(-self.file.size // cache.block_size)
+        limit = getattr(cache, 'budget', None)
+        if limit is not None:
+            limit *= self.BUDGET_SHARE
+        while len(self._inflight) < self.depth and self._ahead < nblocks:
+            start = self._ahead
+            end = min(start + self.chunk_blocks, nblocks)
+            total = self._reserve()
+            if limit is not None and self._held and total + (end - start) * cache.block_size > limit:
+                return
+            if self._epoch_start is None:
+                self._epoch_start = time.monotonic()
+            try:
+                fut = self.file.prefetch(start, end)
+            except Exception:
+                return # the read itself will retry and raise
+            self._inflight[start] = [end, fut]
+            self._ahead = end
+            self._reserve()
+            fut.add_done_callback(lambda fut, start=start, end=end: self._prefetched(fut, start, end))
+
+    def _prefetched(self, fut, first, end):
+        if fut.cancelled() or fut.exception() is not None:
+            return
+        block_size = self.file.remote.cache.block_size
+        with self._lock:
+            self._epoch_bytes += min(end * block_size, self.file.size) - first * block_size
+            self._epoch_chunks += 1
+            if self._epoch_chunks >= self.depth:
+                self._adapt()
+            if self._streak >= 1:
+                self._fill()
+
+    def _adapt(self):
+        now = time.monotonic()
+        rate = self._epoch_bytes / max(now - self._epoch_start, 1e-6)
+        if self._last_rate is not None:
+            if rate < self._last_rate * 0.9:
+                self._direction = -self._direction
+            elif rate < self._last_rate * 1.1:
+                self._direction = 0 if self._direction else 1
+        self.depth = max(1, min(self.max_depth, self.depth + self._direction))
+        self._last_rate = rate
+        self._epoch_start = now
+        self._epoch_bytes = 0
+        self._epoch_chunks = 0
+
+    def cancel(self):
+        with self._lock:
+            self.max_depth = 0
+            self._streak = 0
+            for end, fut in self._inflight.values():
+                fut.cancel()
+            self._inflight.clear()
+            self._ahead = self._reader
+            self._reserve()
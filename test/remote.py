@@ -0,0 +1,400 @@
+# Shared machinery for backends whose files are served by http range requests.
+# Reads are split into cache blocks; missing runs of blocks are fetched with one
+# request each, and blocks already being fetched by another reader are waited on.
+# Blocks are hashed in order as they pass through, so a file read from start to end
+# is verified against its digest without reading it again.
+# Files can also be hydrated: streamed in the background to a local path, past the
+# block cache, after which open handles switch to reading the local copy.
+# Range requests go through the transport, or through a fetch engine when given one;
+# with an engine, read-ahead is started without a thread waiting on each request.
+# Files with several sources spread requests over them by their measured speed,
+# moving a failed request on to the next source.
+
+import concurrent.futures, hashlib, os, tempfile, threading, time
+
+from .cache import BlockCache
+from .endpoints import Endpoints
+from .readahead import ReadAhead
+from .stats import Stats
+from .transport import Transport
+
+class Remote:
+    def __init__(self, transport=None, cache=None, readahead=ReadAhead.MAX_DEPTH, workers=Transport.DOWNLOAD_POOL_SIZE, executor=None, stats=None, engine=None):
+        self.stats = Stats() if stats is None else stats
+        self.transport = Transport(download_pool_size=workers) if transport is None else transport
+        self.engine = engine
+        self.endpoints = Endpoints()
+        self.cache = BlockCache() if cache is None else cache
+        self.readahead = readahead
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='remote-fetch')
+        self.executor = executor
+        # caches blocks fetched by the engine; never the executor, whose tasks may wait on those blocks
+        self.store_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='remote-store')
+        self._inflight = {} # (cache key, block index) -> future of block bytes
+        self._inflight_lock = threading.Lock()
+
+    def _claim(self, key, idcs):
+        # splits block indices into those the caller must fetch and futures for those already being fetched
+        # blocks that became cached meanwhile are in neither
+        owned = []
+        waiting = {}
+        with self._inflight_lock:
+            for idx in idcs:
+                fut = self._inflight.get((key, idx))
+                if fut is not None:
+                    waiting[idx] = fut
+                elif not self.cache.contains(key, idx):
+                    self._inflight[key, idx] = concurrent.futures.Future()
+                    owned.append(idx)
+        return owned, waiting
+    def _settle(self, key, idcs, blocks=None, exception=None):
+        with self._inflight_lock:
+            futs = [self._inflight.pop((key, idx)) for idx in idcs]
+        for idx, fut in enumerate(futs):
+            if exception is None:
+                fut.set_result(blocks[idx])
+            else:
+                fut.set_exception(exception)
+
+def _gather(futs):
+    # a future completing when all of futs have, with the first exception if any
+    result = concurrent.futures.Future()
+    remaining = [len(futs)]
+    lock = threading.Lock()
+    def done(fut):
+        with lock:
+            remaining[0] -= 1
+            last = not remaining[0]
+        if fut.cancelled() or fut.exception() is not None or last:
+            try:
+                if fut.cancelled() or fut.exception() is None:
+                    result.set_result(None)
+                else:
+                    result.set_exception(fut.exception())
+            except concurrent.futures.InvalidStateError:
+                pass # already settled or cancelled by the waiter
+    if not futs:
+        result.set_result(None)
+    for fut in futs:
+        fut.add_done_callback(done)
+    return result
+
+class RemoteFile:
+    # subclasses set remote, size, cache_key, lock, and either fd or href and headers,
+    # call _init_verification and _init_hydration, and implement _ensure_remote to set href
+    fd = None
+    opens = 0
+    HYDRATE_RANGE = 64*1024*1024 # bytes requested at once when hydrating
+    STREAM_CHUNK = 1024*1024
+    def _init_hydration(self, path=None, tmp_dir=None):
+        # hydration is exposed as an xattr: none, running, done, failed or unavailable
+        self.hydrate_path = path
+        self.hydrate_tmp_dir = tmp_dir
+        self.hydration = 'unavailable' if path is None else 'none'
+    def hydrate(self):
+        with self.lock:
+            if self.hydration not in ['none', 'failed']:
+                return
+            self.hydration = 'running'
+        threading.Thread(target=self._run_hydration, name='hydrate', daemon=True).start()
+    def _run_hydration(self):
+        # streams the object in ranges straight into a temporary file, hashing it on the way;
+        # the block cache and the fetch executor are left to readers
+        tmp_path = None
+        try:
+            if not os.path.exists(self.hydrate_path):
+                with self.lock:
+                    self._ensure_remote()
+                os.makedirs(self.hydrate_tmp_dir, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=self.hydrate_tmp_dir, prefix=self.cache_key + '.')
+                try:
+                    hasher = None if self.expected_digest is None else hashlib.new(self.hash_name)
+                    for start in range(0, self.size, self.HYDRATE_RANGE):
+                        hasher = self._hydrate_range(fd, hasher, start, min(start + self.HYDRATE_RANGE, self.size))
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                if hasher is not None:
+                    if hasher.hexdigest() != self.expected_digest:
+                        self.verification = 'corrupt'
+                        raise ValueError('digest mismatch hydrating ' + self.cache_key)
+                    with self._hash_lock:
+                        # the whole object has been hashed, so reads need not hash it again
+                        self.verification = 'verified'
+                        self.hashed = self.size
+                os.makedirs(os.path.dirname(self.hydrate_path), exist_ok=True)
+                os.rename(tmp_path, self.hydrate_path)
+                tmp_path = None
+            with self.lock:
+                if self.opens and self.fd is None:
+                    # open handles check fd on every read, so they switch over here
+                    self.fd = os.open(self.hydrate_path, os.O_RDONLY)
+            self.hydration = 'done'
+        except Exception:
+            self.hydration = 'failed'
+        finally:
+            if tmp_path is not None:
+                os.unlink(tmp_path)
+    def _hydrate_range(self, fd, hasher, start, stop):
+        # writes bytes [start, stop) of the object to fd, moving a failed request on to the next source
+        # returns the hasher updated with them, which is a copy when a source failed partway
+        endpoints = self.remote.endpoints
+        sources = self._sources()
+        while True:
+            source = endpoints.choose(sources, stop - start)
+            key, href, headers = source
+            updated = None if hasher is None else hasher.copy()
+            began = time.monotonic()
+            try:
+                self._stream_range(fd, updated, href, headers, start, stop, retries=0 if len(sources) > 1 else None)
+            except Exception as exc:
+                endpoints.failed(key, exc)
+                sources = [other for other in sources if other is not source]
+                if not sources:
+                    raise
+                self.stats.add('failovers')
+                continue
+            endpoints.succeeded(key, stop - start, time.monotonic() - began)
+            return updated
+    def _stream_range(self, fd, hasher, href, headers, start, stop, retries=None):
+        resp = self.remote.transport.request('download', 'GET', href, retries=retries, stream=True,
+            headers={**headers, 'Range': 'bytes='+str(start)+'-'+str(stop-1)})
+        with resp:
+            resp.raise_for_status()
+            self.stats.add('requests')
+            skip = 0 if resp.status_code == 206 else start # the server ignored the range
+            offset = start
+            for chunk in resp.iter_content(self.STREAM_CHUNK):
+                if skip:
+                    chunk, skip = chunk[skip:], max(0, skip - len(chunk))
+                chunk = chunk[:stop - offset]
+                if chunk:
+                    os.pwrite(fd, chunk, offset)
+                    if hasher is not None:
+                        hasher.update(chunk)
+                    offset += len(chunk)
+                    self.stats.add('bytes_fetched', len(chunk))
+                if offset == stop:
+                    break
+        if offset != stop:
+            raise OSError('response ended at byte {} of {} hydrating {}'.format(offset, stop, self.cache_key))
+    def _init_verification(self, hash_name=None, digest=None):
+        # verification is exposed as an xattr: pending, verified, corrupt or unavailable
+        self.hash_name = hash_name
+        self.expected_digest = digest
+        self.verification = 'unavailable' if digest is None else 'pending'
+        self.hashed = 0
+        self._hasher = None
+        self._hashed_blocks = 0
+        self._hash_lock = threading.Lock()
+    def _hash_blocks(self, first, blocks):
+        # continues the running hash if blocks include the next unhashed block, then through
+        # the cached blocks after them, which arrived ahead of the hash and may not be read again
+        # when the whole file is hashed and the digest is wrong, its cached blocks are discarded to be fetched again
+        if self.expected_digest is None or self.verification == 'verified':
+            return
+        with self._hash_lock:
+            idx = self._hashed_blocks
+            if idx < first or idx >= first + len(blocks):
+                return
+            if self._hasher is None:
+                self._hasher = hashlib.new(self.hash_name)
+            for block in blocks[idx - first:]:
+                self._hasher.update(block)
+            idx = first + len(blocks)
+            nblocks = -(-self.size // self.remote.cache.block_size)
+            while idx < nblocks:
+                block = self.remote.cache.get(self.cache_key, idx, self._block_len(idx))
+                if block is None:
+                    break
+                self._hasher.update(block)
+                idx += 1
+            self._hashed_blocks = idx
+            self.hashed = min(self._hashed_blocks * self.remote.cache.block_size, self.size)
+            if self.hashed < self.size:
+                return
+            if self._hasher.hexdigest() == self.expected_digest:
+                self.verification = 'verified'
+            else:
+                self.verification = 'corrupt'
+                self.remote.cache.discard(self.cache_key)
+                self._hasher = None
+                self._hashed_blocks = 0
+                self.hashed = 0
+    def _ensure_remote(self):
+        raise NotImplementedError
+    def _sources(self):
+        # [endpoint key, href, headers] for each place ranges can be fetched from
+        return [[None, self.href, self.headers]]
+    def close(self):
+        with self.lock:
+            self.opens -= 1
+            if not self.opens and self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+    def read(self, size, offset):
+        fd = self.fd
+        if fd is not None:
+            data = os.pread(fd, size, offset)
+            self.stats.add('bytes_served', len(data))
+            return data
+        size = min(size, self.size - offset)
+        if size <= 0:
+            return b''
+        block_size = self.remote.cache.block_size
+        first = offset // block_size
+        blocks = self._blocks(first, (offset + size - 1) // block_size + 1)
+        start = offset - first * block_size
+        if len(blocks) == 1:
+            data = blocks[0][start:start+size]
+        else:
+            data = b''.join(blocks)[start:start+size]
+        self.stats.add('bytes_served', len(data))
+        return data
+    def _block_len(self, idx):
+        block_size = self.remote.cache.block_size
+        return min(block_size, self.size - idx * block_size)
+    def _blocks(self, first, end):
+        # returns the blocks in [first, end), fetching missing runs in single requests
+        # blocks another reader is already fetching are waited on rather than requested again
+        cache = self.remote.cache
+        blocks = [None] * (end - first)
+        pending = range(first, end)
+        lookups = 0
+        while pending:
+            for idx in pending:
+                blocks[idx - first] = cache.get(self.cache_key, idx, self._block_len(idx))
+            pending = [idx for idx in pending if blocks[idx - first] is None]
+            if not lookups:
+                lookups = end - first
+                self.stats.add('cache_hits', lookups - len(pending))
+                self.stats.add('cache_misses', len(pending))
+            owned, waiting = self.remote._claim(self.cache_key, pending)
+            while owned:
+                run_end = 1
+                while run_end < len(owned) and owned[run_end] == owned[0] + run_end:
+                    run_end += 1
+                run, owned = owned[:run_end], owned[run_end:]
+                try:
+                    fetched = self._fetch(run[0], run[-1] + 1)
+                except Exception as exc:
+                    self.remote._settle(self.cache_key, run + owned, exception=exc)
+                    raise
+                self.remote._settle(self.cache_key, run, fetched)
+                blocks[run[0] - first : run[-1] + 1 - first] = fetched
+            for idx, fut in waiting.items():
+                blocks[idx - first] = fut.result()
+            pending = [idx for idx in pending if blocks[idx - first] is None]
+        self._hash_blocks(first, blocks)
+        return blocks
+    def _fetch(self, first, end):
+        cache = self.remote.cache
+        block_size = cache.block_size
+        start = first * block_size
+        stop = min(end * block_size, self.size)
+        fetcher = self.remote.transport if self.remote.engine is None else self.remote.engine
+        endpoints = self.remote.endpoints
+        sources = self._sources()
+        while True:
+            source = endpoints.choose(sources, stop - start)
+            key, href, headers = source
+            began = time.monotonic()
+            try:
+                with self.stats.timed('range_latency', 'inflight_requests'):
+                    # with other sources to try, a refusal moves on rather than waiting
+                    content = fetcher.get_range(href, start, stop, headers, retries=0 if len(sources) > 1 else None)
+            except Exception as exc:
+                endpoints.failed(key, exc)
+                sources = [other for other in sources if other is not source]
+                if not sources:
+                    raise
+                self.stats.add('failovers')
+                continue
+            endpoints.succeeded(key, stop - start, time.monotonic() - began)
+            return self._store(first, end, content)
+    def _store(self, first, end, content):
+        # caches the fetched bytes of blocks [first, end) and returns them as blocks
+        cache = self.remote.cache
+        block_size = cache.block_size
+        self.stats.add('requests')
+        self.stats.add('bytes_fetched', len(content))
+        assert len(content) == min(end * block_size, self.size) - first * block_size
+        blocks = []
+        for idx in range(first, end):
+            block = content[(idx-first)*block_size : (idx-first+1)*block_size]
+            cache.put(self.cache_key, idx, block)
+            blocks.append(block)
+        return blocks
+    def prefetch(self, first, end):
+        # future completing once blocks [first, end) are cached, or have failed
+        # without an engine an executor thread fetches them; with one, the requests are
+        # started here and their completions cache the blocks
+        engine = self.remote.engine
+        if engine is None:
+            return self.remote.executor.submit(self._blocks, first, end)
+        owned, waiting = self.remote._claim(self.cache_key, range(first, end))
+        futs = list(waiting.values())
+        try:
+            while owned:
+                run_end = 1
+                while run_end < len(owned) and owned[run_end] == owned[0] + run_end:
+                    run_end += 1
+                futs.append(self._fetch_async(engine, owned[0], owned[run_end - 1] + 1))
+                owned = owned[run_end:]
+        except Exception as exc:
+            # blocks claimed here and not yet requested would otherwise be waited on forever
+            self.remote._settle(self.cache_key, owned, exception=exc)
+            raise
+        return _gather(futs)
+    def _fetch_async(self, engine, first, end):
+        # the caller settles blocks [first, end) if this raises
+        block_size = self.remote.cache.block_size
+        idcs = list(range(first, end))
+        start, stop = first * block_size, min(end * block_size, self.size)
+        key, href, headers = self.remote.endpoints.choose(self._sources(), stop - start)
+        self.stats.add('inflight_requests')
+        started = time.monotonic()
+        try:
+            fut = engine.submit(href, start, stop, headers)
+        except Exception:
+            self.stats.add('inflight_requests', -1)
+            raise
+        stored = concurrent.futures.Future()
+        def store(fut):
+            seconds = time.monotonic() - started
+            self.stats.record('range_latency', seconds)
+            self.stats.add('inflight_requests', -1)
+            try:
+                blocks = self._store(first, end, fut.result())
+            except Exception as exc:
+                # the demand read that follows a failed prefetch tries the other sources
+                self.remote.endpoints.failed(key, exc)
+                self.remote._settle(self.cache_key, idcs, exception=exc)
+                stored.set_exception(exc)
+            else:
+                self.remote.endpoints.succeeded(key, stop - start, seconds)
+                self.remote._settle(self.cache_key, idcs, blocks)
+                stored.set_result(None)
+        def stored_later(fut):
+            # caching happens on the store thread rather than blocking the engine's loop
+            try:
+                self.remote.store_executor.submit(store, fut)
+            except RuntimeError:
+                store(fut) # shut down
+        fut.add_done_callback(stored_later)
+        return stored
+
+class RemoteHandle:
+    def __init__(self, file):
+        self.file = file
+        self.size = file.size
+        self.readahead = ReadAhead(file, file.remote.readahead)
+    def read(self, size, offset):
+        # no locks are taken here: positional reads and per-handle read-ahead state
+        if self.file.fd is None:
+            self.readahead.advise(size, offset)
+        return self.file.read(size, offset)
+    def close(self):
+        self.readahead.cancel()
+        self.file.close()
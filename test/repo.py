@@ -1,18 +1,45 @@
 import os
 
+from .cache import BlockCache
 from .repo_lfs import LFS
 from .repo_annex import Annex
+from .repo_hf import HuggingFace
 
 class Repo:
-    def __init__(self, root):
+    CACHE_DIR = os.path.join('lfs', 'httpfs_lm', 'blocks') # within the git directory
+    def __init__(self, root, lfs_api=False, cache_budget=BlockCache.BUDGET, **lfs_options):
         import dulwich.repo
         self.dulwich = dulwich.repo.Repo(root)
         self.rootdir = os.path.normpath(self.dulwich.path)
         self.gitdir = os.path.normpath(self.dulwich.controldir())
-        self.backends = [
-            Backend(self.dulwich, self.rootdir, self.gitdir)
-            for Backend in [LFS, Annex]
-        ]
+        if lfs_options.get('cache') is None:
+            # blocks persist across mounts, beside the lfs objects they stand in for
+            lfs_options['cache'] = BlockCache(os.path.join(self.gitdir, self.CACHE_DIR), cache_budget)
+        # clones of the hub are served from its resolve urls, others from the lfs batch api
+        lfs_class = HuggingFace if not lfs_api and HuggingFace.handles(self.dulwich) else LFS
+        lfs = lfs_class(self.dulwich, self.rootdir, self.gitdir, **lfs_options)
+        annex = Annex(self.dulwich, self.rootdir, self.gitdir, transport=lfs.transport, cache=lfs.cache, readahead=lfs.readahead, executor=lfs.executor, stats=lfs.stats, engine=lfs.engine)
+        self.backends = [lfs, annex]
+        self.stats = lfs.stats
+        self.engine = lfs.engine
+        self.endpoints = lfs.endpoints
+    def start(self):
+        for backend in self.backends:
+            if hasattr(backend, 'start'):
+                backend.start()
+    def stop(self):
+        for backend in self.backends:
+            if hasattr(backend, 'stop'):
+                backend.stop()
+        if self.engine is not None:
+            self.engine.close()
+    def files(self):
+        # every external file looked up so far
+        for backend in self.backends:
+            yield from list(backend._files.values())
+    def tree_stamp(self):
+        # lfs and annex pointers both come from the checked-out tree
+        return self.backends[0].tree_stamp()
     def get_by_path(self, path, st=None, fd=None):
         if path.startswith(self.gitdir):
             return None
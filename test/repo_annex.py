@@ -1,11 +1,35 @@
-import os
+# https://git-annex.branchable.com/internals/
+# https://git-annex.branchable.com/internals/key_format/
+# https://git-annex.branchable.com/internals/hashing/
 
-class Annex:
+# WORKTREE
+# annexed files are symlinks into .git/annex/objects/.../KEY/KEY, dangling when not present
+# KEY is BACKEND[-sSIZE][-mMTIME][-Sn-Cn]--NAME, e.g. SHA256E-s12345--4d7a21....bin
+
+# GIT-ANNEX BRANCH
+# HASHDIR/KEY.log.web lists urls: "TIMESTAMP 1 URL", later lines override earlier, 0 removes
+# HASHDIR/KEY.log lists remotes holding the key: "TIMESTAMP 1 UUID"
+# remote.log configures special remotes: "UUID key=value ... timestamp=TIMESTAMP"
+# HASHDIR is hashdirlower: the first 3 and next 3 hex digits of md5(KEY)
+
+import hashlib, os, threading
+
+from .readahead import ReadAhead
+from .remote import Remote, RemoteFile, RemoteHandle
+from .stats import Stats
+from .transport import Transport
+
+class Annex(Remote):
     LINK_PFX = '.git/annex/objects/'
-    def __init__(self, dulwich, workdir, controldir):
+    BRANCHES = [b'refs/heads/git-annex', b'refs/remotes/origin/git-annex']
+    SHA256_BACKENDS = ['SHA256', 'SHA256E']
+    def __init__(self, dulwich, workdir, controldir, transport=None, cache=None, readahead=ReadAhead.MAX_DEPTH, workers=Transport.DOWNLOAD_POOL_SIZE, executor=None, stats=None, engine=None):
+        super().__init__(transport, cache, readahead, workers, executor, stats, engine)
         self.dulwich = dulwich
         self.workdir = workdir
         self.controldir = controldir
+        self._lock = threading.Lock()
+        self._files = {}
     def get_by_path(self, path, st, fd):
         if st is None:
             st = os.lstat(path)
@@ -14,17 +38,126 @@ class Annex:
         link = os.readlink(path)
         if not self.LINK_PFX in link:
             return None
-        return AnnexFile(path)
+        key = os.path.basename(link)
+        file = self._files.get(key)
+        if file is None:
+            # two threads opening the same key must share its hashing and hydration state
+            with self._lock:
+                file = self._files.get(key)
+                if file is None:
+                    file = AnnexFile(self, path, link)
+                    self._files[key] = file
+        return file
+
+    @staticmethod
+    def hashdirlower(key):
+        digest = hashlib.md5(key.encode()).hexdigest()
+        return digest[:3] + '/' + digest[3:6] + '/'
+
+    def _branch_file(self, path):
+        # contents of path in each git-annex branch that has it
+        from dulwich.object_store import tree_lookup_path
+        contents = []
+        for ref in self.BRANCHES:
+            try:
+                tree = self.dulwich[self.dulwich.refs[ref]].tree
+                mode, sha = tree_lookup_path(self.dulwich.__getitem__, tree, path)
+                contents.append(self.dulwich[sha].as_raw_string())
+            except KeyError:
+                continue
+        return contents
+
+    def _log(self, path):
+        # latest state of each value in a timestamped log: value -> present
+        entries = []
+        for content in self._branch_file(path):
+            for line in content.decode().split('\n'):
+                fields = line.split(' ', 2)
+                if len(fields) == 3:
+                    timestamp, status, value = fields
+                    entries.append([float(timestamp.rstrip('s')), status == '1', value])
+        return {value: present for timestamp, present, value in sorted(entries)}
+
+    def _special_remotes(self):
+        # uuid -> config of its latest line
+        remotes = {}
+        latest = {}
+        for content in self._branch_file(b'remote.log'):
+            for line in content.decode().split('\n'):
+                uuid, *fields = line.split(' ')
+                config = dict(field.split('=', 1) for field in fields if '=' in field)
+                timestamp = float(config.get('timestamp', '0').rstrip('s'))
+                if uuid and timestamp >= latest.get(uuid, timestamp):
+                    latest[uuid] = timestamp
+                    remotes[uuid] = config
+        return remotes
+
+    def urls(self, key):
+        # candidate urls for key, from the web log then from httpalso special remotes holding it
+        hashdir = self.hashdirlower(key)
+        urls = [
+            url
+            for url, present in self._log((hashdir + key + '.log.web').encode()).items()
+            if present and url.startswith('http')
+        ]
+        remotes = self._special_remotes()
+        for uuid, present in self._log((hashdir + key + '.log').encode()).items():
+            config = remotes.get(uuid, {})
+            if present and config.get('type') == 'httpalso' and 'url' in config:
+                base = config['url'].rstrip('/') + '/'
+                urls.extend([base + hashdir + key + '/' + key, base + key])
+        return urls
 
-        
-class AnnexFile:
-    def __init__(self, annex, path):
+class AnnexFile(RemoteFile):
+    def __init__(self, annex, path, link):
+        self.annex = annex
+        self.remote = annex
         self.path = path
+        self.object_path = os.path.normpath(os.path.join(os.path.dirname(path), link))
         self.key = os.path.basename(link)
-        key, *_ = self.key.split('.',1)
-        pfx, self.digest = key.split('--',1)
-        self.algo, sizestr = pfx.split('-',1)
-        self.size = int(sizestr[1:])
+        pfx, name = self.key.split('--',1)
+        self.algo, *fields = pfx.split('-')
+        self.size = None
+        for field in fields:
+            if field[:1] == 's':
+                self.size = int(field[1:])
+        self.digest = name.split('.',1)[0] if self.algo.endswith('E') else name
+        # sha256 keys share cached blocks with lfs objects of the same content
+        self.cache_key = self.digest if self.algo in self.annex.SHA256_BACKENDS else self.key
+        self.href = None
+        self.headers = {}
+        self.lock = threading.Lock()
+        self.stats = Stats(annex.stats)
+        if self.algo in self.annex.SHA256_BACKENDS:
+            self._init_verification('sha256', self.digest)
+        else:
+            self._init_verification()
+        # objects placed without git-annex would not be in its location log, so are not hydrated
+        self._init_hydration()
     def open(self):
-        assert os.path.exists(self.path)
-        ...
+        with self.lock:
+            if self.fd is None and os.path.exists(self.object_path):
+                self.fd = os.open(self.object_path, os.O_RDONLY)
+                if self.size is None:
+                    self.size = os.fstat(self.fd).st_size
+            elif self.fd is None:
+                self._ensure_remote()
+            self.opens += 1
+        return RemoteHandle(self)
+    def _ensure_remote(self):
+        if self.href is None:
+            self._resolve()
+    def _resolve(self):
+        for url in self.annex.urls(self.key):
+            try:
+                resp = self.annex.transport.request('download', 'HEAD', url, retries=0, allow_redirects=True)
+            except Exception:
+                continue
+            if resp.status_code == 200:
+                length = resp.headers.get('Content-Length')
+                if self.size is None and length is not None:
+                    self.size = int(length)
+                if self.size is not None:
+                    self.href = resp.url
+                    return
+        raise FileNotFoundError('no reachable url for annex key ' + self.key)
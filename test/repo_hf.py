@@ -0,0 +1,127 @@
+# https://huggingface.co/docs/hub/api#get-apimodelsrepo_idrevisionrevision
+# https://huggingface.co/docs/huggingface_hub/package_reference/environment_variables
+
+# RESOLVE
+# {endpoint}/[datasets/|spaces/]{org}/{name}/resolve/{revision}/{path}
+# HEAD answers 302 to a signed cdn url for lfs files, with X-Linked-Size and X-Linked-Etag
+# the signed url carries its expiry: Expires=EPOCH, or X-Amz-Date and X-Amz-Expires
+# Authorization: Bearer {token}, from $HF_TOKEN or ~/.cache/huggingface/token
+
+# Repositories cloned from the hub are served from resolve urls of the checked-out
+# commit rather than the lfs batch api. Pointers, caching, href refresh and reads are
+# those of LFS; each "batch url" here is a repository's resolve base.
+
+import datetime, os, time, urllib.parse
+
+from .repo_lfs import LFS, LFSException
+
+class HuggingFace(LFS):
+    ENDPOINT = os.environ.get('HF_ENDPOINT', 'https://huggingface.co')
+    TOKEN_PATH = os.path.join(os.environ.get('HF_HOME', os.path.expanduser('~/.cache/huggingface')), 'token')
+    HREF_TTL = 3600 # seconds to trust a resolved url that does not carry its expiry
+    GONE_STATUSES = [401, 403, 404, 410] # the file is not served to us; other failures are retried
+    def __init__(self, *params, **kwparams):
+        super().__init__(*params, **kwparams)
+        self._resolve_auths = {} # credentials are kept off the cdn urls, so not in _auths
+
+    @classmethod
+    def handles(cls, dulwich):
+        return bool(cls._resolve_bases(dulwich))
+
+    @classmethod
+    def _resolve_bases(cls, dulwich):
+        # resolve base -> token embedded in the remote url, for remotes on the hub
+        endpoint = urllib.parse.urlsplit(cls.ENDPOINT)
+        bases = {}
+        config = dulwich.get_config()
+        for section_tuple in config.sections():
+            if section_tuple[0] == b'remote':
+                try:
+                    url = urllib.parse.urlsplit(config.get(section_tuple, b'url').decode())
+                except KeyError:
+                    continue
+                if url.scheme == endpoint.scheme and url.hostname == endpoint.hostname and url.port == endpoint.port:
+                    path = url.path.rstrip('/').removesuffix('.git')
+                    bases[cls.ENDPOINT.rstrip('/') + path + '/resolve/'] = url.password
+        return bases
+
+    def _populate_batch_urls(self):
+        token = os.environ.get('HF_TOKEN')
+        if token is None:
+            try:
+                with open(self.TOKEN_PATH) as fh:
+                    token = fh.read().strip()
+            except FileNotFoundError:
+                pass
+        bases = self._resolve_bases(self.dulwich)
+        for base, url_token in bases.items():
+            if url_token or token:
+                self._resolve_auths[base] = {'Authorization': 'Bearer ' + (url_token or token)}
+        assert bases
+        self.batch_urls = list(bases)
+        return self.batch_urls
+
+    @classmethod
+    def _href_expiry(cls, href):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(href).query)
+        if 'Expires' in query:
+            return float(query['Expires'][0])
+        if 'X-Amz-Date' in query and 'X-Amz-Expires' in query:
+            date = datetime.datetime.strptime(query['X-Amz-Date'][0], '%Y%m%dT%H%M%SZ').replace(tzinfo=datetime.timezone.utc)
+            return date.timestamp() + int(query['X-Amz-Expires'][0])
+        return time.time() + cls.HREF_TTL
+
+    def _resolve(self, base, revision, file):
+        # [href, expires_at, headers], with the url followed to the cdn, or an LFSException
+        # when the file is not served; raises an LFSException for a failure worth retrying
+        auth = self._resolve_auths.get(base, {})
+        path = os.path.relpath(file.path, self.workdir)
+        url = base + revision + '/' + urllib.parse.quote(path)
+        with self.stats.timed('batch_latency', 'inflight_batch_requests'):
+            resp = self.transport.request('batch', 'HEAD', url, headers=auth, allow_redirects=False)
+        self.stats.add('batch_requests')
+        if resp.status_code in [301, 302, 303, 307, 308] and 'Location' in resp.headers:
+            href = urllib.parse.urljoin(url, resp.headers['Location'])
+            # a redirect within the hub is followed with credentials, one to a cdn is signed
+            headers = auth if urllib.parse.urlsplit(href).hostname == urllib.parse.urlsplit(url).hostname else {}
+        elif resp.status_code == 200:
+            href = url
+            headers = auth
+        elif resp.status_code in self.GONE_STATUSES:
+            return LFSException(resp.status_code, 'cannot resolve ' + path, request=resp.request, response=resp)
+        else:
+            raise LFSException(resp.status_code, 'cannot resolve ' + path + ' for now', request=resp.request, response=resp)
+        size = resp.headers.get('X-Linked-Size', resp.headers.get('Content-Length'))
+        if size is not None and int(size) != file.size:
+            return LFSException(LFS.ErrorCode.VALIDATION, 'size of ' + path + ' is ' + size + ', not ' + str(file.size), request=resp.request, response=resp)
+        return [href, self._href_expiry(href), headers]
+
+    def _fetch_hrefs_for(self, batch_url, ref=None, hash_algo=None, **files):
+        # resolves the files' paths at the checked-out commit, in parallel
+        # files that failed transiently are left as they were, and the round raises so it is retried
+        revision = self.dulwich.head().decode()
+        failures = []
+        def resolve(file):
+            try:
+                return self._resolve(batch_url, revision, file)
+            except Exception as exc:
+                failures.append(exc)
+                return None
+        resolved = self.executor.map(resolve, files.values())
+        actions = {}
+        for file, outcome in zip(list(files.values()), resolved):
+            if outcome is None:
+                continue
+            if isinstance(outcome, LFSException):
+                file.drop_endpoint(batch_url, outcome)
+                continue
+            href, expires_at, headers = outcome
+            file.update_href(batch_url, href, expires_at, **headers)
+            if not headers:
+                # only signed urls are persisted, as the others need credentials
+                actions[file.oid_short] = [href, expires_at, {}]
+        if actions:
+            self._save_hrefs(batch_url, actions)
+        if failures:
+            raise failures[0]
+        return files
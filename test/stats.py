@@ -0,0 +1,94 @@
+# Performance counters, shared by a mount's backends and kept per file.
+# Counters are plain integers; latencies go into histograms with power-of-two
+# millisecond buckets, from which percentiles are estimated.
+
+import contextlib, threading, time
+
+class Histogram:
+    BUCKETS = [2 ** exp / 1000 for exp in range(17)] # 1ms .. 65s, in seconds
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+    def record(self, seconds):
+        idx = 0
+        while idx < len(self.BUCKETS) and seconds > self.BUCKETS[idx]:
+            idx += 1
+        self.counts[idx] += 1
+        self.count += 1
+        self.total += seconds
+    def percentile(self, fraction):
+        # upper bound of the bucket holding the given fraction of samples
+        if not self.count:
+            return None
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= fraction * self.count:
+                return self.BUCKETS[idx] if idx < len(self.BUCKETS) else float('inf')
+    def snapshot(self):
+        buckets = {}
+        for idx, count in enumerate(self.counts):
+            if count:
+                if idx < len(self.BUCKETS):
+                    buckets['<=%gms' % (self.BUCKETS[idx] * 1000)] = count
+                else:
+                    buckets['>%gms' % (self.BUCKETS[-1] * 1000)] = count
+        return dict(
+            count=self.count,
+            mean=self.total / self.count if self.count else None,
+            p50=self.percentile(0.5),
+            p99=self.percentile(0.99),
+            buckets=buckets,
+        )
+
+class Stats:
+    def __init__(self, parent=None):
+        # counts recorded here are also recorded in parent
+        self.parent = parent
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+    def add(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        if self.parent is not None:
+            self.parent.add(name, value)
+    def record(self, name, seconds):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = Histogram()
+                self.histograms[name] = histogram
+            histogram.record(seconds)
+        if self.parent is not None:
+            self.parent.record(name, seconds)
+    @contextlib.contextmanager
+    def timed(self, name, inflight=None):
+        # records the latency of the block as name, counting it in the inflight gauge meanwhile
+        if inflight is not None:
+            self.add(inflight)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - start)
+            if inflight is not None:
+                self.add(inflight, -1)
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {name: histogram.snapshot() for name, histogram in self.histograms.items()}
+        hits = counters.get('cache_hits', 0)
+        lookups = hits + counters.get('cache_misses', 0)
+        if lookups:
+            counters['cache_hit_ratio'] = hits / lookups
+        return dict(counters=counters, histograms=histograms)
+    def flat(self):
+        # name -> value, for xattrs
+        snapshot = self.snapshot()
+        values = dict(snapshot['counters'])
+        for name, histogram in snapshot['histograms'].items():
+            for field in ['count', 'mean', 'p50', 'p99']:
+                values[name + '.' + field] = histogram[field]
+        return values
@@ -0,0 +1,188 @@
+# Tests of the git-annex backend: keys, the git-annex branch's logs, and reads from
+# local objects or from urls served by the fake lfs server.
+#   python3 -m pytest -q test
+# or python3 -m unittest test.test_annex, from the directory above this one.
+# Repositories and their git-annex branches are built with dulwich, so neither git nor
+# git-annex is needed.
+
+import hashlib, os, shutil, tempfile, unittest
+
+from .cache import BlockCache
+from .fake_lfs import FakeLFS
+from .repo_annex import Annex
+
+BLOCK = 4096
+
+def sha256e_key(data, ext='.bin'):
+    return 'SHA256E-s' + str(len(data)) + '--' + hashlib.sha256(data).hexdigest() + ext
+
+def annex_link(key):
+    # where git-annex points an annexed file at the top of the worktree
+    return '.git/annex/objects/' + Annex.hashdirlower(key) + key + '/' + key
+
+def commit_branch(repo, ref, files):
+    # commits files, a dict of path -> text, as the whole tree of ref
+    from dulwich.objects import Blob, Commit
+    from dulwich.index import commit_tree
+    entries = []
+    for path, text in files.items():
+        blob = Blob.from_string(text.encode())
+        repo.object_store.add_object(blob)
+        entries.append((path.encode(), blob.id, 0o100644))
+    commit = Commit()
+    commit.tree = commit_tree(repo.object_store, entries)
+    commit.author = commit.committer = b'test <test@localhost>'
+    commit.author_time = commit.commit_time = 0
+    commit.author_timezone = commit.commit_timezone = 0
+    commit.message = b'update'
+    repo.object_store.add_object(commit)
+    repo.refs[ref] = commit.id
+
+class AnnexTestCase(unittest.TestCase):
+    def setUp(self):
+        import dulwich.repo
+        self.path = tempfile.mkdtemp(prefix='httpfs_lm_test_annex_')
+        self.addCleanup(shutil.rmtree, self.path)
+        self.dulwich = dulwich.repo.Repo.init(self.path)
+        self.addCleanup(self.dulwich.close)
+        self.annex = Annex(self.dulwich, self.path, self.dulwich.controldir(), cache=BlockCache(None, 64 * BLOCK, BLOCK), readahead=0)
+        self.addCleanup(self.annex.store_executor.shutdown)
+        self.addCleanup(self.annex.executor.shutdown)
+
+    def annexed(self, name, key, data=None):
+        # an annexed file of key, present in .git/annex/objects if data is given
+        os.symlink(annex_link(key), os.path.join(self.path, name))
+        if data is not None:
+            object_path = os.path.join(self.path, annex_link(key))
+            os.makedirs(os.path.dirname(object_path))
+            with open(object_path, 'wb') as fh:
+                fh.write(data)
+        return self.annex.get_by_path(os.path.join(self.path, name), None, None)
+
+class KeyTests(AnnexTestCase):
+    def test_sha256e_key(self):
+        data = b'annexed content'
+        key = sha256e_key(data, '.tar.gz')
+        file = self.annexed('data.tar.gz', key)
+        self.assertEqual([file.key, file.algo, file.size], [key, 'SHA256E', len(data)])
+        # the digest shares cached blocks with an lfs object of the same content
+        self.assertEqual([file.digest, file.cache_key], [hashlib.sha256(data).hexdigest()] * 2)
+        self.assertEqual(file.object_path, os.path.join(self.path, annex_link(key)))
+        self.assertEqual(file.verification, 'pending')
+
+    def test_other_keys(self):
+        digest = hashlib.sha256(b'x').hexdigest()
+        file = self.annexed('a', 'SHA256-s1-m1700000000--' + digest)
+        self.assertEqual([file.algo, file.size, file.digest, file.cache_key], ['SHA256', 1, digest, digest])
+        file = self.annexed('b', 'MD5E-s3--900150983cd24fb0d6963f7d28e17f72.txt')
+        self.assertEqual([file.algo, file.size, file.cache_key], ['MD5E', 3, file.key])
+        self.assertEqual(file.verification, 'unavailable')
+        file = self.annexed('c', 'WORM--name')
+        self.assertIsNone(file.size)
+
+    def test_files_are_shared_by_key(self):
+        key = sha256e_key(b'shared')
+        first = self.annexed('first', key)
+        self.assertIs(self.annexed('second', key), first)
+
+    def test_only_annex_links_are_annexed(self):
+        with open(os.path.join(self.path, 'plain'), 'wb') as fh:
+            fh.write(b'plain')
+        os.symlink('plain', os.path.join(self.path, 'link'))
+        self.assertIsNone(self.annex.get_by_path(os.path.join(self.path, 'plain'), None, None))
+        self.assertIsNone(self.annex.get_by_path(os.path.join(self.path, 'link'), None, None))
+
+    def test_hashdirlower(self):
+        key = sha256e_key(b'')
+        digest = hashlib.md5(key.encode()).hexdigest()
+        self.assertEqual(Annex.hashdirlower(key), digest[:3] + '/' + digest[3:6] + '/')
+        self.assertRegex(Annex.hashdirlower('WORM--name'), '^[0-9a-f]{3}/[0-9a-f]{3}/$')
+
+class BranchTests(AnnexTestCase):
+    UUID = '5b4c5a3e-0000-4000-8000-000000000001'
+
+    def test_web_log_latest_timestamp_wins(self):
+        key = sha256e_key(b'web')
+        hashdir = Annex.hashdirlower(key)
+        # lines out of order, and across the local and remote branches
+        commit_branch(self.dulwich, b'refs/heads/git-annex', {hashdir + key + '.log.web': '\n'.join([
+            '1700000010.5s 1 http://a.example/data',
+            '1700000020s 0 http://b.example/data',
+            '1700000005s 1 http://b.example/data',
+            '1700000001s 1 ftp://c.example/data',
+            '',
+        ])})
+        commit_branch(self.dulwich, b'refs/remotes/origin/git-annex', {hashdir + key + '.log.web': '\n'.join([
+            '1700000030s 1 http://b.example/data',
+            '1700000000s 0 http://a.example/data',
+            '999999999s 1 http://d.example/data',
+            '1000000000s 0 http://d.example/data',
+        ])})
+        self.assertEqual(self.annex._log((hashdir + key + '.log.web').encode()), {
+            'http://a.example/data': True,
+            'http://b.example/data': True,
+            'ftp://c.example/data': True,
+            'http://d.example/data': False,
+        })
+        self.assertEqual(sorted(self.annex.urls(key)), ['http://a.example/data', 'http://b.example/data'])
+
+    def test_httpalso_remotes_from_the_location_log(self):
+        key = sha256e_key(b'also')
+        hashdir = Annex.hashdirlower(key)
+        other = '5b4c5a3e-0000-4000-8000-000000000002'
+        commit_branch(self.dulwich, b'refs/heads/git-annex', {
+            # a later timestamp with fewer digits still wins
+            'remote.log': '\n'.join([
+                f'{self.UUID} name=old type=httpalso url=http://old.example/annex timestamp=999999999s',
+                f'{self.UUID} name=mirror type=httpalso url=http://mirror.example/annex/ timestamp=1700000000s',
+                f'{other} name=gone type=httpalso url=http://gone.example timestamp=1700000000s',
+            ]),
+            hashdir + key + '.log': '\n'.join([
+                f'1700000000s 1 {self.UUID}',
+                f'1700000000s 1 {other}',
+                f'1700000001s 0 {other}',
+            ]),
+        })
+        self.assertEqual(self.annex._special_remotes()[self.UUID]['name'], 'mirror')
+        self.assertEqual(self.annex.urls(key), [
+            'http://mirror.example/annex/' + hashdir + key + '/' + key,
+            'http://mirror.example/annex/' + key,
+        ])
+
+    def test_no_branch_no_urls(self):
+        self.assertEqual(self.annex.urls(sha256e_key(b'none')), [])
+
+class ReadTests(AnnexTestCase):
+    def test_reads_local_objects(self):
+        data = os.urandom(3 * BLOCK)
+        file = self.annexed('data.bin', sha256e_key(data), data)
+        handle = file.open()
+        self.assertIsNotNone(file.fd)
+        self.assertEqual(handle.read(BLOCK, BLOCK // 2), data[BLOCK//2:BLOCK//2+BLOCK])
+        handle.close()
+        self.assertIsNone(file.fd)
+
+    def test_reads_web_urls(self):
+        fake = FakeLFS().start()
+        self.addCleanup(fake.stop)
+        data = os.urandom(5 * BLOCK + 100)
+        key = sha256e_key(data)
+        commit_branch(self.dulwich, b'refs/heads/git-annex', {
+            Annex.hashdirlower(key) + key + '.log.web': '1700000000s 1 ' + fake.url + '/objects/' + fake.add(data),
+        })
+        file = self.annexed('data.bin', key)
+        handle = file.open()
+        self.addCleanup(handle.close)
+        self.assertIsNone(file.fd)
+        self.assertEqual(file.href, fake.url + '/objects/' + hashlib.sha256(data).hexdigest())
+        for offset in range(0, len(data), BLOCK):
+            self.assertEqual(handle.read(BLOCK, offset), data[offset:offset+BLOCK])
+        self.assertEqual(file.verification, 'verified')
+
+    def test_unreachable_key_fails_to_open(self):
+        file = self.annexed('data.bin', sha256e_key(b'nowhere'))
+        with self.assertRaises(FileNotFoundError):
+            file.open()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+# Tests of the block caches.
+#   python3 -m pytest -q test
+# or python3 -m unittest test.test_cache, from the directory above this one.
+
+import os, shutil, tempfile, threading, unittest, unittest.mock
+
+from .cache import BlockCache, SharedBlockCache
+
+BLOCK = 4096
+
+def xattrs_supported(path):
+    probe = os.path.join(path, 'xattr_probe')
+    with open(probe, 'wb') as fh:
+        try:
+            os.setxattr(fh.fileno(), BlockCache.SIZE_XATTR, b'0')
+            return True
+        except OSError:
+            return False
+        finally:
+            os.unlink(probe)
+
+class BlockCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='httpfs_lm_test_')
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def caches(self):
+        memory = BlockCache(None, 4 * BLOCK, BLOCK)
+        disk = BlockCache(os.path.join(self.dir, 'blocks'), 4 * BLOCK, BLOCK)
+        self.addCleanup(disk.close)
+        return [memory, disk]
+
+    def test_put_get(self):
+        for cache in self.caches():
+            data = os.urandom(BLOCK)
+            cache.put('a' * 64, 0, data)
+            self.assertTrue(cache.contains('a' * 64, 0))
+            self.assertEqual(cache.get('a' * 64, 0, BLOCK), data)
+            self.assertIsNone(cache.get('a' * 64, 1, BLOCK))
+
+    def test_evicts_least_recently_used(self):
+        for cache in self.caches():
+            for idx in range(4):
+                cache.put('a' * 64, idx, bytes([idx]) * BLOCK)
+            cache.get('a' * 64, 0, BLOCK)
+            cache.put('a' * 64, 4, bytes([4]) * BLOCK)
+            self.assertLessEqual(cache.used, cache.budget)
+            self.assertTrue(cache.contains('a' * 64, 0))
+            self.assertFalse(cache.contains('a' * 64, 1))
+            self.assertEqual(cache.get('a' * 64, 4, BLOCK), bytes([4]) * BLOCK)
+
+    def test_length_mismatch_drops_block(self):
+        # a reader expecting another length must see a miss it can fill, not a block that stays
+        for cache in self.caches():
+            cache.put('a' * 64, 0, os.urandom(BLOCK))
+            self.assertIsNone(cache.get('a' * 64, 0, BLOCK // 2))
+            self.assertFalse(cache.contains('a' * 64, 0))
+
+    def test_discard_during_put(self):
+        # a block written to a file that discard unlinks meanwhile must not be indexed
+        cache = BlockCache(os.path.join(self.dir, 'blocks'), 16 * BLOCK, BLOCK)
+        self.addCleanup(cache.close)
+        cache.put('a' * 64, 0, os.urandom(BLOCK))
+        writing, resume = threading.Event(), threading.Event()
+        pwrite = os.pwrite
+        def paused_pwrite(fd, data, offset):
+            if offset == 5 * BLOCK:
+                writing.set()
+                resume.wait(5)
+            return pwrite(fd, data, offset)
+        with unittest.mock.patch('os.pwrite', paused_pwrite):
+            writer = threading.Thread(target=cache.put, args=('a' * 64, 5, os.urandom(BLOCK)))
+            writer.start()
+            self.assertTrue(writing.wait(5))
+            cache.discard('a' * 64)
+            cache.put('a' * 64, 7, os.urandom(BLOCK))
+            resume.set()
+            writer.join()
+        self.assertFalse(cache.contains('a' * 64, 5))
+        self.assertIsNone(cache.get('a' * 64, 5, BLOCK))
+        self.assertTrue(cache.contains('a' * 64, 7))
+
+    def test_rescan(self):
+        path = os.path.join(self.dir, 'blocks')
+        if not xattrs_supported(self.dir):
+            self.skipTest('no user xattrs on ' + self.dir)
+        cache = BlockCache(path, 16 * BLOCK, BLOCK)
+        full, last = os.urandom(BLOCK), os.urandom(100)
+        cache.put('a' * 64, 0, full)
+        cache.put('a' * 64, 2, last)
+        cache.close()
+        cache = BlockCache(path, 16 * BLOCK, BLOCK)
+        self.addCleanup(cache.close)
+        self.assertEqual(cache.get('a' * 64, 0, BLOCK), full)
+        self.assertFalse(cache.contains('a' * 64, 1))
+        self.assertEqual(cache.get('a' * 64, 2, 100), last)
+
+    def test_rescan_ignores_torn_block(self):
+        # a short trailing block without the object's size recorded was cut off mid-write
+        path = os.path.join(self.dir, 'blocks')
+        cache = BlockCache(path, 16 * BLOCK, BLOCK)
+        cache.put('a' * 64, 0, os.urandom(BLOCK))
+        cache.close()
+        with open(cache._oid_path('a' * 64), 'ab') as fh:
+            fh.write(os.urandom(100))
+        cache = BlockCache(path, 16 * BLOCK, BLOCK)
+        self.addCleanup(cache.close)
+        self.assertTrue(cache.contains('a' * 64, 0))
+        self.assertFalse(cache.contains('a' * 64, 1))
+
+    def test_directory_is_locked(self):
+        path = os.path.join(self.dir, 'blocks')
+        cache = BlockCache(path, 16 * BLOCK, BLOCK)
+        self.addCleanup(cache.close)
+        with self.assertRaises(RuntimeError):
+            BlockCache(path, 16 * BLOCK, BLOCK)
+
+class SharedBlockCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='httpfs_lm_test_')
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def cache(self, budget=4 * BLOCK):
+        cache = SharedBlockCache(self.dir, budget, BLOCK)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_shared_between_instances(self):
+        first, second = self.cache(), self.cache()
+        data = os.urandom(BLOCK)
+        first.put('a' * 64, 3, data)
+        self.assertTrue(second.contains('a' * 64, 3))
+        self.assertEqual(second.get('a' * 64, 3, BLOCK), data)
+
+    def test_evicts_within_budget(self):
+        first, second = self.cache(), self.cache()
+        for idx in range(3):
+            first.put('a' * 64, idx, bytes([idx]) * BLOCK)
+        for idx in range(3):
+            second.put('b' * 64, idx, bytes([idx]) * BLOCK)
+        held = [
+            (oid, idx)
+            for oid in ['a' * 64, 'b' * 64]
+            for idx in range(3)
+            if first.contains(oid, idx)
+        ]
+        self.assertLessEqual(len(held), 4)
+        self.assertIn(('b' * 64, 2), held)
+        for oid, idx in held:
+            self.assertIn(first.get(oid, idx, BLOCK), [bytes([idx]) * BLOCK, None])
+
+    def test_truncated_file_is_a_miss(self):
+        cache = self.cache()
+        cache.put('a' * 64, 0, os.urandom(BLOCK))
+        os.truncate(cache._oid_path('a' * 64), 0)
+        self.assertIsNone(cache.get('a' * 64, 0, BLOCK))
+        self.assertFalse(cache.contains('a' * 64, 0))
+
+    def test_length_mismatch_drops_block(self):
+        cache = self.cache()
+        cache.put('a' * 64, 0, os.urandom(BLOCK))
+        self.assertIsNone(cache.get('a' * 64, 0, 100))
+        self.assertFalse(cache.contains('a' * 64, 0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+# Tests of endpoint selection: measurement, backoff, and reads failing over between sources.
+#   python3 -m pytest -q test
+# or python3 -m unittest test.test_endpoints, from the directory above this one.
+
+import os, types, unittest, unittest.mock
+
+from .endpoints import Endpoints
+from .test_remote import BLOCK, MemoryFile, memory_remote
+
+SOURCES = [['a', 'http://a/object', {}], ['b', 'http://b/object', {}]]
+
+class EndpointsTests(unittest.TestCase):
+    def failed(self, endpoints, key, retry_after=None):
+        # an exception carrying its response, as requests raises
+        exc = OSError('refused')
+        exc.response = types.SimpleNamespace(headers={} if retry_after is None else {'Retry-After': str(retry_after)})
+        endpoints.failed(key, exc)
+
+    def test_unmeasured_endpoints_are_tried_first(self):
+        endpoints = Endpoints()
+        endpoints.succeeded('a', 1000, 0.1)
+        for attempt in range(20):
+            self.assertEqual(endpoints.choose(SOURCES, 1000)[0], 'b')
+
+    def test_failed_endpoint_is_skipped(self):
+        endpoints = Endpoints()
+        endpoints.succeeded('a', 1000, 0.01)
+        endpoints.succeeded('b', 1000, 0.01)
+        self.failed(endpoints, 'a')
+        for attempt in range(20):
+            self.assertEqual(endpoints.choose(SOURCES, 1000)[0], 'b')
+
+    def test_backoff_doubles_until_a_success(self):
+        endpoints = Endpoints()
+        downs = []
+        for failure in range(3):
+            self.failed(endpoints, 'a')
+            downs.append(endpoints.snapshot()['a']['down_for'])
+        self.assertAlmostEqual(downs[0], Endpoints.BACKOFF, delta=0.1)
+        self.assertAlmostEqual(downs[1], 2 * Endpoints.BACKOFF, delta=0.1)
+        self.assertAlmostEqual(downs[2], 4 * Endpoints.BACKOFF, delta=0.1)
+        endpoints.succeeded('a', 1000, 0.01)
+        self.failed(endpoints, 'a')
+        self.assertAlmostEqual(endpoints.snapshot()['a']['down_for'], Endpoints.BACKOFF, delta=0.1)
+
+    def test_retry_after_is_honoured(self):
+        endpoints = Endpoints()
+        self.failed(endpoints, 'a', retry_after=30)
+        self.assertAlmostEqual(endpoints.snapshot()['a']['down_for'], 30, delta=0.5)
+        self.failed(endpoints, 'b', retry_after=10 * Endpoints.MAX_BACKOFF)
+        self.assertLessEqual(endpoints.snapshot()['b']['down_for'], Endpoints.MAX_BACKOFF)
+
+    def test_all_down_tries_the_first_to_recover(self):
+        endpoints = Endpoints()
+        self.failed(endpoints, 'a', retry_after=30)
+        self.failed(endpoints, 'b', retry_after=5)
+        self.assertEqual(endpoints.choose(SOURCES, 1000)[0], 'b')
+
+    def test_slow_endpoint_gets_nothing_but_probes(self):
+        endpoints = Endpoints()
+        endpoints.succeeded('a', 1000, 0.01)
+        endpoints.succeeded('b', 1000, 0.01 * Endpoints.SLOW_FACTOR * 2)
+        with unittest.mock.patch.object(Endpoints, 'PROBE', 0):
+            for attempt in range(50):
+                self.assertEqual(endpoints.choose(SOURCES, 1000)[0], 'a')
+
+    def test_throughput_is_measured_net_of_latency(self):
+        endpoints = Endpoints()
+        endpoints.succeeded('a', 1000, 0.1)
+        nbytes = 10 * Endpoints.SMALL
+        endpoints.succeeded('a', nbytes, 1.1)
+        self.assertAlmostEqual(endpoints.snapshot()['a']['throughput'], nbytes, delta=nbytes * 0.01)
+
+class FailoverTests(unittest.TestCase):
+    def test_reads_move_on_to_the_next_source(self):
+        data = os.urandom(4 * BLOCK)
+        remote = memory_remote(data, readahead=0)
+        self.addCleanup(remote.executor.shutdown)
+        get_range = remote.transport.get_range
+        def refusing_a(url, start, stop, headers={}, retries=None):
+            if url == SOURCES[0][1]:
+                raise OSError('refused')
+            return get_range(url, start, stop, headers, retries)
+        remote.transport.get_range = refusing_a
+        file = MemoryFile(remote, data)
+        file._sources = lambda: [list(source) for source in SOURCES]
+        for idx in range(4):
+            self.assertEqual(file.read(BLOCK, idx * BLOCK), data[idx*BLOCK:(idx+1)*BLOCK])
+        # a is unmeasured, so is tried until it has failed, and then skipped while it backs off
+        snapshot = remote.endpoints.snapshot()
+        self.assertEqual(snapshot['b']['requests'], 4)
+        self.assertEqual(snapshot['a']['requests'], 0)
+        self.assertGreater(snapshot['a']['down_for'], 0)
+        self.assertEqual(file.stats.flat()['failovers'], 1)
+
+    def test_last_source_failing_raises(self):
+        data = os.urandom(BLOCK)
+        remote = memory_remote(data, readahead=0)
+        self.addCleanup(remote.executor.shutdown)
+        def refusing(url, start, stop, headers={}, retries=None):
+            raise OSError('refused')
+        remote.transport.get_range = refusing
+        file = MemoryFile(remote, data)
+        file._sources = lambda: [list(source) for source in SOURCES]
+        with self.assertRaises(OSError):
+            file.read(BLOCK, 0)
+        # the claim was released, so a later read fetches again
+        owned, waiting = remote._claim('k', [0])
+        self.assertEqual(owned, [0])
+        remote._settle('k', owned, exception=OSError('unused'))
+
+if __name__ == '__main__':
+    unittest.main()
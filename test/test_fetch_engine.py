@@ -0,0 +1,89 @@
+# Tests of the fetch engine against the fake lfs server.
+#   python3 -m pytest -q test
+# or python3 -m unittest test.test_fetch_engine, from the directory above this one.
+# These need aiohttp, and are skipped without it.
+
+import importlib.util, itertools, os, time, unittest, unittest.mock
+
+from . import fake_lfs
+from .fake_lfs import FakeLFS
+from .fetch_engine import FetchEngine
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+class MissingTests(unittest.TestCase):
+    def test_fails_when_made(self):
+        find_spec = importlib.util.find_spec
+        def without_aiohttp(name, *args):
+            return None if name == 'aiohttp' else find_spec(name, *args)
+        with unittest.mock.patch.object(importlib.util, 'find_spec', without_aiohttp):
+            with self.assertRaises(ImportError) as raised:
+                FetchEngine()
+        self.assertEqual(raised.exception.name, 'aiohttp')
+
+@unittest.skipIf(aiohttp is None, 'needs aiohttp')
+class FetchEngineTests(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeLFS().start()
+        self.addCleanup(self.fake.stop)
+        self.data = os.urandom(256 * 1024 + 10)
+        self.url = self.fake.url + '/objects/' + self.fake.add(self.data)
+        self.engine = FetchEngine()
+        self.addCleanup(self.engine.close)
+
+    def test_ranges(self):
+        ranges = [[0, 1], [100, 70000], [65536, 131072], [len(self.data) - 10, len(self.data)], [0, len(self.data)]]
+        futs = [self.engine.submit(self.url, start, stop) for start, stop in ranges]
+        for [start, stop], fut in zip(ranges, futs):
+            self.assertEqual(fut.result(), self.data[start:stop])
+        self.assertEqual(self.engine.get_range(self.url, 5, 10), self.data[5:10])
+
+    def test_retries_after_429(self):
+        self.fake.rate_limit, self.fake.retry_after = 0.5, 0.3
+        # the first request is refused and the rest admitted
+        admissions = itertools.chain([0.0], itertools.repeat(1.0))
+        with unittest.mock.patch.object(fake_lfs.random, 'random', lambda: next(admissions)):
+            began = time.monotonic()
+            self.assertEqual(self.engine.get_range(self.url, 0, 1000), self.data[:1000])
+        self.assertGreaterEqual(time.monotonic() - began, 0.3)
+        self.assertEqual(self.fake.counts['rate_limited'], 1)
+
+    def test_gives_up_after_its_retries(self):
+        self.fake.rate_limit, self.fake.retry_after = 1, 0
+        with self.assertRaises(aiohttp.ClientResponseError) as raised:
+            self.engine.get_range(self.url, 0, 1000, retries=2)
+        self.assertEqual(raised.exception.status, 429)
+        self.assertEqual(self.fake.counts['rate_limited'], 3)
+
+    def test_close_stops_the_loop(self):
+        self.engine.get_range(self.url, 0, 10)
+        loop, thread = self.engine._loop, self.engine._thread
+        self.engine.close()
+        self.assertTrue(loop.is_closed())
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(self.engine._session)
+        # and a later request starts another
+        self.assertEqual(self.engine.get_range(self.url, 0, 10), self.data[:10])
+        self.assertIsNot(self.engine._loop, loop)
+
+    @unittest.skipIf(not hasattr(os, 'fork'), 'needs fork')
+    def test_forked_child_starts_its_own_loop(self):
+        self.engine.get_range(self.url, 0, 10)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                ok = self.engine.submit(self.url, 0, 100).result(timeout=10) == self.data[:100]
+                self.engine.close()
+            except BaseException:
+                ok = False
+            os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        # the parent's pooled connections were left alone by the child
+        self.assertEqual(self.engine.submit(self.url, 0, 10).result(timeout=10), self.data[:10])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+# Tests of the hub backend, resolving files through the fake lfs server's resolve urls.
+#   python3 -m pytest -q test
+# or python3 -m unittest test.test_hf, from the directory above this one.
+# Tests serving a repository from the fake lfs server need git.
+
+import datetime, os, shutil, time, unittest, unittest.mock
+
+from .cache import BlockCache
+from .fake_lfs import FakeLFS
+from .repo_hf import HuggingFace
+from .repo_lfs import LFSException
+
+BLOCK = 4096
+
+class ExpiryTests(unittest.TestCase):
+    def test_expires(self):
+        self.assertEqual(HuggingFace._href_expiry('https://cdn.example/x?Expires=1700000000&Signature=s'), 1700000000)
+
+    def test_amz_date(self):
+        href = 'https://cdn.example/x?X-Amz-Date=20240101T000000Z&X-Amz-Expires=3600&X-Amz-Signature=s'
+        expected = datetime.datetime(2024, 1, 1, 1, tzinfo=datetime.timezone.utc).timestamp()
+        self.assertEqual(HuggingFace._href_expiry(href), expected)
+
+    def test_unsigned_urls_are_trusted_for_a_while(self):
+        expiry = HuggingFace._href_expiry('https://cdn.example/x')
+        self.assertAlmostEqual(expiry, time.time() + HuggingFace.HREF_TTL, delta=5)
+
+@unittest.skipIf(shutil.which('git') is None, 'needs git')
+class ResolveTests(unittest.TestCase):
+    def setUp(self):
+        from .bench import fake_repo
+        from .repo import Repo
+        self.fake = FakeLFS().start()
+        self.addCleanup(self.fake.stop)
+        self.data = os.urandom(3 * BLOCK + 10)
+        self.path = fake_repo(self.fake, {'model.bin': self.data})
+        self.addCleanup(shutil.rmtree, self.path)
+        self.oid = self.fake.add(self.data)
+        self.fake.files['model.bin'] = self.oid
+        for patch in [
+            unittest.mock.patch.object(HuggingFace, 'ENDPOINT', self.fake.url),
+            unittest.mock.patch.dict(os.environ, HF_TOKEN='secret'),
+        ]:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.repo = Repo(self.path, cache=BlockCache(None, 64 * BLOCK, BLOCK), readahead=0)
+        self.addCleanup(self.repo.stop)
+        self.hub = self.repo.backends[0]
+        self.base = self.fake.url + '/bench/resolve/'
+
+    def file(self):
+        return self.repo.get_by_path(os.path.join(self.path, 'model.bin'))
+
+    def test_hub_clones_resolve(self):
+        self.assertIsInstance(self.hub, HuggingFace)
+        self.assertEqual(self.hub._ensure_batch_urls(), [self.base])
+        self.assertEqual(self.hub._resolve_auths[self.base], {'Authorization': 'Bearer secret'})
+
+    def test_resolves_to_the_signed_cdn_url(self):
+        file = self.file()
+        handle = file.open()
+        self.addCleanup(handle.close)
+        # the redirect was not followed, and the token went to the hub alone
+        self.assertEqual(self.fake.counts['object_requests'], 0)
+        self.assertEqual(self.fake.counts['authorized_resolve_requests'], 1)
+        self.assertTrue(file.href.startswith(self.fake.cdn_url + '/objects/' + self.oid + '?Expires='), file.href)
+        self.assertEqual(file.headers, {})
+        self.assertAlmostEqual(file.expires_at, time.time() + self.fake.expires_in, delta=5)
+        self.assertEqual(handle.read(len(self.data), 0), self.data)
+        self.assertGreater(self.fake.counts['object_requests'], 0)
+        self.assertEqual(self.fake.counts['authorized_object_requests'], 0)
+
+    def test_gone_files_drop_the_endpoint(self):
+        del self.fake.files['model.bin']
+        file = self.file()
+        with self.assertRaises(LFSException) as raised:
+            file.open()
+        self.assertEqual(raised.exception.code, 404)
+        self.assertEqual(file.batch_urls, set())
+        self.assertEqual(file.errors[self.base].code, 404)
+
+    def test_size_mismatch_drops_the_endpoint(self):
+        self.fake.files['model.bin'] = self.fake.add(self.data + b'more')
+        file = self.file()
+        with self.assertRaises(LFSException):
+            file.open()
+        self.assertEqual(file.batch_urls, set())
+        self.assertEqual(file.errors[self.base].code, HuggingFace.ErrorCode.VALIDATION)
+
+    def test_transient_failures_keep_the_endpoint(self):
+        file = self.file()
+        file.batch_urls = set(self.hub._ensure_batch_urls())
+        self.fake.rate_limit, self.fake.retry_after = 1, 0
+        with self.assertRaises(LFSException) as raised:
+            self.hub._fetch_hrefs_for(self.base, **{file.oid_short: file})
+        self.assertEqual(raised.exception.code, 429)
+        self.assertEqual(file.batch_urls, {self.base})
+        self.assertEqual(file.errors, {})
+        # so the next round resolves it
+        self.fake.rate_limit = 0
+        handle = file.open()
+        self.addCleanup(handle.close)
+        self.assertEqual(handle.read(BLOCK, 0), self.data[:BLOCK])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+# Tests of the lfs backend against the fake lfs server.
+#   python3 -m pytest -q test
+# or python3 -m unittest test.test_lfs, from the directory above this one.
+# These serve a repository from the fake lfs server, so need git.
+
+import json, os, shutil, subprocess, time, unittest
+
+from .cache import BlockCache
+from .fake_lfs import FakeLFS
+
+BLOCK = 4096
+
+@unittest.skipIf(shutil.which('git') is None, 'needs git')
+class LFSTestCase(unittest.TestCase):
+    def setUp(self):
+        from .bench import fake_repo
+        self.fake = FakeLFS().start()
+        self.addCleanup(self.fake.stop)
+        self.data = os.urandom(3 * BLOCK + 10)
+        self.path = fake_repo(self.fake, {'model.bin': self.data})
+        self.addCleanup(shutil.rmtree, self.path)
+        self.batch_url = self.fake.url + '/bench.git/info/lfs/objects/batch'
+        self.hrefs_path = os.path.join(self.path, '.git', 'lfs', 'httpfs_lm', 'hrefs.json')
+
+    def repo(self):
+        # a fresh mount's view of the repository, given its batch url so it probes nothing
+        from .repo import Repo
+        repo = Repo(self.path, cache=BlockCache(None, 64 * BLOCK, BLOCK), readahead=0, lfs_batch_urls=[self.batch_url])
+        self.addCleanup(repo.stop)
+        return repo
+
+    def read(self, repo, name='model.bin'):
+        handle = repo.get_by_path(os.path.join(self.path, name)).open()
+        try:
+            return handle.read(1 << 20, 0)
+        finally:
+            handle.close()
+
+class HREFCacheTests(LFSTestCase):
+    def hrefs(self):
+        with open(self.hrefs_path) as fh:
+            return json.load(fh)
+
+    def test_restart_reuses_fresh_hrefs(self):
+        self.assertEqual(self.read(self.repo()), self.data)
+        self.assertEqual(self.fake.counts['batch_requests'], 1)
+        oid = self.fake.add(self.data)
+        [[batch_url, entry]] = self.hrefs()[oid].items()
+        self.assertEqual([batch_url, entry['href']], [self.batch_url, self.fake.url + '/objects/' + oid])
+        self.assertGreater(entry['expires_at'], time.time())
+        self.assertEqual(self.read(self.repo()), self.data)
+        self.assertEqual(self.fake.counts['batch_requests'], 1)
+
+    def test_hrefs_due_for_refresh_are_fetched_again(self):
+        self.read(self.repo())
+        hrefs = self.hrefs()
+        for entries in hrefs.values():
+            for entry in entries.values():
+                entry['expires_at'] = time.time() + 10
+        with open(self.hrefs_path, 'w') as fh:
+            json.dump(hrefs, fh)
+        self.assertEqual(self.read(self.repo()), self.data)
+        self.assertEqual(self.fake.counts['batch_requests'], 2)
+
+    def test_saving_converts_old_entries_and_drops_stale_ones(self):
+        old_oid, stale_oid = 'a' * 64, 'b' * 64
+        old_entry = dict(batch_url=self.batch_url, href='http://old.example/object', expires_at=time.time() + 3600, header={})
+        os.makedirs(os.path.dirname(self.hrefs_path))
+        with open(self.hrefs_path, 'w') as fh:
+            json.dump({
+                old_oid: old_entry,
+                stale_oid: {self.batch_url: dict(href='http://stale.example/object', expires_at=time.time() - 1, header={})},
+            }, fh)
+        self.read(self.repo())
+        hrefs = self.hrefs()
+        self.assertEqual(hrefs[old_oid], {self.batch_url: old_entry})
+        self.assertNotIn(stale_oid, hrefs)
+        self.assertIn(self.fake.add(self.data), hrefs)
+
+class PointerIndexTests(LFSTestCase):
+    def git(self, *args):
+        subprocess.check_call(['git', '-C', self.path, '-c', 'user.name=test', '-c', 'user.email=test@localhost', *args], stdout=subprocess.DEVNULL)
+
+    def test_commits_after_start_are_seen(self):
+        repo = self.repo()
+        lfs = repo.backends[0]
+        lfs.INDEX_CHECK_INTERVAL = 0
+        repo.start()
+        # once the resolver has been through the tree it only waits
+        deadline = time.monotonic() + 10
+        while not lfs._files or lfs._files[self.fake.add(self.data)].expired():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        stamp = repo.tree_stamp()
+        new_path = os.path.join(self.path, 'new.bin')
+        data = os.urandom(BLOCK)
+        with open(new_path, 'wb') as fh:
+            fh.write(self.fake.pointer(self.fake.add(data), len(data)))
+        # lookups without an fd go by the index, which lacks the pointer so far
+        self.assertIsNone(lfs.get_by_path(new_path, None, None))
+        self.git('add', 'new.bin')
+        self.git('commit', '-q', '-m', 'new')
+        self.assertNotEqual(repo.tree_stamp(), stamp)
+        file = lfs.get_by_path(new_path, None, None)
+        self.assertEqual([file.oid_short, file.size], [self.fake.add(data), len(data)])
+        self.assertEqual(self.read(repo, 'new.bin'), data)
+        self.git('rm', '-q', 'model.bin')
+        self.git('commit', '-q', '-m', 'gone')
+        self.assertNotIn(b'model.bin', lfs._pointer_index())
+
+    def test_index_is_checked_at_most_every_interval(self):
+        repo = self.repo()
+        lfs = repo.backends[0]
+        lfs.INDEX_CHECK_INTERVAL = 60
+        pointers = lfs._pointer_index()
+        self.git('rm', '-q', 'model.bin')
+        self.assertIs(lfs._pointer_index(), pointers)
+        lfs.INDEX_CHECK_INTERVAL = 0
+        self.assertEqual(lfs._pointer_index(), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,409 @@
+# Tests of torch_remote_serialization, loading checkpoints served by the fake lfs server.
+#   python3 -m pytest -q test
+# or python3 -m unittest test.test_loader, from the directory above this one.
+# Manifests are written to a temporary directory. These need torch, and are skipped without it.
+
+import io, json, os, random, shutil, tempfile, threading, unittest, unittest.mock
+
+from .cache import BlockCache
+from .fake_lfs import FakeLFS
+
+try:
+    import torch, torch_remote_serialization as trs
+except ImportError:
+    torch = None
+
+def checkpoint(layers=4, numel=1000):
+    # a state dict and its torch.save bytes
+    state = {f'layers.{idx}.weight': torch.randn(numel) for idx in range(layers)}
+    buf = io.BytesIO()
+    torch.save(state, buf)
+    return state, buf.getvalue()
+
+def safetensors(entries, metadata=None):
+    # the bytes of a safetensors file of entries, a dict of name -> [dtype code, shape, tensor]
+    # data is laid out in reverse order, so offsets do not follow the header
+    header = {} if metadata is None else {'__metadata__': metadata}
+    body = b''
+    for name, [code, shape, tensor] in reversed(list(entries.items())):
+        raw = tensor.reshape(-1).view(torch.uint8).numpy().tobytes()
+        header[name] = dict(dtype=code, shape=shape, data_offsets=[len(body), len(body) + len(raw)])
+        body += raw
+    header = json.dumps(header).encode()
+    header += b' ' * (-len(header) % 8)
+    return len(header).to_bytes(8, 'little') + header + body
+
+@unittest.skipIf(torch is None, 'needs torch')
+class LoaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeLFS().start()
+        self.addCleanup(self.fake.stop)
+
+    def serve(self, data):
+        return self.fake.url + '/objects/' + self.fake.add(data)
+
+    def assertTensorsEqual(self, first, second):
+        self.assertEqual(list(first), list(second))
+        for name in first:
+            self.assertTrue(torch.equal(first[name], second[name]), name)
+
+class BatchTests(LoaderTestCase):
+    def test_spans_merge_close_extents_in_offset_order(self):
+        extents = [[100, 10, 'c'], [0, 10, 'a'], [30, 10, 'd'], [15, 5, 'b']]
+        self.assertEqual(trs._spans(extents, merge_gap=10, max_span=1000), [
+            [0, 40, [[0, 10, 'a'], [15, 5, 'b'], [30, 10, 'd']]],
+            [100, 110, [[100, 10, 'c']]],
+        ])
+        # a span stops growing at max_span
+        self.assertEqual(trs._spans(extents, merge_gap=10, max_span=25), [
+            [0, 20, [[0, 10, 'a'], [15, 5, 'b']]],
+            [30, 40, [[30, 10, 'd']]],
+            [100, 110, [[100, 10, 'c']]],
+        ])
+        self.assertEqual(len(trs._spans(extents, merge_gap=0)), 4)
+
+    def test_fetch_many_matches_direct_reads(self):
+        state, data = checkpoint(layers=8)
+        tensors = trs.load(self.serve(data), manifest_dir=None)
+        self.assertTrue(all(tensor.is_meta for tensor in tensors.values()))
+        direct = {name: tensor.remote_fetch() for name, tensor in tensors.items()}
+        self.assertTensorsEqual(direct, state)
+        before = self.fake.counts['object_requests']
+        self.assertTensorsEqual(trs.fetch_many(tensors), state)
+        merged = self.fake.counts['object_requests'] - before
+        self.assertLess(merged, len(tensors))
+        self.assertTensorsEqual(trs.fetch_many(tensors, merge_gap=0, max_span=1), state)
+        # an iterable of tensors is keyed by remote_name
+        fetched = trs.fetch_many(list(tensors.values()))
+        self.assertEqual(sorted(fetched), sorted(tensor.remote_name for tensor in tensors.values()))
+
+class IterFetchTests(LoaderTestCase):
+    def fetch(self, tensors, **options):
+        # iter_fetch's results, and the most bytes its reads had in flight at once
+        lock = threading.Lock()
+        inflight = [0, 0] # now, peak
+        read_storages = trs._RemoteArchive.read_storages
+        def counted(archive, start, end, extents):
+            with lock:
+                inflight[0] += end - start
+                inflight[1] = max(inflight[1], inflight[0])
+            try:
+                return read_storages(archive, start, end, extents)
+            finally:
+                with lock:
+                    inflight[0] -= end - start
+        with unittest.mock.patch.object(trs._RemoteArchive, 'read_storages', counted):
+            fetched = dict(trs.iter_fetch(tensors, **options))
+        return fetched, inflight[1]
+
+    def test_reads_stay_within_the_byte_budget(self):
+        self.fake.latency = 0.05
+        state, data = checkpoint(layers=8, numel=1000)
+        tensors = trs.load(self.serve(data), manifest_dir=None)
+        fetched, peak = self.fetch(tensors, workers=8, max_inflight_bytes=8000, merge_gap=0)
+        self.assertTensorsEqual(dict(sorted(fetched.items())), dict(sorted(state.items())))
+        self.assertLessEqual(peak, 8000)
+        # without the budget the same reads overlap further
+        fetched, peak = self.fetch(tensors, workers=8, merge_gap=0)
+        self.assertGreater(peak, 8000)
+
+    def test_filter_restricts_the_fetch(self):
+        state, data = checkpoint()
+        tensors = trs.load(self.serve(data), manifest_dir=None)
+        names = ['layers.1.weight', 'layers.3.weight']
+        fetched = dict(trs.iter_fetch(tensors, filter=names))
+        self.assertEqual(sorted(fetched), names)
+        fetched = dict(trs.iter_fetch(tensors, filter=lambda name: name.startswith('layers.0.')))
+        self.assertTensorsEqual(fetched, {'layers.0.weight': state['layers.0.weight']})
+
+class StorageTests(LoaderTestCase):
+    def test_local_files_are_mapped(self):
+        state, data = checkpoint()
+        directory = tempfile.mkdtemp(prefix='httpfs_lm_test_')
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'model.pt')
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        tensors = trs.load(path, manifest_dir=None)
+        name = 'layers.2.weight'
+        self.assertIsNotNone(tensors[name].remote_archive._mmap)
+        # both fetches view the same pages of the mapping rather than copies of them
+        fetched, again = tensors[name].remote_fetch(), tensors[name].remote_fetch()
+        self.assertEqual(fetched.data_ptr(), again.data_ptr())
+        self.assertTensorsEqual(trs.fetch_many(tensors), state)
+        # the mapping is copy on write, so the file is left as it was
+        fetched.fill_(0)
+        with open(path, 'rb') as fh:
+            self.assertEqual(fh.read(), data)
+
+    def test_buffers_are_read_into_storages(self):
+        state, data = checkpoint()
+        tensors = trs.load(io.BytesIO(data), manifest_dir=None)
+        name = 'layers.2.weight'
+        self.assertIsNone(tensors[name].remote_archive._mmap)
+        first, second = tensors[name].remote_fetch(), tensors[name].remote_fetch()
+        self.assertNotEqual(first.data_ptr(), second.data_ptr())
+        self.assertTensorsEqual(trs.fetch_many(tensors), state)
+        self.assertTensorsEqual(dict(sorted(trs.iter_fetch(tensors))), dict(sorted(state.items())))
+
+class LayerTests(LoaderTestCase):
+    def test_groups_by_numbered_module(self):
+        names = ['embed.weight', 'transformer.h.0.attn.weight', 'transformer.h.0.mlp.weight', 'transformer.h.1.attn.weight', 'transformer.h.10.attn.weight', 'lm_head.weight', 'bias']
+        self.assertEqual(trs.layer_groups(names), {
+            'embed': ['embed.weight'],
+            'transformer.h.0': ['transformer.h.0.attn.weight', 'transformer.h.0.mlp.weight'],
+            'transformer.h.1': ['transformer.h.1.attn.weight'],
+            'transformer.h.10': ['transformer.h.10.attn.weight'],
+            'lm_head': ['lm_head.weight'],
+            'bias': ['bias'],
+        })
+        self.assertEqual(list(trs.layer_groups(names, pattern=r'^(transformer)\.')), ['embed', 'transformer', 'lm_head', 'bias'])
+
+    def test_groups_are_fetched_a_window_ahead(self):
+        state = {'embed.weight': torch.randn(8)}
+        for idx in range(5):
+            state[f'layers.{idx}.weight'] = torch.randn(8)
+            state[f'layers.{idx}.bias'] = torch.randn(2)
+        buf = io.BytesIO()
+        torch.save(state, buf)
+        tensors = trs.load(self.serve(buf.getvalue()), manifest_dir=None)
+        fetched = []
+        fetch_many = trs.fetch_many
+        def counted(selected, **fetch_args):
+            fetched.append(list(selected))
+            return fetch_many(selected, **fetch_args)
+        with unittest.mock.patch.object(trs, 'fetch_many', counted):
+            prefixes = []
+            for prefix, group in trs.iter_layers(tensors, window=2):
+                # the group held, and at most the one after it
+                self.assertLessEqual(len(fetched), len(prefixes) + 2)
+                self.assertTensorsEqual(group, {name: state[name] for name in trs.layer_groups(state)[prefix]})
+                prefixes.append(prefix)
+        self.assertEqual(prefixes, ['embed'] + [f'layers.{idx}' for idx in range(5)])
+        self.assertEqual(len(fetched), 6)
+
+class SafetensorsTests(LoaderTestCase):
+    def entries(self):
+        return {
+            'embed.weight': ['F32', [3, 4], torch.randn(3, 4)],
+            'layers.0.bias': ['BF16', [5], torch.randn(5).to(torch.bfloat16)],
+            'layers.0.ids': ['I64', [2, 1, 2], torch.arange(4).reshape(2, 1, 2)],
+            'scale': ['F16', [], torch.tensor(0.5, dtype=torch.float16)],
+            'mask': ['BOOL', [3], torch.tensor([True, False, True])],
+        }
+
+    def test_header_gives_shapes_dtypes_and_offsets(self):
+        entries = self.entries()
+        data = safetensors(entries, metadata={'format': 'pt'})
+        tensors = trs.load_safetensors(self.serve(data))
+        self.assertEqual(list(tensors), list(reversed(entries)))
+        header_len = int.from_bytes(data[:8], 'little')
+        header = json.loads(data[8:8+header_len])
+        for name, [code, shape, expected] in entries.items():
+            tensor = tensors[name]
+            self.assertTrue(tensor.is_meta)
+            self.assertEqual([list(tensor.shape), tensor.dtype, tensor.remote_name], [shape, expected.dtype, name])
+            offset = tensor.remote_archive.storage_offset(name)
+            self.assertEqual(offset, 8 + header_len + header[name]['data_offsets'][0])
+            self.assertTrue(torch.equal(tensor.remote_fetch(), expected), name)
+        self.assertTensorsEqual(trs.fetch_many(tensors), {name: tensors[name].remote_fetch() for name in tensors})
+
+    def test_local_files_load_through_load(self):
+        entries = self.entries()
+        directory = tempfile.mkdtemp(prefix='httpfs_lm_test_')
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'model.safetensors')
+        with open(path, 'wb') as fh:
+            fh.write(safetensors(entries))
+        tensors = trs.load(path, manifest_dir=None)
+        for name, [code, shape, expected] in entries.items():
+            self.assertTrue(torch.equal(tensors[name].remote_fetch(), expected), name)
+
+    def test_unknown_dtype_names_the_tensor(self):
+        data = safetensors({'odd.weight': ['X7', [2], torch.zeros(2, dtype=torch.uint8)]})
+        with self.assertRaisesRegex(ValueError, 'odd.weight.*X7'):
+            trs.load_safetensors(self.serve(data))
+
+class ShardedTests(LoaderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp(prefix='httpfs_lm_test_')
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write(self, name, data):
+        with open(os.path.join(self.directory, name), 'wb') as fh:
+            fh.write(data)
+
+    def index(self, weight_map):
+        return json.dumps(dict(metadata=dict(total_size=0), weight_map=weight_map)).encode()
+
+    def test_shards_open_when_first_looked_up(self):
+        first, first_data = checkpoint(layers=2)
+        second = {'head.weight': torch.randn(6, 2)}
+        self.write('model-1.bin', first_data)
+        self.write('model-2.safetensors', safetensors({'head.weight': ['F32', [6, 2], second['head.weight']]}))
+        weight_map = dict({name: 'model-1.bin' for name in first}, **{'head.weight': 'model-2.safetensors'})
+        self.write('model.index.json', self.index(weight_map))
+        tensors = trs.load_sharded(os.path.join(self.directory, 'model.index.json'), manifest_dir=None)
+        self.assertEqual(tensors.opened_shards(), [])
+        self.assertEqual([len(tensors), list(tensors), tensors.metadata], [3, list(weight_map), dict(total_size=0)])
+        self.assertIn('head.weight', tensors)
+        self.assertNotIn('tail.weight', tensors)
+        self.assertEqual(tensors.opened_shards(), [])
+        self.assertTrue(torch.equal(tensors['head.weight'].remote_fetch(), second['head.weight']))
+        self.assertEqual(tensors.opened_shards(), ['model-2.safetensors'])
+        with self.assertRaises(KeyError):
+            tensors['tail.weight']
+        # filtering by name leaves the other shard unopened
+        fetched = dict(trs.iter_fetch(tensors, filter=['head.weight']))
+        self.assertEqual(list(fetched), ['head.weight'])
+        self.assertEqual(tensors.opened_shards(), ['model-2.safetensors'])
+        self.assertTensorsEqual(trs.fetch_many(tensors), dict(first, **second))
+        self.assertEqual(sorted(tensors.opened_shards()), ['model-1.bin', 'model-2.safetensors'])
+
+    def test_shards_of_a_url_are_found_next_to_the_index(self):
+        # shard names are oids, which the fake server serves beside the index
+        states = [{f'shard{idx}.weight': torch.randn(4)} for idx in range(2)]
+        weight_map = {}
+        for state in states:
+            buf = io.BytesIO()
+            torch.save(state, buf)
+            weight_map.update({name: self.fake.add(buf.getvalue()) for name in state})
+        tensors = trs.load_sharded(self.serve(self.index(weight_map)), manifest_dir=None)
+        self.assertEqual(tensors.opened_shards(), [])
+        self.assertTrue(torch.equal(tensors['shard1.weight'].remote_fetch(), states[1]['shard1.weight']))
+        self.assertEqual(tensors.opened_shards(), [weight_map['shard1.weight']])
+
+class ManifestTests(LoaderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.manifest_dir = tempfile.mkdtemp(prefix='httpfs_lm_test_manifests_')
+        self.addCleanup(shutil.rmtree, self.manifest_dir)
+
+    def load(self, url):
+        # load() with its unpickling counted
+        with unittest.mock.patch.object(trs, '_load', wraps=trs._load) as unpickle:
+            tensors = trs.load(url, manifest_dir=self.manifest_dir)
+        return tensors, unpickle.call_count
+
+    def test_repeat_load_reads_the_manifest(self):
+        state, data = checkpoint()
+        url = self.serve(data)
+        first, unpickled = self.load(url)
+        self.assertEqual(unpickled, 1)
+        [manifest_name] = os.listdir(self.manifest_dir)
+        manifest = trs._read_manifest(os.path.join(self.manifest_dir, manifest_name))
+        self.assertEqual(len(manifest['storages']), len(state))
+        second, unpickled = self.load(url)
+        self.assertEqual(unpickled, 0)
+        self.assertEqual(list(second), list(first))
+        for name, tensor in second.items():
+            self.assertTrue(tensor.is_meta)
+            self.assertEqual([tensor.shape, tensor.stride(), tensor.dtype], [first[name].shape, first[name].stride(), first[name].dtype])
+            self.assertEqual(tensor.remote_archive.storage_offset(tensor.remote_key), first[name].remote_archive.storage_offset(first[name].remote_key))
+        self.assertTensorsEqual(trs.fetch_many(second), state)
+        self.assertTensorsEqual({name: tensor.remote_fetch() for name, tensor in second.items()}, state)
+
+    def test_changed_etag_is_loaded_afresh(self):
+        state, data = checkpoint()
+        url = self.serve(data)
+        self.load(url)
+        with unittest.mock.patch.object(trs._HTTPFile, '_etag', return_value='"changed"'):
+            tensors, unpickled = self.load(url)
+        self.assertEqual(unpickled, 1)
+        self.assertEqual(len(os.listdir(self.manifest_dir)), 2)
+        self.assertTensorsEqual(trs.fetch_many(tensors), state)
+
+    def test_weak_etag_writes_no_manifest(self):
+        state, data = checkpoint()
+        with unittest.mock.patch.object(trs._HTTPFile, '_etag', return_value='W/"weak"'):
+            self.load(self.serve(data))
+        self.assertEqual(os.listdir(self.manifest_dir), [])
+
+    def test_other_versions_are_ignored(self):
+        state, data = checkpoint()
+        url = self.serve(data)
+        self.load(url)
+        [manifest_name] = os.listdir(self.manifest_dir)
+        path = os.path.join(self.manifest_dir, manifest_name)
+        manifest = trs._read_manifest(path)
+        manifest['version'] = trs.MANIFEST_VERSION + 1
+        with open(path, 'w') as fh:
+            json.dump(manifest, fh)
+        self.assertIsNone(trs._read_manifest(path))
+        tensors, unpickled = self.load(url)
+        self.assertEqual(unpickled, 1)
+        self.assertEqual(trs._read_manifest(path)['version'], trs.MANIFEST_VERSION)
+
+class HTTPFileTests(LoaderTestCase):
+    def open(self, url, **options):
+        file = trs._HTTPFile(url, **options)
+        self.addCleanup(file.close)
+        return file
+
+    def test_reads_match_the_source(self):
+        data = os.urandom(3 * trs.HTTP_MIN_BLOCK + 1234)
+        file = self.open(self.serve(data))
+        self.assertEqual([file.size, file.oid], [len(data), None])
+        self.assertEqual(file.etag, '"' + self.fake.add(data) + '"')
+        rng = random.Random(0)
+        for attempt in range(50):
+            start = rng.randrange(len(data))
+            size = rng.choice([1, 100, trs.HTTP_MIN_BLOCK, 2 * trs.HTTP_MIN_BLOCK])
+            size = min(size, len(data) - start)
+            self.assertEqual(trs._RemoteArchive._read_from(file, start, size), data[start:start+size], [start, size])
+        file.seek(0)
+        self.assertEqual(file.read(), data)
+        file.seek(-10, io.SEEK_END)
+        self.assertEqual([file.read(100), file.read(1)], [data[-10:], b''])
+
+    def test_block_grows_while_sequential_and_restarts_on_a_jump(self):
+        self.fake.latency = 0.01
+        data = os.urandom(64 * trs.HTTP_MIN_BLOCK)
+        file = self.open(self.serve(data))
+        self.assertEqual(file.read(100), data[:100])
+        self.assertEqual(file._block, trs.HTTP_MIN_BLOCK)
+        blocks = []
+        pos = 100
+        while pos < 8 * trs.HTTP_MIN_BLOCK:
+            chunk = file.read(1000)
+            self.assertEqual(chunk, data[pos:pos+len(chunk)])
+            pos += len(chunk)
+            blocks.append(file._block)
+        self.assertEqual(blocks, sorted(blocks))
+        self.assertGreater(blocks[-1], trs.HTTP_MIN_BLOCK)
+        # beyond anything buffered
+        file.seek(48 * trs.HTTP_MIN_BLOCK)
+        self.assertEqual(file.read(100), data[48*trs.HTTP_MIN_BLOCK:48*trs.HTTP_MIN_BLOCK+100])
+        self.assertEqual(file._block, trs.HTTP_MIN_BLOCK)
+
+    def test_block_is_bounded_by_the_bandwidth_delay_product(self):
+        file = self.open(self.serve(os.urandom(100)))
+        file.latency, file.throughput = 0.01, 100 * trs.HTTP_MIN_BLOCK
+        target = trs.HTTP_EFFICIENCY * file.latency * file.throughput
+        for step in range(20):
+            file._next_block(True)
+        self.assertEqual(file._block, int(target))
+        file.latency, file.throughput = 0.0001, 1000
+        self.assertEqual(file._next_block(True), trs.HTTP_MIN_BLOCK)
+        file.latency, file.throughput = 10, 10 * trs.HTTP_MAX_BLOCK
+        for step in range(20):
+            file._next_block(True)
+        self.assertEqual(file._block, trs.HTTP_MAX_BLOCK)
+        self.assertEqual(file._next_block(False), trs.HTTP_MIN_BLOCK)
+
+    def test_cached_blocks_are_not_fetched_again(self):
+        data = os.urandom(4 * trs.HTTP_MIN_BLOCK)
+        url = self.serve(data)
+        cache = BlockCache(None, len(data), trs.HTTP_MIN_BLOCK)
+        file = self.open(url, cache=cache)
+        self.assertEqual(file.oid, self.fake.add(data))
+        self.assertEqual(trs._RemoteArchive._read_from(file, 1000, 2 * trs.HTTP_MIN_BLOCK), data[1000:1000+2*trs.HTTP_MIN_BLOCK])
+        requests = self.fake.counts['object_requests']
+        again = self.open(url, cache=cache)
+        requests += 1 # its HEAD
+        self.assertEqual(trs._RemoteArchive._read_from(again, 1000, 2 * trs.HTTP_MIN_BLOCK), data[1000:1000+2*trs.HTTP_MIN_BLOCK])
+        self.assertEqual(self.fake.counts['object_requests'], requests)
+
+if __name__ == '__main__':
+    unittest.main()
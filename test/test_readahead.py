@@ -0,0 +1,124 @@
+# Tests of sequential read-ahead: when it starts, how deep it goes, and its share of the cache.
+#   python3 -m pytest -q test
+# or python3 -m unittest test.test_readahead, from the directory above this one.
+
+import concurrent.futures, time, types, unittest
+
+from .cache import BlockCache
+from .readahead import ReadAhead
+
+BLOCK = 4096
+
+class PrefetchRecorder:
+    # a remote file whose prefetches are recorded and left for the test to complete
+    def __init__(self, cache, nblocks):
+        self.remote = types.SimpleNamespace(cache=cache)
+        self.size = nblocks * BLOCK
+        self.requests = [] # [first block, end block, future]
+    def prefetch(self, first, end):
+        fut = concurrent.futures.Future()
+        self.requests.append([first, end, fut])
+        return fut
+    def ranges(self):
+        return [[first, end] for first, end, fut in self.requests]
+
+class ReadAheadTests(unittest.TestCase):
+    def readahead(self, file, **options):
+        readahead = ReadAhead(file, **options)
+        self.addCleanup(readahead.cancel)
+        return readahead
+
+    def test_starts_once_reads_are_sequential(self):
+        file = PrefetchRecorder(BlockCache(None, 64 * BLOCK, BLOCK), 32)
+        readahead = self.readahead(file, max_depth=4, chunk_blocks=2)
+        readahead.advise(BLOCK, 0)
+        self.assertEqual(file.ranges(), [])
+        readahead.advise(BLOCK, BLOCK)
+        self.assertEqual(file.ranges(), [[2, 4], [4, 6]])
+        # a jump ends the streak, so nothing more is started until reads follow each other again
+        readahead.advise(BLOCK, 20 * BLOCK)
+        self.assertEqual(file.ranges(), [[2, 4], [4, 6]])
+
+    def test_chunks_read_past_are_replaced(self):
+        file = PrefetchRecorder(BlockCache(None, 64 * BLOCK, BLOCK), 32)
+        readahead = self.readahead(file, max_depth=2, chunk_blocks=2)
+        readahead.advise(BLOCK, 0)
+        readahead.advise(BLOCK, BLOCK)
+        # completed chunks still count against the depth until the reader passes them
+        file.requests[0][2].set_result(None)
+        readahead.advise(BLOCK, 2 * BLOCK)
+        readahead.advise(BLOCK, 3 * BLOCK)
+        self.assertEqual(file.ranges(), [[2, 4], [4, 6]])
+        file.requests[1][2].set_result(None)
+        readahead.advise(BLOCK, 4 * BLOCK)
+        self.assertEqual(file.ranges(), [[2, 4], [4, 6], [6, 8]])
+
+    def test_stops_at_the_end_of_the_file(self):
+        file = PrefetchRecorder(BlockCache(None, 64 * BLOCK, BLOCK), 5)
+        readahead = self.readahead(file, max_depth=4, chunk_blocks=2)
+        readahead.advise(BLOCK, 0)
+        readahead.advise(BLOCK, BLOCK)
+        self.assertEqual(file.ranges(), [[2, 4], [4, 5]])
+
+    def test_depth_climbs_while_throughput_improves(self):
+        file = PrefetchRecorder(BlockCache(None, 64 * BLOCK, BLOCK), 32)
+        readahead = self.readahead(file, max_depth=8)
+        self.assertEqual(readahead.depth, 2)
+        def epoch(nbytes):
+            # an epoch of about a second that moved nbytes
+            readahead._epoch_start = time.monotonic() - 1
+            readahead._epoch_bytes = nbytes
+            readahead._adapt()
+            return readahead.depth
+        self.assertEqual(epoch(100), 3)
+        self.assertEqual(epoch(200), 4)
+        self.assertEqual(epoch(400), 5)
+        # a drop turns back, a plateau holds, and a second plateau probes upward again
+        self.assertEqual(epoch(200), 4)
+        self.assertEqual(epoch(205), 4)
+        self.assertEqual(epoch(206), 5)
+
+    def test_depth_stays_within_bounds(self):
+        file = PrefetchRecorder(BlockCache(None, 64 * BLOCK, BLOCK), 32)
+        readahead = self.readahead(file, max_depth=3)
+        for nbytes in [100, 200, 400, 800, 1600]:
+            readahead._epoch_start = time.monotonic() - 1
+            readahead._epoch_bytes = nbytes
+            readahead._adapt()
+            self.assertLessEqual(readahead.depth, 3)
+        self.assertEqual(readahead.depth, 3)
+        readahead._direction = -1
+        for nbytes in [3200, 6400, 12800]:
+            readahead._epoch_start = time.monotonic() - 1
+            readahead._epoch_bytes = nbytes
+            readahead._adapt()
+        self.assertEqual(readahead.depth, 1)
+
+    def test_kept_within_a_share_of_the_budget(self):
+        # half of an 8 block budget leaves room for two chunks of two blocks ahead of the reader
+        cache = BlockCache(None, 8 * BLOCK, BLOCK)
+        file = PrefetchRecorder(cache, 32)
+        readahead = self.readahead(file, max_depth=16, chunk_blocks=2)
+        readahead.depth = 16
+        readahead.advise(BLOCK, 0)
+        readahead.advise(BLOCK, BLOCK)
+        self.assertEqual(file.ranges(), [[2, 4], [4, 6]])
+        # another handle of the same cache may still start one chunk, but no more
+        other_file = PrefetchRecorder(cache, 32)
+        other = self.readahead(other_file, max_depth=16, chunk_blocks=2)
+        other.depth = 16
+        other.advise(BLOCK, 0)
+        other.advise(BLOCK, BLOCK)
+        self.assertEqual(other_file.ranges(), [[2, 4]])
+        # the reserved share is released by reading on and by closing
+        other.cancel()
+        for first, end, fut in file.requests:
+            fut.set_result(None)
+        readahead.advise(BLOCK, 2 * BLOCK)
+        readahead.advise(BLOCK, 3 * BLOCK)
+        self.assertEqual(file.ranges(), [[2, 4], [4, 6], [6, 8]])
+        readahead.cancel()
+        self.assertEqual(ReadAhead._reserved[cache], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+# Tests of fetching through Remote: single flight, the fetch engine's completions,
+# incremental verification and hydration.
+#   python3 -m pytest -q test
+# or python3 -m unittest test.test_remote, from the directory above this one.
+# Tests serving a repository from the fake lfs server need git.
+
+import concurrent.futures, hashlib, os, shutil, threading, time, unittest
+
+from .cache import BlockCache
+from .remote import Remote, RemoteFile
+from .stats import Stats
+
+BLOCK = 4096
+
+class MemoryTransport:
+    def __init__(self, data):
+        self.data = data
+    def get_range(self, url, start, stop, headers={}, retries=None):
+        return self.data[start:stop]
+
+class HeldEngine:
+    # completes the ranges submitted to it once released, from threads of its own
+    def __init__(self, data):
+        self.data = data
+        self.released = threading.Event()
+    def submit(self, url, start, stop, headers={}, retries=None):
+        fut = concurrent.futures.Future()
+        def complete():
+            self.released.wait()
+            fut.set_result(self.data[start:stop])
+        threading.Thread(target=complete, daemon=True).start()
+        return fut
+
+class MemoryFile(RemoteFile):
+    # a file of data, verified against the digest of expected if given
+    def __init__(self, remote, data, key='k', expected=None):
+        self.remote = remote
+        self.size = len(data)
+        self.cache_key = key
+        self.href = 'memory'
+        self.headers = {}
+        self.lock = threading.Lock()
+        self.stats = Stats(remote.stats)
+        self._init_verification('sha256', hashlib.sha256(data if expected is None else expected).hexdigest())
+        self._init_hydration()
+    def _ensure_remote(self):
+        pass
+
+def memory_remote(data, **options):
+    return Remote(transport=MemoryTransport(data), cache=BlockCache(None, 64 * BLOCK, BLOCK), **options)
+
+class SingleFlightTests(unittest.TestCase):
+    def test_claim_and_settle(self):
+        remote = Remote(cache=BlockCache(None, 16 * BLOCK, BLOCK))
+        self.addCleanup(remote.executor.shutdown)
+        remote.cache.put('k', 0, b'cached')
+        owned, waiting = remote._claim('k', [0, 1, 2])
+        self.assertEqual(owned, [1, 2])
+        self.assertEqual(waiting, {})
+        owned, waiting = remote._claim('k', [1, 2, 3])
+        self.assertEqual(owned, [3])
+        self.assertEqual(set(waiting), {1, 2})
+        remote._settle('k', [1, 2], [b'one', b'two'])
+        self.assertEqual(waiting[1].result(0), b'one')
+        self.assertEqual(waiting[2].result(0), b'two')
+        owned, waiting = remote._claim('k', [3])
+        self.assertEqual(owned, [])
+        remote._settle('k', [3], exception=OSError('refused'))
+        with self.assertRaises(OSError):
+            waiting[3].result(0)
+        # settled blocks are claimable again
+        owned, waiting = remote._claim('k', [3])
+        self.assertEqual(owned, [3])
+        remote._settle('k', [3], [b'three'])
+
+    @unittest.skipIf(shutil.which('git') is None, 'needs git')
+    def test_concurrent_readers_fetch_once(self):
+        from .bench import fake_repo
+        from .fake_lfs import FakeLFS
+        from .repo import Repo
+        fake = FakeLFS(latency=0.01).start()
+        self.addCleanup(fake.stop)
+        size = 4 * 1024 * 1024 + 1000
+        data = os.urandom(size)
+        path = fake_repo(fake, {'data.bin': data})
+        self.addCleanup(shutil.rmtree, path)
+        repo = Repo(path, cache=BlockCache(None, 2 * size, 64 * 1024), readahead=0)
+        file = repo.get_by_path(os.path.join(path, 'data.bin'))
+        handles = [file.open() for _ in range(8)]
+        self.assertEqual(file.size, size)
+        sent = fake.counts['bytes_sent']
+        barrier = threading.Barrier(len(handles))
+        def read(handle):
+            barrier.wait()
+            chunks = []
+            for offset in range(0, size, 256 * 1024):
+                chunks.append(handle.read(256 * 1024, offset))
+            return b''.join(chunks)
+        with concurrent.futures.ThreadPoolExecutor(len(handles)) as executor:
+            results = list(executor.map(read, handles))
+        for handle in handles:
+            handle.close()
+        for result in results:
+            self.assertEqual(result, data)
+        self.assertEqual(fake.counts['bytes_sent'] - sent, size)
+
+class EngineTests(unittest.TestCase):
+    def test_completions_do_not_queue_behind_readers(self):
+        # a reader waiting on prefetched blocks holds the only executor thread
+        data = os.urandom(4 * BLOCK)
+        engine = HeldEngine(data)
+        remote = memory_remote(data, workers=1, engine=engine)
+        self.addCleanup(remote.executor.shutdown, wait=False)
+        file = MemoryFile(remote, data)
+        prefetched = file.prefetch(0, 4)
+        reader = remote.executor.submit(file._blocks, 0, 4)
+        engine.released.set()
+        self.assertEqual(b''.join(reader.result(5)), data)
+        prefetched.result(5)
+
+    def test_failed_prefetch_releases_its_claims(self):
+        data = os.urandom(4 * BLOCK)
+        remote = memory_remote(data, engine=HeldEngine(data))
+        self.addCleanup(remote.executor.shutdown)
+        file = MemoryFile(remote, data)
+        def no_sources():
+            raise OSError('no sources')
+        file._sources = no_sources
+        with self.assertRaises(OSError):
+            file.prefetch(0, 4)
+        owned, waiting = remote._claim('k', range(4))
+        self.assertEqual(owned, [0, 1, 2, 3])
+        self.assertEqual(waiting, {})
+        remote._settle('k', owned, exception=OSError('unused'))
+
+class VerificationTests(unittest.TestCase):
+    def file(self, data, expected=None):
+        remote = memory_remote(data, readahead=0)
+        self.addCleanup(remote.executor.shutdown)
+        return MemoryFile(remote, data, expected=expected)
+
+    def test_sequential_reads_verify(self):
+        data = os.urandom(5 * BLOCK + 100)
+        file = self.file(data)
+        for offset in range(0, len(data), 1000):
+            self.assertEqual(file.read(1000, offset), data[offset:offset+1000])
+            if offset + 1000 < len(data):
+                self.assertEqual(file.verification, 'pending')
+        self.assertEqual(file.verification, 'verified')
+        self.assertEqual(file.hashed, len(data))
+
+    def test_blocks_read_ahead_of_the_hash_are_hashed(self):
+        data = os.urandom(5 * BLOCK + 100)
+        file = self.file(data)
+        file.read(2 * BLOCK, 3 * BLOCK)
+        file.read(100, 5 * BLOCK)
+        self.assertEqual(file.hashed, 0)
+        file.read(3 * BLOCK, 0)
+        self.assertEqual(file.verification, 'verified')
+
+    def test_corrupt_blocks_are_discarded(self):
+        data = os.urandom(3 * BLOCK)
+        file = self.file(data, expected=os.urandom(len(data)))
+        file.read(len(data), 0)
+        self.assertEqual(file.verification, 'corrupt')
+        self.assertEqual(file.hashed, 0)
+        self.assertFalse(any(file.remote.cache.contains('k', idx) for idx in range(3)))
+
+@unittest.skipIf(shutil.which('git') is None, 'needs git')
+class HydrationTests(unittest.TestCase):
+    def hydrate(self, data, served=None):
+        # hydrates a file of data from the fake lfs server, serving served in its place if given
+        from .bench import fake_repo
+        from .fake_lfs import FakeLFS
+        from .repo import Repo
+        fake = FakeLFS().start()
+        self.addCleanup(fake.stop)
+        path = fake_repo(fake, {'data.bin': data})
+        self.addCleanup(shutil.rmtree, path)
+        if served is not None:
+            fake.objects[hashlib.sha256(data).hexdigest()] = served
+        repo = Repo(path, cache=BlockCache(None, 64 * BLOCK, BLOCK), readahead=0)
+        file = repo.get_by_path(os.path.join(path, 'data.bin'))
+        file.HYDRATE_RANGE = 1024 * 1024
+        handle = file.open()
+        self.addCleanup(handle.close)
+        sent = fake.counts['bytes_sent']
+        file.hydrate()
+        deadline = time.monotonic() + 10
+        while file.hydration == 'running' and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return file, handle, fake.counts['bytes_sent'] - sent
+
+    def test_streams_past_the_cache(self):
+        data = os.urandom(3 * 1024 * 1024 + 1000)
+        file, handle, sent = self.hydrate(data)
+        self.assertEqual(file.hydration, 'done')
+        self.assertEqual(file.verification, 'verified')
+        self.assertEqual(sent, len(data))
+        self.assertEqual(file.remote.cache.used, 0)
+        with open(file.hydrate_path, 'rb') as fh:
+            self.assertEqual(fh.read(), data)
+        self.assertIsNotNone(file.fd)
+        self.assertEqual(handle.read(100, len(data) - 100), data[-100:])
+
+    def test_digest_mismatch_fails(self):
+        data = os.urandom(2 * 1024 * 1024)
+        file, handle, sent = self.hydrate(data, served=os.urandom(len(data)))
+        self.assertEqual(file.hydration, 'failed')
+        self.assertEqual(file.verification, 'corrupt')
+        self.assertFalse(os.path.exists(file.hydrate_path))
+        self.assertEqual(os.listdir(file.hydrate_tmp_dir), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# HTTP transport shared by every thread of a mount.
+# requests.Session keeps cookies and other mutable state and is not meant to be
+# shared between threads, so each thread gets its own sessions. The sessions are
+# mounted on adapters shared by all threads, whose urllib3 pools are thread-safe:
+# one for batch-API calls and one for object downloads, each keeping up to
+# pool_size keep-alive connections per host. Reusing pooled connections also
+# reuses their established TLS sessions.
+# Requests refused with 429 or 503 are retried after the server's Retry-After, or
+# with exponential backoff when it gives none; requests that time out or lose their
+# connection are retried with the backoff. Every request has a (connect, read) timeout,
+# the read one bounding each wait for data rather than the whole response.
+
+import email.utils, threading, time
+import requests, requests.adapters
+
+def retry_after(headers):
+    # seconds the server asks to wait in a headers mapping's Retry-After, in seconds or as a date, or None
+    value = headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+
+class Transport:
+    BATCH_POOL_SIZE = 4
+    DOWNLOAD_POOL_SIZE = 32
+    HOSTS = 16
+    RETRIES = 5
+    RETRY_STATUSES = [429, 503]
+    BACKOFF = 0.5 # seconds before the first retry without Retry-After, doubling after
+    MAX_RETRY_AFTER = 60
+    TIMEOUT = (10, 60) # seconds to connect, and between bytes received
+    def __init__(self, batch_pool_size=BATCH_POOL_SIZE, download_pool_size=DOWNLOAD_POOL_SIZE, hosts=HOSTS, timeout=TIMEOUT):
+        self.timeout = timeout
+        self.adapters = {
+            'batch': requests.adapters.HTTPAdapter(pool_connections=hosts, pool_maxsize=batch_pool_size, pool_block=True),
+            'download': requests.adapters.HTTPAdapter(pool_connections=hosts, pool_maxsize=download_pool_size, pool_block=True),
+        }
+        self._local = threading.local()
+
+    def session(self, kind):
+        sessions = getattr(self._local, 'sessions', None)
+        if sessions is None:
+            sessions = {}
+            self._local.sessions = sessions
+        session = sessions.get(kind)
+        if session is None:
+            session = requests.Session()
+            adapter = self.adapters[kind]
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            sessions[kind] = session
+        return session
+
+    @classmethod
+    def retry_delay(cls, headers, attempt):
+        # seconds before retrying a refused request; headers may be None for a failed one
+        delay = None if headers is None else retry_after(headers)
+        if delay is not None:
+            return min(max(delay, 0), cls.MAX_RETRY_AFTER)
+        return cls.BACKOFF * 2 ** attempt
+
+    def request(self, kind, method, url, retries=None, **kwparams):
+        # retries defaults to RETRIES; callers with somewhere else to go may pass 0
+        retries = self.RETRIES if retries is None else retries
+        kwparams.setdefault('timeout', self.timeout)
+        for attempt in range(retries + 1):
+            try:
+                resp = self.session(kind).request(method, url, **kwparams)
+            except (requests.Timeout, requests.ConnectionError):
+                if attempt == retries:
+                    raise
+                time.sleep(self.retry_delay(None, attempt))
+                continue
+            if resp.status_code not in self.RETRY_STATUSES or attempt == retries:
+                return resp
+            resp.close()
+            time.sleep(self.retry_delay(resp.headers, attempt))
+
+    def batch(self, url, **kwparams):
+        return self.request('batch', 'POST', url, **kwparams)
+
+    def get(self, url, **kwparams):
+        return self.request('download', 'GET', url, **kwparams)
+
+    def get_range(self, url, start, stop, headers={}, retries=None):
+        resp = self.get(url, headers={**headers, 'Range': 'bytes='+str(start)+'-'+str(stop-1)}, retries=retries)
+        resp.raise_for_status()
+        content = resp.content
+        if resp.status_code != 206 and len(content) != stop - start:
+            # server ignored the range
+            content = content[start:stop]
+        return content
+
+    def close(self):
+        for adapter in self.adapters.values():
+            adapter.close()
@@ -1,10 +1,22 @@
+import collections
+import collections.abc
+import concurrent.futures
+import ctypes
 import functools
+import hashlib
+import json
+import mmap
+import re
+import time
 import trace
 
 import torch
 import io
 import os
 import pickle
+import threading
+import warnings
+import zipfile
 from typing import Any, BinaryIO, Callable, cast, Dict, Optional, Type, Tuple, Union, IO
 from torch.serialization import (
     FILE_LIKE, MAP_LOCATION,
@@ -18,14 +30,49 @@ from torch.serialization import (
 
 # returns meta tensors where tensor.remote_fetch() makes a real one that actually reads the data
 # and tensor.remote_name contains the data filename in the zip
+# fetch_many(tensors) materializes many at once, reading their records in file order
+# iter_fetch(tensors) does the same on a thread pool, yielding tensors as they finish
+# load_safetensors(f) returns the same kind of meta tensors for a .safetensors file, reading only its header
+# load_sharded(index) returns one lazy state dict over the shards of a *.index.json, opening shards on first use
+# iter_layers(tensors) materializes one module group at a time, prefetching the next, for offloaded inference
 # note: you might be able to pass an http remote fileobject to load(), but i've only tried/troubleshooted local filepaths
 
+# http urls are read by range requests sized per access: small where reads jump around,
+# as in the zip directory and pickle, growing while reads are sequential until a request
+# takes long enough to hide its round trip at the measured throughput
+# load(..., engine=engine) sends them through a fetch engine instead, anything with
+# submit(url, start, stop, headers) returning a concurrent future of the bytes, such as
+# test.fetch_engine.FetchEngine; merged reads of tensors are then split into
+# ENGINE_PIECE requests that are all in flight at once
+# load(..., cache=cache) keeps the bytes read from urls in a block cache, such as
+# test.cache.SharedBlockCache, so other processes loading or mounting the same content
+# reuse them; content is told by its etag, which on the hub is the lfs oid a mount uses
+# refused and failed requests are retried, with timeouts, as test.transport.Transport does
+
+# a manifest of every tensor's shape, dtype and record offset is cached per file content,
+# so a later load() of the same content skips the zip directory and unpickling
+
+MERGE_GAP = 1024*1024 # records closer than this are read together, gap included
+MAX_SPAN = 256*1024*1024 # bytes read at most in one merged read
+WORKERS = 8
+LAYER_PATTERN = r'^(.*?\.\d+)\.' # a group per numbered module, e.g. transformer.h.3.
+MAX_INFLIGHT_BYTES = 1024*1024*1024 # bytes being read or awaiting the consumer in iter_fetch
+MANIFEST_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'httpfs_lm', 'manifests')
+MANIFEST_VERSION = 1
+HTTP_MIN_BLOCK = 64*1024 # bytes fetched for a read that does not follow the last one
+HTTP_MAX_BLOCK = 64*1024*1024
+HTTP_EFFICIENCY = 8 # sequential requests grow to this many bandwidth-delay products
+ENGINE_PIECE = 8*1024*1024
+
 def load(
     f: FILE_LIKE,
     map_location: MAP_LOCATION = None,
     pickle_module: Any = None,
     *,
     weights_only: bool = False,
+    manifest_dir: Optional[str] = MANIFEST_DIR,
+    engine: Any = None,
+    cache: Any = None,
     **pickle_load_args: Any
 ) -> Any:
     # Reference: https://github.com/pytorch/pytorch/issues/54354
@@ -119,6 +166,8 @@ def load(
         >>> torch.load('module.pt', encoding='ascii')
     """
     torch._C._log_api_usage_once("torch.load")
+    if isinstance(f, (str, os.PathLike)) and os.fspath(f).endswith('.safetensors'):
+        return load_safetensors(f, map_location, engine=engine, cache=cache)
     UNSAFE_MESSAGE = (
         "Weights only load failed. Re-running `torch.load` with `weights_only` set to `False`"
         " will likely succeed, but it can result in arbitrary code execution."
@@ -140,8 +189,15 @@ def load(
     if 'encoding' not in pickle_load_args.keys():
         pickle_load_args['encoding'] = 'utf-8'
 
+    opened_file = _open_file_like(f, 'rb', engine, cache).__enter__()
+    content_id = manifest_dir and _content_id(f, opened_file)
+    if content_id:
+        manifest_path = os.path.join(manifest_dir, hashlib.sha256(content_id.encode()).hexdigest() + '.json')
+        manifest = _read_manifest(manifest_path)
+        if manifest is not None:
+            return _load_manifest(manifest, opened_file, map_location, source=f, engine=engine, cache=cache)
+
     if True:
-        opened_file = _open_file_like(f, 'rb').__enter__()
         if _is_zipfile(opened_file):
             # The zipfile reader is going to advance the current file position.
             # If we want to actually tail call to torch.jit.load, we need to
@@ -157,10 +213,16 @@ def load(
                     return torch.jit.load(opened_file, map_location=map_location)
                 if weights_only:
                     try:
-                        return _load(opened_zipfile, map_location, _weights_only_unpickler, **pickle_load_args)
+                        result = _load(opened_zipfile, map_location, _weights_only_unpickler, opened_file=opened_file, source=f, engine=engine, cache=cache, **pickle_load_args)
+                        if content_id:
+                            _write_manifest(manifest_path, result)
+                        return result
                     except RuntimeError as e:
                         raise pickle.UnpicklingError(UNSAFE_MESSAGE + str(e)) from None
-                return _load(opened_zipfile, map_location, pickle_module, **pickle_load_args)
+                result = _load(opened_zipfile, map_location, pickle_module, opened_file=opened_file, source=f, engine=engine, cache=cache, **pickle_load_args)
+                if content_id:
+                    _write_manifest(manifest_path, result)
+                return result
         if weights_only:
             try:
                 return _legacy_load(opened_file, map_location, _weights_only_unpickler, **pickle_load_args)
@@ -168,15 +230,571 @@ def load(
                 raise pickle.UnpicklingError(UNSAFE_MESSAGE + str(e)) from None
         return _legacy_load(opened_file, map_location, pickle_module, **pickle_load_args)
 
-def _load(zip_file, map_location, pickle_module, pickle_file='data.pkl', **pickle_load_args):
+def fetch_many(tensors, merge_gap=MERGE_GAP, max_span=MAX_SPAN):
+    # materializes many remote tensors from load() at once
+    # tensors is a dict of name -> tensor, or an iterable of tensors keyed by remote_name in the result
+    # records are read in offset order, with records closer than merge_gap read together
+    if isinstance(tensors, collections.abc.Mapping):
+        items = list(tensors.items())
+    else:
+        items = [[tensor.remote_name, tensor] for tensor in tensors]
+    archive_records = {}
+    for name, tensor in items:
+        archive = getattr(tensor, 'remote_archive', None)
+        if archive is not None:
+            archive_records.setdefault(archive, {})[tensor.remote_key] = tensor.remote_storage
+    storages = {}
+    for archive, records in archive_records.items():
+        for key, storage in archive.load_storages(records, merge_gap, max_span).items():
+            storages[archive, key] = storage
+    result = {}
+    for name, tensor in items:
+        archive = getattr(tensor, 'remote_archive', None)
+        if archive is None:
+            result[name] = tensor
+        else:
+            result[name] = tensor.remote_rebuild(storages[archive, tensor.remote_key])
+    return result
+
+def iter_fetch(tensors, filter=None, workers=WORKERS, max_inflight_bytes=MAX_INFLIGHT_BYTES, merge_gap=MERGE_GAP, max_span=MAX_SPAN):
+    # materializes remote tensors from load() on a pool of worker threads, yielding (name, tensor) as each is ready
+    # tensors is as for fetch_many; filter is a callable or a collection of names to restrict it to
+    # merged reads are submitted in offset order while their bytes, plus those of finished tensors
+    # not yet taken by the consumer, stay within max_inflight_bytes
+    if filter is not None and not callable(filter):
+        filter = set(filter).__contains__
+    if isinstance(tensors, collections.abc.Mapping):
+        # filtering names first leaves lazily opened shards unopened
+        items = [[name, tensors[name]] for name in tensors if filter is None or filter(name)]
+    else:
+        items = [[tensor.remote_name, tensor] for tensor in tensors if filter is None or filter(tensor.remote_name)]
+    max_span = min(max_span, max_inflight_bytes)
+    jobs = collections.deque()
+    archive_records = {}
+    for name, tensor in items:
+        archive = getattr(tensor, 'remote_archive', None)
+        if archive is None:
+            yield name, tensor
+            continue
+        records = archive_records.setdefault(archive, {})
+        record = records.get(tensor.remote_key)
+        if record is None:
+            dtype, nbytes, location = tensor.remote_storage
+            record = [archive.storage_offset(tensor.remote_key), nbytes, tensor.remote_key, []]
+            records[tensor.remote_key] = record
+        record[3].append([name, tensor])
+    for archive, records in archive_records.items():
+        for start, end, extents in _spans(records.values(), merge_gap, max_span):
+            jobs.append([archive, start, end, extents])
+    def run(archive, start, end, extents):
+        ready = []
+        for [offset, nbytes, key, named_tensors], untyped in zip(extents, archive.read_storages(start, end, extents)):
+            dtype, nbytes, location = named_tensors[0][1].remote_storage
+            storage = archive.storage(untyped, dtype, location)
+            ready.extend([[name, tensor.remote_rebuild(storage)] for name, tensor in named_tensors])
+        return ready
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        inflight = 0
+        try:
+            while jobs or pending:
+                while jobs and len(pending) < workers and (not pending or inflight + jobs[0][2] - jobs[0][1] <= max_inflight_bytes):
+                    job = jobs.popleft()
+                    pending[executor.submit(run, *job)] = job[2] - job[1]
+                    inflight += job[2] - job[1]
+                done, not_done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for fut in done:
+                    for name, tensor in fut.result():
+                        yield name, tensor
+                    inflight -= pending.pop(fut)
+        finally:
+            for fut in pending:
+                fut.cancel()
+
+def layer_groups(names, pattern=LAYER_PATTERN):
+    # prefix -> names, in order of first appearance
+    # names matching pattern group by its first group; others group by their parent module
+    regex = re.compile(pattern)
+    groups = {}
+    for name in names:
+        match = regex.match(name)
+        prefix = match.group(1) if match else name.rsplit('.', 1)[0]
+        groups.setdefault(prefix, []).append(name)
+    return groups
+
+def iter_layers(tensors, window=2, pattern=LAYER_PATTERN, **fetch_args):
+    # yields (prefix, {name: tensor}) for each group of layer_groups, materialized with fetch_many
+    # while the consumer holds one group the following window-1 are fetched in the background;
+    # nothing else is kept, so once the consumer drops a group its memory is released
+    groups = list(layer_groups(tensors, pattern).items())
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, window - 1)) as executor:
+        pending = collections.deque()
+        next_group = 0
+        try:
+            while pending or next_group < len(groups):
+                while next_group < len(groups) and len(pending) < window:
+                    prefix, names = groups[next_group]
+                    selected = {name: tensors[name] for name in names}
+                    pending.append([prefix, executor.submit(fetch_many, selected, **fetch_args)])
+                    next_group += 1
+                prefix, fut = pending.popleft()
+                group = fut.result()
+                del fut
+                yield prefix, group
+                del group
+        finally:
+            for prefix, fut in pending:
+                fut.cancel()
+
+def _spans(extents, merge_gap=MERGE_GAP, max_span=MAX_SPAN):
+    # groups (offset, nbytes, item) extents into [start, end, extents] reads, sorted by offset
+    spans = []
+    for extent in sorted(extents, key=lambda extent: extent[0]):
+        offset, nbytes = extent[:2]
+        if spans and offset - spans[-1][1] <= merge_gap and offset + nbytes - spans[-1][0] <= max_span:
+            spans[-1][1] = max(spans[-1][1], offset + nbytes)
+            spans[-1][2].append(extent)
+        else:
+            spans.append([offset, offset + nbytes, [extent]])
+    return spans
+
+def _content_id(f, opened_file=None):
+    # a string identifying the content of f, or None if it cannot be told cheaply
+    # urls are told by the etag that opening them found
+    if isinstance(f, os.PathLike):
+        f = os.fspath(f)
+    if type(f) is not str:
+        return None
+    if f.startswith('http'):
+        etag = getattr(opened_file, 'etag', None)
+        if etag is None or etag.startswith('W/'):
+            return None
+        return 'etag:' + f + ':' + etag
+    try:
+        # files on an httpfs_lm mount expose their lfs oid
+        return 'sha256:' + os.getxattr(f, 'user.oid_short').decode()
+    except (OSError, AttributeError):
+        pass
+    try:
+        st = os.stat(f)
+    except OSError:
+        return None
+    return 'stat:' + os.path.realpath(f) + ':' + str(st.st_size) + ':' + str(st.st_mtime_ns)
+
+class _Unrepresentable(Exception):
+    pass
+
+def _encode_manifest_tree(obj, keys):
+    # returns obj as json, adding the storage keys of its tensors to keys
+    if isinstance(obj, torch.Tensor):
+        params = getattr(obj, 'remote_params', None)
+        if params is None:
+            raise _Unrepresentable(obj)
+        keys.add(obj.remote_key)
+        storage_offset, size, stride, requires_grad = params
+        return {'tensor': [obj.remote_key, storage_offset, list(size), list(stride), requires_grad]}
+    if type(obj) in [dict, collections.OrderedDict]:
+        return {
+            'dict': [[_encode_manifest_tree(key, keys), _encode_manifest_tree(val, keys)] for key, val in obj.items()],
+            'ordered': type(obj) is collections.OrderedDict,
+        }
+    if type(obj) in [list, tuple]:
+        return {type(obj).__name__: [_encode_manifest_tree(item, keys) for item in obj]}
+    if obj is None or type(obj) in [bool, int, float, str]:
+        return obj
+    raise _Unrepresentable(obj)
+
+def _decode_manifest_tree(node, make_tensor):
+    if type(node) is not dict:
+        return node
+    if 'tensor' in node:
+        return make_tensor(*node['tensor'])
+    if 'dict' in node:
+        items = [[_decode_manifest_tree(key, make_tensor), _decode_manifest_tree(val, make_tensor)] for key, val in node['dict']]
+        return collections.OrderedDict(items) if node['ordered'] else dict(items)
+    if 'list' in node:
+        return [_decode_manifest_tree(item, make_tensor) for item in node['list']]
+    return tuple([_decode_manifest_tree(item, make_tensor) for item in node['tuple']])
+
+def _write_manifest(path, result):
+    # records result's structure and every tensor's storage, including absolute offsets
+    # results holding anything besides containers, primitives and plain tensors are not recorded
+    keys = set()
+    try:
+        tree = _encode_manifest_tree(result, keys)
+    except _Unrepresentable:
+        return
+    storages = {}
+    try:
+        for tensor in _iter_tensors(result):
+            key = tensor.remote_key
+            if key in storages:
+                continue
+            dtype, nbytes, location = tensor.remote_storage
+            storages[key] = dict(
+                dtype=str(dtype).split('.')[-1],
+                nbytes=nbytes,
+                location=location,
+                offset=tensor.remote_archive.record_offset(f'data/{key}'),
+            )
+        manifest = dict(version=MANIFEST_VERSION, tree=tree, storages=storages)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'w') as fh:
+            json.dump(manifest, fh)
+        os.replace(tmp_path, path)
+    except (OSError, KeyError, RuntimeError):
+        pass # the manifest is only an optimization
+
+def _read_manifest(path):
+    try:
+        with open(path) as fh:
+            manifest = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+def _iter_tensors(obj):
+    if isinstance(obj, torch.Tensor):
+        yield obj
+    elif isinstance(obj, dict):
+        for val in obj.values():
+            yield from _iter_tensors(val)
+    elif type(obj) in [list, tuple]:
+        for item in obj:
+            yield from _iter_tensors(item)
+
+def _load_manifest(manifest, opened_file, map_location, source=None, engine=None, cache=None):
+    # builds the meta tensor tree of a previous load() without reading the zip directory or data.pkl
+    storages = {
+        key: [getattr(torch, entry['dtype']), entry['nbytes'], entry['location']]
+        for key, entry in manifest['storages'].items()
+    }
+    archive = _RemoteArchive(opened_file, None, _get_restore_location(map_location), offsets={
+        f'data/{key}': entry['offset']
+        for key, entry in manifest['storages'].items()
+    }, source=source, engine=engine, cache=cache)
+    meta_storages = {}
+    def make_tensor(key, storage_offset, size, stride, requires_grad):
+        dtype, nbytes, location = storages[key]
+        meta_storage = meta_storages.get(key)
+        if meta_storage is None:
+            meta_storage = torch.TypedStorage(nbytes // torch._utils._element_size(dtype), dtype=dtype, device='meta', _internal=True)
+            meta_storages[key] = meta_storage
+        def rebuild(typed_storage):
+            return torch._utils._rebuild_tensor_v2(typed_storage, storage_offset, tuple(size), tuple(stride), requires_grad, collections.OrderedDict())
+        tensor = rebuild(meta_storage)
+        tensor.remote_fetch = lambda: rebuild(archive.load_storages({key: storages[key]})[key])
+        tensor.remote_name = f'data/{key}'
+        tensor.remote_archive = archive
+        tensor.remote_key = key
+        tensor.remote_storage = tuple(storages[key])
+        tensor.remote_rebuild = rebuild
+        tensor.remote_params = (storage_offset, tuple(size), tuple(stride), requires_grad)
+        return tensor
+    return _decode_manifest_tree(manifest['tree'], make_tensor)
+
+class _RemoteArchive:
+    # the zip file that the remote tensors of one load() read from
+    # offsets, when known in advance, map record names to absolute offsets and zip_file may be None
+    # source is what load() was given; urls are reopened per thread so reads can run in parallel,
+    # or with an engine, read in pieces that are all requested at once
+    def __init__(self, opened_file, zip_file, restore_location, offsets=None, source=None, engine=None, cache=None):
+        self.file = opened_file
+        self.engine = engine
+        self.cache = cache
+        self.zip_file = zip_file
+        self.restore_location = restore_location
+        self.lock = threading.Lock() # the zip reader and raw reads share the file position
+        self._offsets = offsets
+        self.source = source
+        self._local = threading.local()
+        try:
+            self._fileno = opened_file.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            self._fileno = None
+        # local and mounted files are mapped copy-on-write, so cpu storages can view the file's pages
+        self._mmap = None
+        if self._fileno is not None:
+            try:
+                self._mmap = mmap.mmap(self._fileno, 0, access=mmap.ACCESS_COPY)
+            except (OSError, ValueError):
+                pass
+
+    def record_offset(self, name):
+        with self.lock:
+            if self._offsets is None and hasattr(self.zip_file, 'get_record_offset'):
+                return self.zip_file.get_record_offset(name)
+            # older torch: find the data behind the local file header
+            if self._offsets is None:
+                self.file.seek(0)
+                with zipfile.ZipFile(self.file) as zf:
+                    self._offsets = {}
+                    for info in zf.infolist():
+                        self.file.seek(info.header_offset + 26)
+                        name_len, extra_len = [int.from_bytes(self.file.read(2), 'little') for field in range(2)]
+                        record = info.filename.split('/', 1)[-1]
+                        self._offsets[record] = info.header_offset + 30 + name_len + extra_len
+        return self._offsets[name]
+
+    def storage_offset(self, key):
+        return self.record_offset(f'data/{key}')
+
+    @staticmethod
+    def _read_from(file, offset, size):
+        file.seek(offset)
+        chunks = []
+        while size:
+            chunk = file.read(size)
+            if not chunk:
+                raise EOFError(offset, size)
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def read_storages(self, start, end, extents):
+        # untyped storages for the (offset, nbytes, ...) extents within [start, end), in order
+        # mapped files give views of the mapping; others are read straight into preallocated storages
+        if self._mmap is not None:
+            return [
+                torch.frombuffer(self._mmap, dtype=torch.uint8, count=nbytes, offset=offset).untyped_storage()
+                if nbytes else torch.UntypedStorage(0)
+                for offset, nbytes, *_ in extents
+            ]
+        if self.engine is not None and isinstance(self.file, _HTTPFile):
+            return self._engine_read_storages(start, end, extents)
+        if type(self.source) is str and self.source.startswith('http'):
+            file = getattr(self._local, 'file', None)
+            if file is None:
+                file = _open_file_like(self.source, 'rb', cache=self.cache)
+                self._local.file = file
+            return self._readinto_storages(file, start, extents)
+        with self.lock:
+            return self._readinto_storages(self.file, start, extents)
+
+    def _engine_read_storages(self, start, end, extents):
+        # pieces of the span are [start, end, future]; with a cache they are whole cache blocks,
+        # cached ones already done, and the fetched ones are stored once the storages are filled
+        file = self.file
+        caching = file.cache is not None and file.oid is not None
+        cached = {}
+        block_size = piece = ENGINE_PIECE
+        if caching:
+            block_size = file.cache.block_size
+            piece = max(ENGINE_PIECE // block_size, 1) * block_size
+            start = start // block_size * block_size
+            end = min(-(-end // block_size) * block_size, file.size)
+            for pos in range(start, end, block_size):
+                data = file.cache.get(file.oid, pos // block_size, min(block_size, file.size - pos))
+                if data is not None:
+                    cached[pos] = data
+        pieces = []
+        pos = start
+        while pos < end:
+            if pos in cached:
+                fut = concurrent.futures.Future()
+                fut.set_result(cached[pos])
+                pieces.append([pos, pos + len(cached[pos]), fut])
+                pos += len(cached[pos])
+                continue
+            piece_end = pos
+            while piece_end < min(pos + piece, end) and piece_end not in cached:
+                piece_end = min(piece_end + block_size, end)
+            pieces.append([pos, piece_end, self.engine.submit(file._href, pos, piece_end, file.headers)])
+            pos = piece_end
+        try:
+            storages = []
+            for offset, nbytes, *_ in extents:
+                buf = torch.empty(nbytes, dtype=torch.uint8)
+                if nbytes:
+                    view = memoryview((ctypes.c_char * nbytes).from_address(buf.data_ptr())).cast('B')
+                    for piece_start, piece_end, fut in pieces:
+                        lo, hi = max(piece_start, offset), min(piece_end, offset + nbytes)
+                        if lo < hi:
+                            view[lo-offset:hi-offset] = memoryview(fut.result())[lo-piece_start:hi-piece_start]
+                storages.append(buf.untyped_storage())
+            for piece_start, piece_end, fut in pieces:
+                if caching and piece_start not in cached:
+                    file._store(piece_start, fut.result())
+            return storages
+        finally:
+            for piece_start, piece_end, fut in pieces:
+                fut.cancel()
+
+    @staticmethod
+    def _readinto_storages(file, start, extents):
+        # reads forward through the span, so a remote file streams it rather than seeking per record
+        file.seek(start)
+        pos = start
+        storages = []
+        for offset, nbytes, *_ in extents:
+            if offset != pos:
+                file.seek(offset)
+            buf = torch.empty(nbytes, dtype=torch.uint8)
+            if nbytes:
+                view = memoryview((ctypes.c_char * nbytes).from_address(buf.data_ptr())).cast('B')
+                filled = 0
+                while filled < nbytes:
+                    if hasattr(file, 'readinto'):
+                        count = file.readinto(view[filled:])
+                    else:
+                        chunk = file.read(nbytes - filled)
+                        count = len(chunk)
+                        view[filled:filled+count] = chunk
+                    if not count:
+                        raise EOFError(offset, nbytes)
+                    filled += count
+            pos = offset + nbytes
+            storages.append(buf.untyped_storage())
+        return storages
+
+    def storage(self, untyped, dtype, location):
+        return torch.storage.TypedStorage(
+            wrap_storage=self.restore_location(untyped, location),
+            dtype=dtype,
+            _internal=True)
+
+    def load_storages(self, records, merge_gap=MERGE_GAP, max_span=MAX_SPAN):
+        # records is key -> (dtype, nbytes, location); returns key -> typed storage
+        extents = [
+            [self.storage_offset(key), nbytes, key]
+            for key, (dtype, nbytes, location) in records.items()
+        ]
+        storages = {}
+        for start, end, span_extents in _spans(extents, merge_gap, max_span):
+            for [offset, nbytes, key], untyped in zip(span_extents, self.read_storages(start, end, span_extents)):
+                dtype, nbytes, location = records[key]
+                storages[key] = self.storage(untyped, dtype, location)
+        return storages
+
+SAFETENSORS_DTYPES = {
+    'BOOL': 'bool', 'U8': 'uint8', 'I8': 'int8', 'I16': 'int16', 'I32': 'int32', 'I64': 'int64',
+    'U16': 'uint16', 'U32': 'uint32', 'U64': 'uint64',
+    'F16': 'float16', 'BF16': 'bfloat16', 'F32': 'float32', 'F64': 'float64',
+    'F8_E4M3': 'float8_e4m3fn', 'F8_E5M2': 'float8_e5m2', 'F8_E8M0': 'float8_e8m0fnu',
+    'C64': 'complex64',
+}
+
+def _safetensors_dtype(name, code):
+    # the torch dtype of a safetensors dtype code; older torch lacks some, such as U16 before 2.3
+    dtype = getattr(torch, SAFETENSORS_DTYPES.get(code, ''), None)
+    if not isinstance(dtype, torch.dtype):
+        raise ValueError(f'tensor {name} has safetensors dtype {code}, which this version of torch cannot represent')
+    return dtype
+
+class _SafetensorsArchive(_RemoteArchive):
+    # tensors of a safetensors file; each tensor is its own storage, keyed by tensor name
+    def __init__(self, opened_file, restore_location, offsets, source=None, engine=None, cache=None):
+        super().__init__(opened_file, None, restore_location, source=source, engine=engine, cache=cache)
+        self._storage_offsets = offsets
+
+    def storage_offset(self, key):
+        return self._storage_offsets[key]
+
+def load_safetensors(f: FILE_LIKE, map_location: MAP_LOCATION = None, engine: Any = None, cache: Any = None) -> Dict[str, torch.Tensor]:
+    # returns a dict of name -> meta tensor with remote_fetch and remote_name, as load() does
+    # only the 8-byte length and json header are read; each fetch reads its tensor's exact byte range
+    opened_file = _open_file_like(f, 'rb', engine, cache).__enter__()
+    opened_file.seek(0)
+    header_len = int.from_bytes(_RemoteArchive._read_from(opened_file, 0, 8), 'little')
+    header = json.loads(_RemoteArchive._read_from(opened_file, 8, header_len))
+    header.pop('__metadata__', None)
+    data_start = 8 + header_len
+    archive = _SafetensorsArchive(opened_file, _get_restore_location(map_location), {
+        name: data_start + entry['data_offsets'][0]
+        for name, entry in header.items()
+    }, source=f, engine=engine, cache=cache)
+    result = {}
+    for name, entry in header.items():
+        dtype = _safetensors_dtype(name, entry['dtype'])
+        size = tuple(entry['shape'])
+        begin, end = entry['data_offsets']
+        nbytes = end - begin
+        stride = []
+        numel = 1
+        for dim in reversed(size):
+            stride.insert(0, numel)
+            numel *= dim
+        stride = tuple(stride)
+        def rebuild(typed_storage, size=size, stride=stride):
+            return torch._utils._rebuild_tensor_v2(typed_storage, 0, size, stride, False, collections.OrderedDict())
+        tensor = rebuild(torch.TypedStorage(numel, dtype=dtype, device='meta', _internal=True))
+        storage_info = (dtype, nbytes, 'cpu')
+        tensor.remote_fetch = lambda key=name, storage_info=storage_info, rebuild=rebuild: rebuild(archive.load_storages({key: storage_info})[key])
+        tensor.remote_name = name
+        tensor.remote_archive = archive
+        tensor.remote_key = name
+        tensor.remote_storage = storage_info
+        tensor.remote_rebuild = rebuild
+        result[name] = tensor
+    return result
+
+class LazyStateDict(collections.abc.Mapping):
+    # name -> meta tensor across the shards of a checkpoint
+    # a shard is opened with load() the first time one of its tensors is looked up
+    def __init__(self, weight_map, shard_paths, metadata=None, **load_args):
+        self.weight_map = weight_map
+        self.shard_paths = shard_paths
+        self.metadata = metadata or {}
+        self._load_args = load_args
+        self._shards = {}
+        self._locks = {shard: threading.Lock() for shard in shard_paths}
+
+    def shard(self, shard):
+        loaded = self._shards.get(shard)
+        if loaded is None:
+            with self._locks[shard]:
+                loaded = self._shards.get(shard)
+                if loaded is None:
+                    loaded = load(self.shard_paths[shard], **self._load_args)
+                    self._shards[shard] = loaded
+        return loaded
+
+    def opened_shards(self):
+        return list(self._shards)
+
+    def __getitem__(self, name):
+        return self.shard(self.weight_map[name])[name]
+
+    def __iter__(self):
+        return iter(self.weight_map)
+
+    def __len__(self):
+        return len(self.weight_map)
+
+    def __contains__(self, name):
+        return name in self.weight_map
+
+def load_sharded(index: Union[str, os.PathLike], map_location: MAP_LOCATION = None, **load_args) -> LazyStateDict:
+    # index is the path or url of a pytorch_model.bin.index.json or model.safetensors.index.json
+    # only the index is read here; shards are found next to it and opened when first needed
+    index = os.fspath(index)
+    with _open_file_like(index, 'rb', load_args.get('engine'), load_args.get('cache')) as fh:
+        document = json.loads(fh.read())
+    if index.startswith('http'):
+        base = index.rsplit('/', 1)[0] + '/'
+    else:
+        base = os.path.dirname(index)
+    weight_map = document['weight_map']
+    shard_paths = {
+        shard: base + shard if index.startswith('http') else os.path.join(base, shard)
+        for shard in set(weight_map.values())
+    }
+    return LazyStateDict(weight_map, shard_paths, document.get('metadata'), map_location=map_location, **load_args)
+
+def _load(zip_file, map_location, pickle_module, pickle_file='data.pkl', opened_file=None, source=None, engine=None, cache=None, **pickle_load_args):
     restore_location = _get_restore_location(map_location)
+    archive = _RemoteArchive(opened_file, zip_file, restore_location, source=source, engine=engine, cache=cache)
 
     #loaded_storages = {}
 
     def load_tensor(dtype, numel, key, location):
         name = f'data/{key}'
 
-        storage = zip_file.get_storage_from_record(name, numel, torch.UntypedStorage)._typed_storage()._untyped_storage
+        with archive.lock:
+            storage = zip_file.get_storage_from_record(name, numel, torch.UntypedStorage)._typed_storage()._untyped_storage
         # TODO: Once we decide to break serialization FC, we can
         # stop wrapping with TypedStorage
         typed_storage = torch.storage.TypedStorage(
@@ -194,10 +812,24 @@ def _load(zip_file, map_location, pickle_module, pickle_file='data.pkl', **pickl
             typename, storage_type, key, location, numel, dtype, nbytes = data
             tensor = Constructor(torch.TypedStorage(numel, dtype=dtype, device='meta', _internal=True), *params, **kwparams)
             def fetch():
-                typed_storage = load_tensor(dtype, nbytes, key, _maybe_decode_ascii(location))
+                if opened_file is not None:
+                    # mapped or read in place, rather than copied out of the zip reader
+                    storage_info = (dtype, nbytes, _maybe_decode_ascii(location))
+                    typed_storage = archive.load_storages({key: storage_info})[key]
+                else:
+                    typed_storage = load_tensor(dtype, nbytes, key, _maybe_decode_ascii(location))
                 return Constructor(typed_storage, *params, **kwparams)
             tensor.remote_fetch = fetch
             tensor.remote_name = f'data/{key}'
+            if opened_file is not None:
+                tensor.remote_archive = archive
+                tensor.remote_key = key
+                tensor.remote_storage = (dtype, nbytes, _maybe_decode_ascii(location))
+                tensor.remote_rebuild = lambda typed_storage: Constructor(typed_storage, *params, **kwparams)
+                if Constructor is torch._utils._rebuild_tensor_v2 and len(params) == 5 and not params[4] and not kwparams:
+                    # plain tensors can be recorded in a manifest
+                    storage_offset, size, stride, requires_grad, backward_hooks = params
+                    tensor.remote_params = (storage_offset, tuple(size), tuple(stride), requires_grad)
             return tensor
         return RemoteTensor
 
@@ -266,9 +898,216 @@ def _load(zip_file, map_location, pickle_module, pickle_file='data.pkl', **pickl
 
     return result
 
-def _open_file_like(name_or_buffer, mode):
+class _HTTPFile(io.RawIOBase):
+    # a read-only seekable file over http range requests, buffering one block
+    # the block size restarts at HTTP_MIN_BLOCK on every jump and doubles while reads are
+    # sequential, up to HTTP_EFFICIENCY times the latency-throughput product measured so far
+    # with a cache, requests cover whole cache blocks and blocks already cached are not fetched;
+    # blocks are keyed by oid: the sha256 a hub etag gives, or else a hash of the url and etag
+    EWMA = 0.3 # weight of each new latency and throughput sample
+    def __init__(self, url, headers={}, engine=None, cache=None):
+        import requests
+        self.name = url
+        self.url = url
+        self.headers = dict(headers)
+        self.engine = engine
+        self.cache = cache
+        self.etag = None # X-Linked-Etag of a hub url, or else the ETag of the content
+        self.oid = None # the cache key of the content, if its etag identifies it
+        self._session = requests.Session()
+        self._href = url # the url after redirects, requested until it is refused
+        self.size = self._probe_size()
+        self.pos = 0
+        self._buf = b''
+        self._buf_start = 0
+        self._fetched_end = None
+        self._block = HTTP_MIN_BLOCK
+        self.latency = None # seconds to response headers
+        self.throughput = None # bytes per second of response bodies
+
+    def _probe_size(self):
+        from test.transport import Transport
+        resp = self._session.head(self.url, headers=self.headers, allow_redirects=True, timeout=Transport.TIMEOUT)
+        resp.raise_for_status()
+        self._href = resp.url
+        self.etag = self._etag([*resp.history, resp])
+        if self.cache is not None:
+            self.oid = self._oid()
+        if 'Content-Length' in resp.headers and 'Content-Encoding' not in resp.headers:
+            return int(resp.headers['Content-Length'])
+        resp = self._request(0, 1)
+        return int(resp.headers['Content-Range'].rsplit('/', 1)[1])
+
+    def _request(self, start, end):
+        import requests
+        from test.transport import Transport
+        headers = dict(self.headers, Range=f'bytes={start}-{end-1}')
+        for attempt in range(Transport.RETRIES + 1):
+            try:
+                resp = self._session.get(self._href, headers=headers, stream=True, timeout=Transport.TIMEOUT)
+            except (requests.Timeout, requests.ConnectionError):
+                if attempt == Transport.RETRIES:
+                    raise
+                time.sleep(Transport.retry_delay(None, attempt))
+                continue
+            if resp.status_code in [401, 403, 410] and self._href != self.url:
+                # a signed redirect expired; resolve it again
+                resp.close()
+                self._href = self.url
+                continue
+            if resp.status_code in Transport.RETRY_STATUSES and attempt < Transport.RETRIES:
+                resp.close()
+                time.sleep(Transport.retry_delay(resp.headers, attempt))
+                continue
+            resp.raise_for_status()
+            if resp.url != self._href:
+                self._href = resp.url
+            return resp
+        resp.raise_for_status()
+        return resp
+
+    @staticmethod
+    def _etag(responses):
+        # the hub puts the lfs oid in X-Linked-Etag of the response that redirects to the cdn
+        for resp in responses:
+            etag = resp.headers.get('X-Linked-Etag')
+            if etag is not None:
+                return etag
+        return responses[-1].headers.get('ETag')
+
+    def _oid(self):
+        etag = self.etag
+        if etag is None or etag.startswith('W/'):
+            return None
+        etag = etag.strip('"')
+        if re.fullmatch('[0-9a-f]{64}', etag):
+            return etag
+        return hashlib.sha256(('etag:' + self.url + ':' + etag).encode()).hexdigest()
+
+    def _fetch(self, start, end):
+        if self.cache is None or self.oid is None:
+            return self._fetch_remote(start, end)
+        block_size = self.cache.block_size
+        first = start // block_size
+        blocks = [
+            self.cache.get(self.oid, idx, min(block_size, self.size - idx * block_size))
+            for idx in range(first, -(-end // block_size))
+        ]
+        idx = 0
+        while idx < len(blocks):
+            if blocks[idx] is not None:
+                idx += 1
+                continue
+            missing = idx
+            while idx < len(blocks) and blocks[idx] is None:
+                idx += 1
+            fetch_start = (first + missing) * block_size
+            content = self._fetch_remote(fetch_start, min((first + idx) * block_size, self.size))
+            self._store(fetch_start, content)
+            blocks[missing:idx] = [content[pos:pos+block_size] for pos in range(0, len(content), block_size)]
+        content = b''.join(blocks)
+        return content[start - first * block_size:end - first * block_size]
+
+    def _store(self, start, content):
+        # puts content fetched from start, a multiple of the block size, into the cache
+        block_size = self.cache.block_size
+        for pos in range(0, len(content), block_size):
+            self.cache.put(self.oid, (start + pos) // block_size, content[pos:pos+block_size])
+
+    def _fetch_remote(self, start, end):
+        if self.engine is not None:
+            return self._fetch_engine(start, end)
+        began = time.monotonic()
+        resp = self._request(start, end)
+        headed = time.monotonic()
+        content = resp.content
+        done = time.monotonic()
+        if resp.status_code != 206:
+            # server ignored the range
+            content = content[start:end]
+        self.latency = headed - began if self.latency is None else self.latency + self.EWMA * (headed - began - self.latency)
+        if len(content) >= HTTP_MIN_BLOCK and done > headed:
+            rate = len(content) / (done - headed)
+            self.throughput = rate if self.throughput is None else self.throughput + self.EWMA * (rate - self.throughput)
+        if len(content) != end - start:
+            raise EOFError(start, end - start)
+        return content
+
+    def _fetch_engine(self, start, end):
+        # only the total time is seen: small requests measure latency, larger ones throughput net of it
+        began = time.monotonic()
+        content = self.engine.submit(self._href, start, end, self.headers).result()
+        elapsed = time.monotonic() - began
+        if len(content) <= HTTP_MIN_BLOCK or self.latency is None:
+            self.latency = elapsed if self.latency is None else self.latency + self.EWMA * (elapsed - self.latency)
+        elif elapsed > self.latency:
+            rate = len(content) / (elapsed - self.latency)
+            self.throughput = rate if self.throughput is None else self.throughput + self.EWMA * (rate - self.throughput)
+        if len(content) != end - start:
+            raise EOFError(start, end - start)
+        return content
+
+    def _next_block(self, sequential):
+        if not sequential:
+            self._block = HTTP_MIN_BLOCK
+        else:
+            target = HTTP_MAX_BLOCK
+            if self.latency is not None and self.throughput is not None:
+                target = HTTP_EFFICIENCY * self.latency * self.throughput
+            self._block = int(min(max(min(self._block * 2, target), HTTP_MIN_BLOCK), HTTP_MAX_BLOCK))
+        return self._block
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('negative seek position', offset)
+        self.pos = offset
+        return self.pos
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        size = min(len(view), self.size - self.pos)
+        if size <= 0:
+            return 0
+        offset = self.pos - self._buf_start
+        if 0 <= offset < len(self._buf):
+            count = min(size, len(self._buf) - offset)
+            view[:count] = self._buf[offset:offset+count]
+        else:
+            block = min(self._next_block(self.pos == self._fetched_end), self.size - self.pos)
+            if size >= block:
+                # bulk reads go straight to the caller
+                count = min(size, HTTP_MAX_BLOCK)
+                view[:count] = self._fetch(self.pos, self.pos + count)
+                self._fetched_end = self.pos + count
+            else:
+                self._buf = self._fetch(self.pos, self.pos + block)
+                self._buf_start = self.pos
+                self._fetched_end = self.pos + block
+                count = size
+                view[:count] = self._buf[:count]
+        self.pos += count
+        return count
+
+    def close(self):
+        if not self.closed:
+            self._session.close()
+        super().close()
+
+def _open_file_like(name_or_buffer, mode, engine=None, cache=None):
     if type(name_or_buffer) is str and name_or_buffer.startswith('http'):
-        import httpio
-        return httpio.open(name_or_buffer, block_size=1024*1024)
+        return _HTTPFile(name_or_buffer, engine=engine, cache=cache)
     else:
         return torch.serialization._open_file_like(name_or_buffer, mode)